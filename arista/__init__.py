@@ -44,13 +44,25 @@ def init():
         Initialize the arista module. You MUST call this method after
         importing.
     """
+    import accounting
+    import analysis
+    import cache
+    import complexity
+    import concat
     import discoverer
     import dvd
+    import history
     import inputs
+    import ladder
+    import metrics
     import presets
+    import profiler
+    import speed
     import queue
+    import tracing
     import transcoder
     import utils
+    import watchdog
 
 __version__ = _("0.9.8")
 __author__ = _("Daniel G. Taylor <dan@programmer-art.org>")
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+    Arista Resource Accounting
+    ==========================
+    Measure the resources each transcode job uses, such as wall and CPU
+    time, memory and I/O, and keep a summary over all jobs for capacity
+    planning.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import gettext
+import logging
+import os
+import resource
+import time
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.accounting")
+
+def _get_io():
+    """
+        Get the number of bytes this process has read and written, or None
+        where /proc/self/io isn't available.
+    """
+    try:
+        lines = open("/proc/self/io").readlines()
+    except IOError:
+        return None
+
+    io = {}
+    for line in lines:
+        key, value = line.split(":")
+        io[key.strip()] = int(value)
+    return io
+
+class JobAccount(object):
+    """
+        Resource use of a single job. Jobs in a queue run one at a time, so
+        the difference in this process' resource use between the start and
+        end of a job is what the job used. Peak RSS can only be measured for
+        the whole process, so it is the highest value up to the end of the
+        job.
+    """
+    def __init__(self):
+        self.started = None
+        self.passes = []
+        self.abandoned = []
+        self._pass_start = None
+        self._usage = None
+        self._io = None
+
+    def start(self):
+        """
+            Take the initial measurements when the job starts.
+        """
+        self.started = time.time()
+        self._usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._io = _get_io()
+
+    def pass_started(self):
+        self._pass_start = time.time()
+
+    def pass_completed(self):
+        if self._pass_start is not None:
+            self.passes.append(time.time() - self._pass_start)
+            self._pass_start = None
+
+    def pass_abandoned(self, enc_pass, reason):
+        """
+            Record a pass that was thrown away to be run again, e.g. after
+            it stalled.
+
+            @type enc_pass: int
+            @param enc_pass: The index of the abandoned pass
+            @type reason: str
+            @param reason: Why it was thrown away
+        """
+        if self._pass_start is not None:
+            self.abandoned.append({
+                "pass": enc_pass + 1,
+                "time": time.time() - self._pass_start,
+                "reason": reason,
+            })
+            self._pass_start = None
+
+    def finish(self, entry, success):
+        """
+            Take the final measurements and create a record of the job.
+
+            @type entry: arista.queue.QueueEntry
+            @param entry: The finished queue entry
+            @type success: bool
+            @param success: Whether the job completed without errors
+            @rtype: dict
+            @return: The job record, which can be serialized as JSON
+        """
+        wall = time.time() - self.started
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        io = _get_io()
+        transcoder = getattr(entry, "transcoder", None)
+        options = entry.options
+
+        record = {
+            "input": options.uri,
+            "output": options.output_uri,
+            "preset": options.preset and options.preset.name or None,
+            "success": success,
+            "started": self.started,
+            "wall_time": wall,
+            "pass_times": self.passes,
+            "abandoned_passes": self.abandoned,
+            "cpu_user": usage.ru_utime - self._usage.ru_utime,
+            "cpu_system": usage.ru_stime - self._usage.ru_stime,
+            # Kilobytes on Linux
+            "peak_rss": usage.ru_maxrss,
+            "bytes_read": None,
+            "bytes_written": None,
+            "output_bytes": None,
+            "realtime_factor": None,
+        }
+
+        if io and self._io:
+            record["bytes_read"] = io["rchar"] - self._io["rchar"]
+            record["bytes_written"] = io["wchar"] - self._io["wchar"]
+
+        try:
+            record["output_bytes"] = os.path.getsize(options.output_uri)
+        except (OSError, TypeError):
+            pass
+
+        if transcoder:
+            duration = getattr(transcoder, "output_duration", 0)
+            if duration and wall:
+                record["realtime_factor"] = duration / wall
+            record["duration"] = duration
+            info = getattr(transcoder, "info", None)
+            record["input_width"] = info and info.videowidth or 0
+            record["input_height"] = info and info.videoheight or 0
+            record.update(getattr(transcoder, "metadata", {}))
+
+        return record
+
+class AccountSummary(object):
+    """
+        Totals over all finished jobs of a queue.
+    """
+    def __init__(self):
+        self.jobs = 0
+        self.failed = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.duration = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss = 0
+
+    def add(self, record):
+        """
+            Add a finished job.
+
+            @type record: dict
+            @param record: A record from JobAccount.finish
+        """
+        self.jobs += 1
+        if not record["success"]:
+            self.failed += 1
+        self.wall_time += record["wall_time"]
+        self.cpu_time += record["cpu_user"] + record["cpu_system"]
+        self.duration += record.get("duration") or 0.0
+        self.bytes_read += record["bytes_read"] or 0
+        self.bytes_written += record["bytes_written"] or 0
+        self.peak_rss = max(self.peak_rss, record["peak_rss"])
+
+    def to_dict(self):
+        """
+            @rtype: dict
+            @return: The summary, which can be serialized as JSON
+        """
+        return {
+            "jobs": self.jobs,
+            "failed": self.failed,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "cpu_utilization": self.wall_time and self.cpu_time / self.wall_time or 0.0,
+            "duration": self.duration,
+            "realtime_factor": self.wall_time and self.duration / self.wall_time or 0.0,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "peak_rss": self.peak_rss,
+        }
+
+def write_record(directory, record):
+    """
+        Write a job record to a new JSON file in a directory.
+
+        @type directory: str
+        @param directory: Where to write the record
+        @type record: dict
+        @param record: A record from JobAccount.finish
+        @rtype: str
+        @return: The path of the new file or None on errors
+    """
+    name = os.path.splitext(os.path.basename(record["output"] or "job"))[0]
+    path = os.path.join(directory, "%s-%d.json" % (name, record["started"] * 1000))
+    try:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        open(path, "w").write(json.dumps(record, indent=4, sort_keys=True))
+    except (IOError, OSError), e:
+        _log.warning(_("Unable to write job report %(filename)s: %(error)s") % {
+            "filename": path,
+            "error": str(e),
+        })
+        return None
+    return path
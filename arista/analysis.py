@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+
+"""
+    Arista Source Analysis
+    ======================
+    Tools to pull decoded frames out of a file and compute statistics on
+    them, used to pick better transcoding settings before encoding starts.
+
+    Statistics are computed with numpy, which is optional. If it is not
+    installed, analysis is simply not available.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import gettext
+import logging
+import os
+
+import gobject
+import gst
+
+import cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.analysis")
+
+# A pixel is combed when it differs from both lines around it in the same
+# direction by more than this (product of the two differences)
+_COMB_PIXEL_THRESHOLD = 100
+
+# A frame is combed when more than this fraction of its pixels are combed
+_COMB_FRAME_THRESHOLD = 0.005
+
+# Fraction of frames that must follow the 3:2 pulldown pattern
+_TELECINE_MATCH = 0.8
+
+# Frames whose mean absolute luma difference to the previous frame is below
+# this are considered static, and can't show whether a source is interlaced
+_MOTION_THRESHOLD = 2.0
+
+# Fraction of moving frames that must be combed for a source to count as
+# interlaced, and the fraction below which it counts as progressive
+_INTERLACED_MIN = 0.7
+_PROGRESSIVE_MAX = 0.1
+
+# Never crop away more than this fraction of the width or height, larger
+# borders are more likely dark content than black bars
+_CROP_MAX = 0.4
+
+# Scene detection compares histograms of frames scaled down to this size
+_SCENE_WIDTH = 64
+_SCENE_HEIGHT = 36
+_SCENE_BINS = 32
+
+# Luma percentiles used to measure the contrast of a frame, so that a few
+# bright or dark pixels don't count as a well exposed frame
+_SPREAD_LOW = 5
+_SPREAD_HIGH = 95
+
+PROGRESSIVE = "progressive"
+INTERLACED = "interlaced"
+MIXED = "mixed"
+
+class AnalysisException(Exception):
+    """
+        An exception to be thrown when a source can't be analyzed.
+    """
+    pass
+
+def available():
+    """
+        Check whether source analysis is possible.
+
+        @rtype: bool
+        @return: True if numpy is installed
+    """
+    return numpy is not None
+
+class FrameSampler(object):
+    """
+        Pull decoded frames out of a file through an appsink. Frames are
+        returned as 8-bit luma numpy arrays, which is all the statistics
+        below need, either at the source size or scaled down.
+    """
+    def __init__(self, uri, width=None, height=None):
+        """
+            @type uri: str
+            @param uri: The URI of the file to sample
+            @type width: int
+            @param width: Scale frames to this width (default: source width)
+            @type height: int
+            @param height: Scale frames to this height (default: source
+                           height)
+        """
+        if not available():
+            raise AnalysisException(_("numpy is required for analysis!"))
+
+        self.uri = uri
+        self.width = width
+        self.height = height
+        self.pipe = None
+        self.sink = None
+
+    def open(self):
+        """
+            Build the sampling pipeline and preroll it.
+        """
+        caps = "video/x-raw-gray,bpp=8,depth=8"
+        if self.width and self.height:
+            caps += ",width=%d,height=%d" % (self.width, self.height)
+
+        cmd = "uridecodebin uri=\"%s\" ! ffmpegcolorspace ! videoscale ! " \
+              "appsink name=sink caps=\"%s\" sync=false max-buffers=2 " \
+              "drop=false" % (self.uri, caps)
+
+        try:
+            self.pipe = gst.parse_launch(cmd)
+        except gobject.GError, e:
+            raise AnalysisException(str(e))
+
+        self.sink = self.pipe.get_by_name("sink")
+        self.pipe.set_state(gst.STATE_PAUSED)
+        if self.pipe.get_state()[0] == gst.STATE_CHANGE_FAILURE:
+            self.close()
+            raise AnalysisException(_("Unable to decode %(uri)s") % {
+                "uri": self.uri,
+            })
+        self.pipe.set_state(gst.STATE_PLAYING)
+
+    def close(self):
+        """
+            Shut down the sampling pipeline.
+        """
+        if self.pipe:
+            self.pipe.set_state(gst.STATE_NULL)
+            self.pipe = None
+            self.sink = None
+
+    def sample(self, position, count=1, accurate=False):
+        """
+            Get consecutive frames starting at a position.
+
+            @type position: int
+            @param position: The position in nanoseconds
+            @type count: int
+            @param count: The number of consecutive frames to return
+            @type accurate: bool
+            @param accurate: Seek exactly to position instead of the nearest
+                             keyframe before it
+            @rtype: list
+            @return: A list of (timestamp, frame) tuples
+        """
+        flags = gst.SEEK_FLAG_FLUSH
+        if accurate:
+            flags |= gst.SEEK_FLAG_ACCURATE
+        else:
+            flags |= gst.SEEK_FLAG_KEY_UNIT
+
+        self.pipe.seek_simple(gst.FORMAT_TIME, flags, position)
+
+        frames = []
+        while len(frames) < count:
+            buffer = self.sink.emit("pull-buffer")
+            if buffer is None:
+                break
+            frames.append((buffer.timestamp, self._to_array(buffer)))
+        return frames
+
+    def frames(self):
+        """
+            Iterate over every frame from the current position to the end.
+
+            @rtype: generator
+            @return: (timestamp, frame) tuples
+        """
+        while True:
+            buffer = self.sink.emit("pull-buffer")
+            if buffer is None:
+                break
+            yield buffer.timestamp, self._to_array(buffer)
+
+    def _to_array(self, buffer):
+        """
+            Get a two dimensional view of the luma in a buffer. Rows are
+            padded to four bytes, the padding is sliced away.
+        """
+        struct = buffer.get_caps()[0]
+        width, height = struct["width"], struct["height"]
+        stride = (width + 3) & ~3
+
+        try:
+            data = numpy.frombuffer(buffer, numpy.uint8)
+        except (TypeError, AttributeError):
+            data = numpy.fromstring(buffer.data, numpy.uint8)
+
+        return data[:stride * height].reshape(height, stride)[:, :width]
+
+def comb_scores(frames):
+    """
+        Get the fraction of pixels in each frame that show interlacing
+        artifacts, i.e. that differ from the lines above and below in the
+        same direction. All frames are processed at once.
+
+        @type frames: list
+        @param frames: Luma frames of the same size at full vertical
+                       resolution
+        @rtype: numpy.ndarray
+        @return: The fraction of combed pixels for each frame
+    """
+    lines = numpy.array(frames, numpy.int32)
+    middle = lines[:, 1:-1]
+    comb = (middle - lines[:, :-2]) * (middle - lines[:, 2:])
+    return (comb > _COMB_PIXEL_THRESHOLD).mean(axis=2).mean(axis=1)
+
+def comb_score(frame):
+    """
+        @type frame: numpy.ndarray
+        @param frame: Luma at full vertical resolution
+        @rtype: float
+        @return: The fraction of combed pixels between 0.0 and 1.0
+    """
+    return float(comb_scores([frame])[0])
+
+def is_combed(frame):
+    """
+        @type frame: numpy.ndarray
+        @param frame: Luma at full vertical resolution
+        @rtype: bool
+        @return: True if the frame shows interlacing artifacts
+    """
+    return comb_score(frame) > _COMB_FRAME_THRESHOLD
+
+def detect_telecine(sequences):
+    """
+        Detect the 3:2 pulldown pattern in runs of consecutive frames. A
+        telecined source shows two combed frames next to each other in
+        every five, at the same phase throughout a run.
+
+        @type sequences: list
+        @param sequences: Lists of combed flags for consecutive frames
+        @rtype: bool
+        @return: True if the source looks telecined
+    """
+    matched = total = 0
+    for flags in sequences:
+        # Runs without motion don't show any combing and tell us nothing
+        if len(flags) < 10 or flags.count(True) < 2:
+            continue
+
+        best = 0
+        for phase in range(5):
+            score = 0
+            for pos, combed in enumerate(flags):
+                if combed == ((pos + phase) % 5 in (0, 1)):
+                    score += 1
+            best = max(best, score)
+
+        matched += best
+        total += len(flags)
+
+    if not total:
+        return False
+
+    _log.debug("Pulldown pattern match: %d/%d" % (matched, total))
+    return matched / float(total) >= _TELECINE_MATCH
+
+def motion_scores(frames):
+    """
+        Get the mean absolute luma difference between each frame and the
+        one before it.
+
+        @type frames: list
+        @param frames: Consecutive luma frames of the same size
+        @rtype: numpy.ndarray
+        @return: One score per frame after the first
+    """
+    stack = numpy.array(frames, numpy.int16)
+    return numpy.abs(stack[1:] - stack[:-1]).mean(axis=2).mean(axis=1)
+
+def classify_interlacing(runs):
+    """
+        Classify a source from runs of consecutive frames. Only frames with
+        motion are considered, as static interlaced frames look just like
+        progressive ones.
+
+        @type runs: list
+        @param runs: Lists of consecutive luma frames at full vertical
+                     resolution
+        @rtype: str
+        @return: PROGRESSIVE, INTERLACED or MIXED
+    """
+    moving = combed = 0
+    for frames in runs:
+        if len(frames) < 2:
+            continue
+
+        motion = motion_scores(frames) >= _MOTION_THRESHOLD
+        combs = comb_scores(frames[1:]) > _COMB_FRAME_THRESHOLD
+        moving += int(motion.sum())
+        combed += int((motion & combs).sum())
+
+    if not moving:
+        return PROGRESSIVE
+
+    ratio = combed / float(moving)
+    _log.debug("Combed frames: %d/%d" % (combed, moving))
+    if ratio >= _INTERLACED_MIN:
+        return INTERLACED
+    elif ratio <= _PROGRESSIVE_MAX:
+        return PROGRESSIVE
+    return MIXED
+
+def detect_crop(frames, threshold=24):
+    """
+        Find black borders that are present in every frame. Rows and columns
+        are compared by their mean luma, for all frames at once. Frames that
+        are black all over (e.g. fades) are ignored.
+
+        @type frames: list
+        @param frames: Luma frames of the same size
+        @type threshold: int
+        @param threshold: The highest mean luma that still counts as black
+        @rtype: tuple
+        @return: The number of pixels to crop on each side as (top, right,
+                 bottom, left), rounded down to even numbers
+    """
+    stack = numpy.array([frame for frame in frames \
+                         if frame.mean() >= threshold], numpy.float32)
+    if not len(stack):
+        return (0, 0, 0, 0)
+
+    height, width = stack.shape[1:]
+    black_rows = (stack.mean(axis=2) < threshold).all(axis=0)
+    black_cols = (stack.mean(axis=1) < threshold).all(axis=0)
+
+    # argmin finds the first row or column that isn't black
+    top = int(numpy.argmin(black_rows))
+    bottom = int(numpy.argmin(black_rows[::-1]))
+    left = int(numpy.argmin(black_cols))
+    right = int(numpy.argmin(black_cols[::-1]))
+
+    if top + bottom > height * _CROP_MAX:
+        top = bottom = 0
+    if left + right > width * _CROP_MAX:
+        left = right = 0
+
+    return tuple([x - x % 2 for x in (top, right, bottom, left)])
+
+def rgb_frame(buffer, width, height):
+    """
+        Get a view of a packed 24-bit RGB buffer, as pulled from an appsink,
+        without the padding at the end of each row.
+
+        @type buffer: gst.Buffer
+        @param buffer: The RGB frame
+        @type width: int
+        @param width: The frame width
+        @type height: int
+        @param height: The frame height
+        @rtype: numpy.ndarray
+        @return: A height x width x 3 array of 8-bit values
+    """
+    stride = (width * 3 + 3) & ~3
+    try:
+        data = numpy.frombuffer(buffer, numpy.uint8)
+    except (TypeError, AttributeError):
+        data = numpy.fromstring(buffer.data, numpy.uint8)
+
+    rgb = data[:stride * height].reshape(height, stride)[:, :width * 3]
+    return rgb.reshape(height, width, 3)
+
+def rgb_to_luma(buffer, width, height):
+    """
+        Get the luma of a packed 24-bit RGB buffer, as pulled from an
+        appsink. Rows are padded to four bytes.
+
+        @type buffer: gst.Buffer
+        @param buffer: The RGB frame
+        @type width: int
+        @param width: The frame width
+        @type height: int
+        @param height: The frame height
+        @rtype: numpy.ndarray
+        @return: A two dimensional float array of luma values
+    """
+    rgb = rgb_frame(buffer, width, height).astype(numpy.float32)
+    return numpy.dot(rgb, numpy.array([0.299, 0.587, 0.114], numpy.float32))
+
+def frame_quality(frame):
+    """
+        Score how good a frame looks as a thumbnail. Sharp frames with a
+        wide spread of luma values and a medium brightness score highest,
+        black fades and motion blurred frames score close to zero.
+
+        @type frame: numpy.ndarray
+        @param frame: A luma frame
+        @rtype: float
+        @return: The score, only meaningful compared to other frames of the
+                 same size
+    """
+    frame = numpy.asarray(frame, numpy.float32)
+
+    # Variance of the Laplacian, low for blurry or flat frames
+    laplacian = 4 * frame[1:-1, 1:-1] - frame[:-2, 1:-1] - frame[2:, 1:-1] - \
+                frame[1:-1, :-2] - frame[1:-1, 2:]
+    sharpness = numpy.log1p(laplacian.var())
+
+    # Prefer frames that are neither too dark nor too bright
+    exposure = 1.0 - abs(frame.mean() - 128.0) / 128.0
+
+    low, high = numpy.percentile(frame, [_SPREAD_LOW, _SPREAD_HIGH])
+    spread = (high - low) / 255.0
+
+    return float(sharpness * exposure * spread)
+
+class SceneIndex(object):
+    """
+        A list of scene changes in a file as (timestamp, score) tuples,
+        where the timestamp is in nanoseconds and the score is the
+        difference between the luma histograms of the frames before and
+        after the change, between 0.0 and 1.0.
+    """
+    def __init__(self, scenes=None):
+        """
+            @type scenes: list
+            @param scenes: (timestamp, score) tuples sorted by timestamp
+        """
+        self.scenes = scenes or []
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def __iter__(self):
+        return iter(self.scenes)
+
+    @property
+    def timestamps(self):
+        """
+            @rtype: list
+            @return: The timestamps of all scene changes
+        """
+        return [ts for (ts, score) in self.scenes]
+
+    def between(self, start, stop):
+        """
+            Get the scene changes in a time range.
+
+            @type start: int
+            @param start: The start of the range in nanoseconds
+            @type stop: int
+            @param stop: The end of the range in nanoseconds (exclusive)
+            @rtype: list
+            @return: (timestamp, score) tuples
+        """
+        return [(ts, score) for (ts, score) in self.scenes \
+                if start <= ts < stop]
+
+    def nearest(self, timestamp, window=None):
+        """
+            Get the scene change closest to a timestamp.
+
+            @type timestamp: int
+            @param timestamp: The timestamp in nanoseconds
+            @type window: int
+            @param window: Only consider changes this close to timestamp
+            @return: A (timestamp, score) tuple or None
+        """
+        best = None
+        for ts, score in self.scenes:
+            distance = abs(ts - timestamp)
+            if window is not None and distance > window:
+                continue
+            if best is None or distance < abs(best[0] - timestamp):
+                best = (ts, score)
+        return best
+
+    @staticmethod
+    def build(uri, threshold=0.35, min_interval=gst.SECOND):
+        """
+            Scan a file for scene changes. Every frame is decoded, but
+            analyzed scaled down to a small size.
+
+            @type uri: str
+            @param uri: The URI of the file to scan
+            @type threshold: float
+            @param threshold: The smallest histogram difference that counts
+                              as a scene change
+            @type min_interval: int
+            @param min_interval: The shortest scene in nanoseconds
+            @rtype: SceneIndex
+            @return: A new scene index
+        """
+        sampler = FrameSampler(uri, _SCENE_WIDTH, _SCENE_HEIGHT)
+        sampler.open()
+        try:
+            scenes = scene_changes(sampler.frames(), threshold, min_interval)
+        finally:
+            sampler.close()
+
+        _log.debug("Found %d scene changes in %s" % (len(scenes), uri))
+        return SceneIndex(scenes)
+
+def histogram_difference(first, second):
+    """
+        Get the difference between the luma histograms of two frames.
+
+        @type first: numpy.ndarray
+        @param first: A luma frame
+        @type second: numpy.ndarray
+        @param second: A luma frame of the same size
+        @rtype: float
+        @return: The difference between 0.0 (same) and 1.0 (disjoint)
+    """
+    return _histogram_distance(_luma_histogram(first),
+                               _luma_histogram(second), first.size)
+
+def _luma_histogram(frame):
+    return numpy.histogram(frame, _SCENE_BINS, (0, 256))[0]
+
+def _histogram_distance(hist1, hist2, size):
+    return numpy.abs(hist1 - hist2).sum() / (2.0 * size)
+
+def scene_changes(frames, threshold=0.35, min_interval=gst.SECOND):
+    """
+        Find scene changes in a sequence of frames.
+
+        @type frames: iterable
+        @param frames: (timestamp, frame) tuples in decoding order
+        @type threshold: float
+        @param threshold: The smallest histogram difference that counts as
+                          a scene change
+        @type min_interval: int
+        @param min_interval: The shortest scene in nanoseconds
+        @rtype: list
+        @return: (timestamp, score) tuples
+    """
+    scenes = []
+    previous = None
+    last = None
+    for timestamp, frame in frames:
+        # Each histogram is computed once and compared to the next frame's
+        hist = _luma_histogram(frame)
+        if previous is not None:
+            score = _histogram_distance(previous, hist, frame.size)
+            if score >= threshold and \
+               (last is None or timestamp - last >= min_interval):
+                scenes.append((timestamp, float(score)))
+                last = timestamp
+        previous = hist
+    return scenes
+
+def get_scene_index(filename, rebuild=False):
+    """
+        Get the scene index of a file, from the cache if possible. New
+        indexes are stored in the cache next to the file's discovery info.
+
+        @type filename: str
+        @param filename: The path or file:// URI of the file
+        @type rebuild: bool
+        @param rebuild: Ignore any cached index
+        @rtype: SceneIndex
+        @return: The scene index
+    """
+    if not rebuild:
+        scenes = cache.get(filename, "scenes")
+        if scenes is not None:
+            return SceneIndex([tuple(scene) for scene in scenes])
+
+    if filename.startswith("file://"):
+        uri = filename
+    else:
+        uri = "file://" + os.path.abspath(filename)
+
+    index = SceneIndex.build(uri)
+    cache.store(filename, "scenes", index.scenes)
+    return index
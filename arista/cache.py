@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+    Arista Media Cache
+    ==================
+    Store information about input files, such as discovery results and
+    scene-change indexes, so that it can be reused instead of scanning the
+    same file again. Entries are invalidated when a file's size or
+    modification time changes.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import gettext
+import hashlib
+import logging
+import os
+
+import gst
+
+import utils
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.cache")
+
+# Cache hits and misses since startup
+stats = {
+    "hits": 0,
+    "misses": 0,
+}
+
+def _get_filename(filename):
+    """
+        Strip a file:// prefix and make a path absolute.
+    """
+    if filename.startswith("file://"):
+        filename = filename[7:]
+    return os.path.abspath(filename)
+
+def _get_cache_path(filename):
+    """
+        Get the path of the cache entry for a file.
+    """
+    key = hashlib.md5(_get_filename(filename)).hexdigest()
+    return utils.get_write_path("cache", key + ".json")
+
+def _get_stamp(filename):
+    """
+        Get the size and modification time of a file, or None if it isn't a
+        local file.
+    """
+    try:
+        stat = os.stat(_get_filename(filename))
+    except OSError:
+        return None
+    return [stat.st_size, int(stat.st_mtime)]
+
+def _load(filename):
+    """
+        Load the cache entry for a file. Entries for a file that has changed
+        since they were written are ignored.
+    """
+    stamp = _get_stamp(filename)
+    if stamp is None:
+        return None
+
+    try:
+        entry = json.loads(open(_get_cache_path(filename)).read())
+    except (IOError, ValueError):
+        return {"stamp": stamp}
+
+    if entry.get("stamp") != stamp:
+        return {"stamp": stamp}
+
+    return entry
+
+def get(filename, section):
+    """
+        Get cached data about a file.
+
+        @type filename: str
+        @param filename: The path or file:// URI of the file
+        @type section: str
+        @param section: The kind of data, e.g. "discovery" or "scenes"
+        @return: The stored data or None if nothing valid is cached
+    """
+    entry = _load(filename)
+    if entry and section in entry:
+        stats["hits"] += 1
+        return entry[section]
+
+    stats["misses"] += 1
+    return None
+
+def store(filename, section, data):
+    """
+        Store data about a file in the cache.
+
+        @type filename: str
+        @param filename: The path or file:// URI of the file
+        @type section: str
+        @param section: The kind of data, e.g. "discovery" or "scenes"
+        @param data: Anything that can be serialized as JSON
+    """
+    entry = _load(filename)
+    if entry is None:
+        return
+
+    entry[section] = data
+    try:
+        open(_get_cache_path(filename), "w").write(json.dumps(entry))
+    except IOError, e:
+        _log.warning(_("Unable to write cache for %(filename)s: %(error)s") % {
+            "filename": filename,
+            "error": str(e),
+        })
+
+class CachedInfo(object):
+    """
+        Discovery results loaded from the cache. Provides the same basic
+        attributes as arista.discoverer.Discoverer, but no caps or tags.
+    """
+    _fields = ["mimetype", "is_video", "is_audio", "videowidth",
+               "videoheight", "videolength", "audiolength", "audiorate",
+               "audiochannels", "audiowidth", "audiodepth", "audiofloat"]
+
+    def __init__(self, data):
+        for field in self._fields:
+            setattr(self, field, data.get(field))
+        self.videorate = gst.Fraction(*data.get("videorate", [0, 1]))
+        self.finished = True
+
+    @property
+    def length(self):
+        return max(self.videolength, self.audiolength)
+
+    @staticmethod
+    def to_data(info):
+        """
+            Get the cacheable part of discovery results.
+
+            @type info: arista.discoverer.Discoverer
+            @param info: Finished discovery results
+            @rtype: dict
+            @return: Data that can be stored with store()
+        """
+        data = {}
+        for field in CachedInfo._fields:
+            data[field] = getattr(info, field)
+        data["videorate"] = [info.videorate.num, info.videorate.denom]
+        return data
+
+def get_discovery(filename):
+    """
+        Get cached discovery results for a file.
+
+        @type filename: str
+        @param filename: The path or file:// URI of the file
+        @rtype: CachedInfo
+        @return: The cached results or None
+    """
+    data = get(filename, "discovery")
+    return data and CachedInfo(data) or None
+
+def store_discovery(filename, info):
+    """
+        Cache discovery results for a file.
+
+        @type filename: str
+        @param filename: The path or file:// URI of the file
+        @type info: arista.discoverer.Discoverer
+        @param info: Finished discovery results
+    """
+    if info.is_video or info.is_audio:
+        store(filename, "discovery", CachedInfo.to_data(info))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+    Arista Complexity Probe
+    =======================
+    Encode a few short windows spread over the input at a fixed quality
+    and measure how many bits they need. Simple content needs few bits for
+    a given quality and complex content many, so this gives a better video
+    bitrate than the size of the input file, which also includes audio and
+    container overhead and depends on how the input was encoded.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import gettext
+import logging
+import time
+
+import gobject
+import gst
+
+import cache
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.complexity")
+
+# Fast, fixed quality settings the windows are encoded with. The bitrate
+# these need is what the job gets.
+TRIAL_SETTINGS = {
+    "x264enc": "pass=qual quantizer=23 speed-preset=veryfast",
+    "vp8enc": "quality=5.75 speed=2",
+    "theoraenc": "quality=32 speed-level=2",
+}
+
+# Number and length in seconds of the sampled windows
+WINDOWS = 4
+WINDOW_LENGTH = 2
+
+# No more windows are started after this many seconds, so the probe never
+# costs much more than this
+MAX_TIME = 30
+
+class ComplexityException(Exception):
+    """
+        An exception to be thrown when the probe can't run.
+    """
+    pass
+
+class ProbeResult(object):
+    """
+        The outcome of a probe.
+    """
+    def __init__(self, bitrate, windows, seconds, elapsed, cached=False):
+        """
+            @type bitrate: int
+            @param bitrate: The measured video bitrate in kbps
+            @type windows: int
+            @param windows: How many windows were encoded
+            @type seconds: float
+            @param seconds: Seconds of media that were encoded
+            @type elapsed: float
+            @param elapsed: Wall time the probe took in seconds
+            @type cached: bool
+            @param cached: Whether the bitrate came from the cache
+        """
+        self.bitrate = bitrate
+        self.windows = windows
+        self.seconds = seconds
+        self.elapsed = elapsed
+        self.cached = cached
+
+def get_trial_settings(encoder):
+    """
+        @type encoder: str
+        @param encoder: The encoder element name, e.g. x264enc
+        @rtype: str
+        @return: The fixed quality settings or None if the encoder can't
+                 be probed
+    """
+    return TRIAL_SETTINGS.get(encoder)
+
+def probe(uri, encoder, caps, start, stop):
+    """
+        Encode WINDOWS windows spread evenly between start and stop and
+        measure their bitrate.
+
+        @type uri: str
+        @param uri: The URI of the input
+        @type encoder: str
+        @param encoder: The encoder element name, e.g. x264enc
+        @type caps: str
+        @param caps: Raw video caps with the output size to encode at
+        @type start: int
+        @param start: Where the output starts in nanoseconds
+        @type stop: int
+        @param stop: Where the output stops in nanoseconds
+        @rtype: ProbeResult
+        @return: The measured bitrate and what it cost
+        @raise ComplexityException: The input can't be probed
+    """
+    settings = get_trial_settings(encoder)
+    if not settings:
+        raise ComplexityException(_("No trial settings for %(encoder)s") % {
+            "encoder": encoder,
+        })
+
+    cmd = "uridecodebin uri=\"%s\" ! ffmpegcolorspace ! videorate ! " \
+          "videoscale ! %s ! %s %s ! appsink name=sink sync=false" % \
+          (uri, caps, encoder, settings)
+
+    try:
+        pipe = gst.parse_launch(cmd)
+    except gobject.GError, e:
+        raise ComplexityException(str(e))
+
+    begin = time.time()
+    sink = pipe.get_by_name("sink")
+    pipe.set_state(gst.STATE_PAUSED)
+    if pipe.get_state()[0] == gst.STATE_CHANGE_FAILURE:
+        pipe.set_state(gst.STATE_NULL)
+        raise ComplexityException(_("Unable to decode %(uri)s") % {
+            "uri": uri,
+        })
+
+    length = min(WINDOW_LENGTH * gst.SECOND, stop - start)
+    step = max(stop - start - length, 0) / WINDOWS
+    count = step and WINDOWS or 1
+
+    size = 0
+    seconds = 0.0
+    windows = 0
+    try:
+        pipe.set_state(gst.STATE_PLAYING)
+        for window in range(count):
+            if time.time() - begin > MAX_TIME:
+                break
+
+            # Window centers are spread evenly, away from the very start
+            # and end which are often titles or credits
+            position = start + step * window + step / 2
+            pipe.seek(1.0, gst.FORMAT_TIME,
+                      gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
+                      gst.SEEK_TYPE_SET, position,
+                      gst.SEEK_TYPE_SET, position + length)
+
+            while True:
+                buffer = sink.emit("pull-buffer")
+                if buffer is None:
+                    break
+                size += buffer.size
+
+            windows += 1
+            seconds += length / float(gst.SECOND)
+    finally:
+        pipe.set_state(gst.STATE_NULL)
+
+    if not seconds:
+        raise ComplexityException(_("Nothing was encoded"))
+
+    return ProbeResult(int(size * 8 / seconds / 1000), windows, seconds,
+                       time.time() - begin)
+
+def get_bitrate(filename, uri, encoder, caps, start, stop):
+    """
+        Get the bitrate of a file at a given size and range, from the cache
+        if possible. The other parameters are the same as for probe().
+
+        @type filename: str
+        @param filename: The path or file:// URI of the file
+        @rtype: ProbeResult
+        @return: The measured bitrate and what it cost
+        @raise ComplexityException: The input can't be probed
+    """
+    section = "complexity %s %s %d %d" % (encoder, caps, start, stop)
+    bitrate = cache.get(filename, section)
+    if bitrate is not None:
+        return ProbeResult(bitrate, 0, 0.0, 0.0, True)
+
+    result = probe(uri, encoder, caps, start, stop)
+    cache.store(filename, section, result.bitrate)
+    return result
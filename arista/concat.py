@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+    Arista Concatenation Source
+    ===========================
+    A source bin that plays several inputs back to back as if they were a
+    single stream, rebasing timestamps across the joins.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import gettext
+import logging
+
+import gobject
+import gst
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.concat")
+
+VIDEO_CAPS = "video/x-raw-yuv;video/x-raw-rgb"
+AUDIO_CAPS = "audio/x-raw-int;audio/x-raw-float"
+
+class ConcatSource(gst.Bin):
+    """
+        Decode a list of inputs one after another. One gnonlin composition
+        is created per media type and every input is placed on its timeline
+        right after the previous one, so downstream elements see a single
+        continuous stream. Decoded pads are ghosted onto this bin, which
+        behaves like uridecodebin: it emits pad-added for each stream and
+        no-more-pads once all streams are available.
+    """
+    def __init__(self, uris, durations, video=True, audio=True, name=None):
+        """
+            @type uris: list
+            @param uris: The input URIs in playback order
+            @type durations: list
+            @param durations: The duration of each input in nanoseconds
+            @type video: bool
+            @param video: Whether to expose a video stream
+            @type audio: bool
+            @param audio: Whether to expose an audio stream
+            @type name: str
+            @param name: The element name
+        """
+        gst.Bin.__init__(self, name)
+
+        if len(uris) != len(durations):
+            raise ValueError(_("Every input needs a duration!"))
+
+        self.uris = uris
+        self.durations = durations
+        self._compositions = []
+
+        for enabled, caps in [(video, VIDEO_CAPS), (audio, AUDIO_CAPS)]:
+            if not enabled:
+                continue
+
+            comp = gst.element_factory_make("gnlcomposition")
+            comp.set_property("caps", gst.Caps(caps))
+
+            start = 0
+            for uri, duration in zip(uris, durations):
+                source = gst.element_factory_make("gnlurisource")
+                source.set_property("uri", uri)
+                source.set_property("caps", gst.Caps(caps))
+                source.set_property("start", start)
+                source.set_property("duration", duration)
+                source.set_property("media-start", 0)
+                source.set_property("media-duration", duration)
+                comp.add(source)
+                start += duration
+
+            comp.connect("pad-added", self._cb_comp_pad_added)
+            comp.connect("pad-removed", self._cb_comp_pad_removed)
+            self.add(comp)
+            self._compositions.append(comp)
+
+        # Ghost pads by composition name, kept when a composition replaces
+        # its source pad so that links downstream stay in place
+        self._ghosts = {}
+        self._no_more_pads = False
+
+    @property
+    def duration(self):
+        """
+            @rtype: long
+            @return: The total duration of all inputs in nanoseconds
+        """
+        return sum(self.durations)
+
+    def _cb_comp_pad_added(self, comp, pad):
+        ghost = self._ghosts.get(comp.get_name())
+        if ghost:
+            _log.debug("Composition %s replaced its source pad" % comp.get_name())
+            ghost.set_target(pad)
+            return
+
+        ghost = gst.GhostPad(pad.get_name() + "_" + comp.get_name(), pad)
+        ghost.set_active(True)
+        self.add_pad(ghost)
+        self._ghosts[comp.get_name()] = ghost
+
+        if not self._no_more_pads and \
+           len(self._ghosts) == len(self._compositions):
+            self._no_more_pads = True
+            _log.debug(_("All concatenated streams are available"))
+            self.no_more_pads()
+
+    def _cb_comp_pad_removed(self, comp, pad):
+        ghost = self._ghosts.get(comp.get_name())
+        if ghost and ghost.get_target() == pad:
+            ghost.set_target(None)
+
+gobject.type_register(ConcatSource)
+
@@ -46,6 +46,44 @@ _log = logging.getLogger("arista.discoverer")
 
 _DISCOVERY_TIMEOUT = 30000 # Discovery timeout in miliseconds
 
+def get_stream_id(pad):
+    """
+        Find the demuxer source pad that a decoded stream comes from by
+        following the pads upstream through decoders and queues.
+
+        @type pad: gst.Pad
+        @param pad: A source pad of a decodebin or one of its elements
+        @rtype: str
+        @return: The name of the demuxer pad, e.g. "audio_01", or None if
+                 the stream doesn't come out of a demuxer
+    """
+    while pad is not None:
+        if isinstance(pad, gst.GhostPad):
+            pad = pad.get_target()
+            continue
+
+        element = pad.get_parent_element()
+        if not isinstance(element, gst.Element):
+            return None
+
+        factory = element.get_factory()
+        if factory and "Demux" in factory.get_klass():
+            return pad.get_name()
+
+        # Queues with several streams, like multiqueue, pair src%d with
+        # sink%d, other elements have a single sink pad
+        sinks = list(element.sink_pads())
+        name = pad.get_name().replace("src", "sink", 1)
+        paired = [sink for sink in sinks if sink.get_name() == name]
+        if paired:
+            pad = paired[0].get_peer()
+        elif len(sinks) == 1:
+            pad = sinks[0].get_peer()
+        else:
+            return None
+
+    return None
+
 class Discoverer(gst.Pipeline):
     """
     Discovers information about files.
@@ -82,6 +120,9 @@ class Discoverer(gst.Pipeline):
     is_video = False
     is_audio = False
 
+    audiolanguages = {}
+    videolanguages = {}
+
     otherstreams = []
 
     finished = False
@@ -123,6 +164,9 @@ class Discoverer(gst.Pipeline):
         self.is_video = False
         self.is_audio = False
 
+        self.audiolanguages = {}
+        self.videolanguages = {}
+
         self.otherstreams = []
 
         self.finished = False
@@ -416,11 +460,28 @@ class Discoverer(gst.Pipeline):
         gst.info("caps:%s" % caps.to_string())
         if "audio" in caps.to_string():
             self.is_audio = True
+            languages = self.audiolanguages
         elif "video" in caps.to_string():
             self.is_video = True
+            languages = self.videolanguages
         else:
             self.warning("got a different caps.. %s" % caps.to_string())
             return
+        # remember the language of each stream so that streams can later be
+        # selected by language as well as by index. Decoded pads don't come
+        # out in the demuxer's order, so streams are keyed by the name of
+        # the demuxer pad they come from, or by their index without one.
+        stream = get_stream_id(pad)
+        if stream is None:
+            stream = len(languages)
+        languages[stream] = None
+        def _tag_event_cb(pad, event):
+            if event.type == gst.EVENT_TAG:
+                taglist = event.parse_tag()
+                if "language-code" in taglist.keys():
+                    languages[stream] = taglist["language-code"]
+            return True
+        pad.add_event_probe(_tag_event_cb)
         #if is_last and not self.is_video and not self.is_audio:
         #    self.debug("is last, not video or audio")
         #    self._finished(False)
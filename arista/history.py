@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+    Arista Job History
+    ==================
+    A local database of how long past jobs took, used to estimate how long
+    new jobs will take before they start. Estimates drive the time remaining
+    display and shortest-job-first or deadline scheduling in the queue.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import gettext
+import logging
+import platform
+import sqlite3
+import time
+
+import gst
+
+import cache
+import utils
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.history")
+
+# Only the most recent jobs are used for estimates, so that they follow
+# changes to presets and hardware
+_RECENT = 50
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        created REAL,
+        host TEXT,
+        preset TEXT,
+        width INTEGER,
+        height INTEGER,
+        duration REAL,
+        passes INTEGER,
+        wall_time REAL
+    )
+"""
+
+_connection = None
+
+def _connect():
+    global _connection
+    if _connection is None:
+        path = utils.get_write_path("history.db")
+        _connection = sqlite3.connect(path)
+        _connection.execute(_SCHEMA)
+    return _connection
+
+def _cost(width, height, duration):
+    # Work is roughly proportional to the number of pixels decoded
+    return max(duration, 0.001) * max(width * height, 1) / 1000000.0
+
+def record(preset, width, height, duration, passes, wall_time):
+    """
+        Store the performance of a finished job.
+
+        @type preset: str
+        @param preset: The preset name
+        @type width: int
+        @param width: The input width (0 for audio)
+        @type height: int
+        @param height: The input height (0 for audio)
+        @type duration: float
+        @param duration: The transcoded duration in seconds
+        @type passes: int
+        @param passes: The number of encoding passes
+        @type wall_time: float
+        @param wall_time: How long the job took in seconds
+    """
+    if not duration or not wall_time:
+        return
+
+    try:
+        db = _connect()
+        db.execute("INSERT INTO jobs (created, host, preset, width, height, "
+                   "duration, passes, wall_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                   (time.time(), platform.node(), preset, width, height,
+                    duration, passes, wall_time))
+        db.commit()
+    except (sqlite3.Error, IOError), e:
+        _log.warning(_("Unable to record job history: %(error)s") % {
+            "error": str(e),
+        })
+
+def estimate(preset, width, height, duration, passes):
+    """
+        Estimate how long a job will take, from the median speed of recent
+        jobs with the same preset on this host, scaled by the number of
+        pixels to process and the number of passes.
+
+        @type preset: str
+        @param preset: The preset name
+        @type width: int
+        @param width: The input width (0 for audio)
+        @type height: int
+        @param height: The input height (0 for audio)
+        @type duration: float
+        @param duration: The duration to transcode in seconds
+        @type passes: int
+        @param passes: The number of encoding passes
+        @rtype: float
+        @return: The estimated wall time in seconds or None if there is no
+                 history for the preset
+    """
+    try:
+        rows = _connect().execute("SELECT width, height, duration, passes, "
+                                  "wall_time FROM jobs WHERE preset = ? AND "
+                                  "host = ? ORDER BY created DESC LIMIT ?",
+                                  (preset, platform.node(), _RECENT)).fetchall()
+    except (sqlite3.Error, IOError), e:
+        _log.warning(_("Unable to read job history: %(error)s") % {
+            "error": str(e),
+        })
+        return None
+
+    if not rows:
+        return None
+
+    # Seconds per pass per unit of work
+    rates = sorted([wall / (_cost(w, h, d) * max(p, 1)) \
+                    for (w, h, d, p, wall) in rows])
+    rate = rates[len(rates) // 2]
+    return rate * _cost(width, height, duration) * max(passes, 1)
+
+def estimate_options(options):
+    """
+        Estimate how long a job will take before it is started, using
+        cached discovery results of its input.
+
+        @type options: arista.transcoder.TranscoderOptions
+        @param options: The job options
+        @rtype: float
+        @return: The estimated wall time in seconds or None if unknown
+    """
+    if not options.preset:
+        return None
+
+    width = height = length = 0
+    for uri in options.uris:
+        info = cache.get_discovery(uri)
+        if not info:
+            return None
+        width = max(width, info.videowidth or 0)
+        height = max(height, info.videoheight or 0)
+        length += max(info.videolength, info.audiolength) / float(gst.SECOND)
+
+    # Ladders encode all renditions in a single pass
+    passes = options.ladder and 1 or options.pass_count
+    return estimate(options.preset.name, width, height,
+                    get_output_duration(options, length), passes)
+
+def get_output_duration(options, duration):
+    """
+        Get how much of the input will be transcoded, after applying the
+        start, stop and maximum duration options.
+
+        @type options: arista.transcoder.TranscoderOptions
+        @param options: The job options
+        @type duration: float
+        @param duration: The input duration in seconds
+        @rtype: float
+        @return: The output duration in seconds
+    """
+    # The same start/stop handling as Transcoder._do_seek
+    start, stop = options.start_time, options.stop_time
+    if not options.absolute:
+        start = duration * start / 100.0
+        if stop != -1:
+            stop = duration * stop / 100.0
+    if stop == -1 or stop > duration:
+        stop = duration
+    if options.max_duration:
+        stop = min(stop, start + options.max_duration)
+    return max(stop - start, 0)
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+"""
+    Arista Adaptive Streaming
+    =========================
+    Transcode an input once into every rendition of a preset's ladder for
+    adaptive bitrate streaming. The input is decoded and its audio encoded
+    a single time, the video is scaled and encoded per rendition with
+    keyframes forced at the same segment boundaries in all of them, and
+    each rendition is cut into MPEG-TS segments. HLS and DASH manifests
+    describing the segments are written once the transcode is complete.
+
+    The output is a local directory:
+
+        OUTPUT/master.m3u8          HLS master playlist
+        OUTPUT/manifest.mpd         DASH manifest
+        OUTPUT/NAME/index.m3u8      HLS media playlist of a rendition
+        OUTPUT/NAME/segment-N.ts    Segments of a rendition
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import copy
+import gettext
+import logging
+import math
+import os
+
+import gobject
+import gst
+
+from .transcoder import Transcoder, PipelineException, \
+                        _NO_APPLICATION_MSG_TIMEOUT
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.ladder")
+
+SEGMENT_NAME = "segment-%05d.ts"
+MASTER_PLAYLIST = "master.m3u8"
+MEDIA_PLAYLIST = "index.m3u8"
+DASH_MANIFEST = "manifest.mpd"
+
+# TranscoderOptions that the shared rendition pipeline doesn't apply
+UNSUPPORTED = ["crop", "auto_crop", "deinterlace", "ivtc", "scene_keyframes",
+               "probe_bitrate", "deadline"]
+
+def get_unsupported(options):
+    """
+        Get the options that are set but can't be used with a ladder.
+
+        @type options: arista.transcoder.TranscoderOptions
+        @param options: The job options
+        @rtype: list
+        @return: Names of TranscoderOptions attributes
+    """
+    return [name for name in UNSUPPORTED if getattr(options, name, None)]
+
+def get_renditions(ladder, width, height, par=None):
+    """
+        Get the output sizes of a ladder's renditions for an input. The
+        input is never scaled up, but the smallest rendition is always kept
+        so there is something to play.
+
+        @type ladder: arista.presets.Ladder
+        @param ladder: The ladder
+        @type width: int
+        @param width: The input width
+        @type height: int
+        @param height: The input height
+        @type par: gst.Fraction
+        @param par: The input pixel aspect ratio
+        @rtype: list
+        @return: (rendition, width, height) tuples
+    """
+    aspect = float(width) / height
+    if par:
+        aspect *= float(par.num) / par.denom
+
+    chosen = [rendition for rendition in ladder.renditions \
+              if rendition.height <= height]
+    if not chosen and ladder.renditions:
+        chosen = [min(ladder.renditions, key=lambda r: r.height)]
+
+    renditions = []
+    for rendition in sorted(chosen, key=lambda r: -r.height):
+        out_height = min(rendition.height, height) // 2 * 2
+        out_width = int(round(out_height * aspect / 2)) * 2
+        renditions.append((rendition, out_width, out_height))
+    return renditions
+
+def write_hls(directory, renditions, segments):
+    """
+        Write an HLS master playlist and a media playlist per rendition.
+
+        @type directory: str
+        @param directory: The output directory
+        @type renditions: list
+        @param renditions: (rendition, width, height) tuples
+        @type segments: dict
+        @param segments: Lists of (filename, duration, size) tuples by
+                         rendition name
+    """
+    master = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for rendition, width, height in renditions:
+        parts = segments[rendition.name]
+        if not parts:
+            continue
+
+        # BANDWIDTH is the peak bitrate of any segment
+        peak = max([size * 8 / max(duration, 0.001) \
+                    for (filename, duration, size) in parts])
+        average = sum([size for (filename, duration, size) in parts]) * 8 / \
+                  max(sum([duration for (filename, duration, size) in parts]), 0.001)
+        master.append("#EXT-X-STREAM-INF:BANDWIDTH=%d,AVERAGE-BANDWIDTH=%d," \
+                      "RESOLUTION=%dx%d" % (peak, average, width, height))
+        master.append("%s/%s" % (rendition.name, MEDIA_PLAYLIST))
+
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-TARGETDURATION:%d" % int(math.ceil(max(
+                [duration for (filename, duration, size) in parts]))),
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        for filename, duration, size in parts:
+            lines.append("#EXTINF:%.3f," % duration)
+            lines.append(filename)
+        lines.append("#EXT-X-ENDLIST")
+
+        open(os.path.join(directory, rendition.name, MEDIA_PLAYLIST), "w").write(
+            "\n".join(lines) + "\n")
+
+    open(os.path.join(directory, MASTER_PLAYLIST), "w").write(
+        "\n".join(master) + "\n")
+
+def write_dash(directory, renditions, segments, segment, duration):
+    """
+        Write a DASH manifest using the MPEG-2 TS simple profile, so that
+        the same segments serve both HLS and DASH players.
+
+        @type directory: str
+        @param directory: The output directory
+        @type renditions: list
+        @param renditions: (rendition, width, height) tuples
+        @type segments: dict
+        @param segments: Lists of (filename, duration, size) tuples by
+                         rendition name
+        @type segment: int
+        @param segment: The segment length in seconds
+        @type duration: float
+        @param duration: The total duration in seconds
+    """
+    lines = [
+        "<?xml version=\"1.0\" encoding=\"UTF-8\"?>",
+        "<MPD xmlns=\"urn:mpeg:dash:schema:mpd:2011\" type=\"static\" " \
+        "profiles=\"urn:mpeg:dash:profile:mp2t-simple:2011\" " \
+        "mediaPresentationDuration=\"PT%.3fS\" " \
+        "minBufferTime=\"PT%dS\">" % (duration, segment),
+        "  <Period start=\"PT0S\">",
+        "    <AdaptationSet mimeType=\"video/mp2t\" segmentAlignment=\"true\" " \
+        "bitstreamSwitching=\"true\">",
+    ]
+    for rendition, width, height in renditions:
+        parts = segments[rendition.name]
+        if not parts:
+            continue
+        peak = max([size * 8 / max(part_duration, 0.001) \
+                    for (filename, part_duration, size) in parts])
+        lines.append("      <Representation id=\"%s\" bandwidth=\"%d\" " \
+                     "width=\"%d\" height=\"%d\">" % \
+                     (rendition.name, peak, width, height))
+        lines.append("        <SegmentTemplate timescale=\"1\" " \
+                     "duration=\"%d\" startNumber=\"0\" " \
+                     "media=\"%s/segment-$Number%%05d$.ts\"/>" % \
+                     (segment, rendition.name))
+        lines.append("      </Representation>")
+    lines += [
+        "    </AdaptationSet>",
+        "  </Period>",
+        "</MPD>",
+    ]
+
+    open(os.path.join(directory, DASH_MANIFEST), "w").write(
+        "\n".join(lines) + "\n")
+
+class LadderTranscoder(Transcoder):
+    """
+        A transcoder that writes every rendition of the preset's ladder to
+        the output directory instead of a single file. All renditions are
+        encoded in a single pass.
+    """
+    def __init__(self, options):
+        """
+            @type options: arista.transcoder.TranscoderOptions
+            @param options: The options, where output_uri is the output
+                            directory and the preset has a ladder
+        """
+        if not options.preset.ladder or not options.preset.ladder.renditions:
+            raise PipelineException(_("The preset has no renditions!"))
+
+        unsupported = get_unsupported(options)
+        if unsupported:
+            raise PipelineException(_("Unsupported options for adaptive " \
+                                      "streaming: %(options)s") % {
+                "options": ", ".join(unsupported),
+            })
+
+        # Don't change the pass count of the caller's options
+        options = copy.copy(options)
+        options.pass_count = 1
+        self.renditions = []
+        self.segments = {}
+        Transcoder.__init__(self, options)
+        self.connect("pass-complete", self._cb_ladder_complete)
+
+    def _get_mux_name(self, index):
+        # The first muxer keeps the usual name so the watchdog finds it
+        return index and "mux_%d" % index or "mux"
+
+    def _setup_pass(self):
+        """
+            Set up the decode, scale, encode and segmenting pipeline of all
+            renditions.
+        """
+        ladder = self.preset.ladder
+        directory = self.options.output_uri
+        self.decode_hints = {}
+
+        par = None
+        for x in range(self.info.videocaps.get_size()):
+            struct = self.info.videocaps[x]
+            if struct.has_field("pixel-aspect-ratio"):
+                par = struct["pixel-aspect-ratio"]
+                break
+
+        if self.info.is_video:
+            self.renditions = get_renditions(ladder, self.info.videowidth,
+                                             self.info.videoheight, par)
+        else:
+            self.renditions = []
+
+        mux_str = ""
+        for index, (rendition, width, height) in enumerate(self.renditions):
+            path = os.path.join(directory, rendition.name)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            mux_str += " mpegtsmux name=%s ! multifilesink name=sink_%d " \
+                       "location=\"%s\" next-file=key-unit-event " % \
+                       (self._get_mux_name(index), index,
+                        os.path.join(path, SEGMENT_NAME))
+
+        if not mux_str:
+            raise PipelineException(_("Adaptive streaming needs video!"))
+
+        num, denom = self._setup_video_framerate()
+        self.output_rate = num / float(denom)
+        self.metadata["framerate"] = self.output_rate
+
+        settings = ladder.settings or self.options.passes[0]
+        video_str = "queue name=q_dec_venc_%%(pad)d ! ffmpegcolorspace ! " \
+                    "videorate ! video/x-raw-yuv,framerate=%d/%d ! " \
+                    "tee name=laddertee_%%(pad)d" % (num, denom)
+        for index, (rendition, width, height) in enumerate(self.renditions):
+            video_str += " laddertee_%%(pad)d. ! queue ! videoscale ! " \
+                         "video/x-raw-yuv,width=%d,height=%d," \
+                         "pixel-aspect-ratio=1/1 ! %s %s bitrate=%d " \
+                         "name=vencoder_%%(pad)d_%d ! " \
+                         "queue name=q_venc_mux_%%(pad)d_%d" % \
+                         (width, height, self.preset.vcodec.name,
+                          settings % {"random": self.random_num},
+                          rendition.bitrate, index, index)
+        _log.debug(video_str)
+
+        audio_str = ""
+        if self.info.is_audio and self.preset.acodec:
+            aencoder = self.preset.acodec.name + " " + \
+                       self.preset.acodec.passes[-1] % {
+                            "threads": self.cpu_count,
+                       }
+            audio_str = "queue name=q_dec_aenc_%%(pad)d ! audioconvert ! " \
+                        "audiorate tolerance=100000000 ! audioresample ! " \
+                        "%s ! tee name=audiotee_%%(pad)d" % aencoder
+            for index in range(len(self.renditions)):
+                audio_str += " audiotee_%%(pad)d. ! " \
+                             "queue name=q_aenc_mux_%%(pad)d_%d" % index
+            _log.debug(audio_str)
+
+        self._start_ns = 0
+        self.counter = 1
+        self.prerolled = False
+
+        self.video_str = video_str
+        self.audio_str = audio_str
+        self.mux_str = mux_str
+
+        self._timeoutid = gobject.timeout_add(_NO_APPLICATION_MSG_TIMEOUT,
+                                              self._cb_no_app_message_timeout)
+        self._build_pipeline(self._get_source())
+
+    def _link_renditions(self, prefix, pad_index):
+        for index in range(len(self.renditions)):
+            q = self.pipe.get_by_name("%s_%d_%d" % (prefix, pad_index, index))
+            muxer = self.pipe.get_by_name(self._get_mux_name(index))
+            link = q.link(muxer)
+            _log.debug("Result of linking %s to % s => %r" % (q, muxer, link))
+
+    def _handle_video_pad_added(self, elem, pad, video_pads):
+        # Only the first video stream is used
+        if video_pads:
+            return False
+
+        video_subpipe = gst.parse_launch(self.video_str % {"pad": video_pads})
+        video_subpipe.set_state(gst.STATE_PAUSED)
+        self.pipe.add(video_subpipe)
+
+        vq = self.pipe.get_by_name("q_dec_venc_%d" % video_pads)
+        link = pad.link(vq.get_pad("sink"))
+        _log.debug("Result of linking %s to % s => %r" % (pad, vq, link))
+
+        self._link_renditions("q_venc_mux", video_pads)
+        for index in range(len(self.renditions)):
+            encoder = self.pipe.get_by_name("vencoder_%d_%d" % (video_pads,
+                                                                 index))
+            self._setup_segment_keyframes(encoder)
+        return True
+
+    def _handle_audio_pad_added(self, elem, pad, audio_pads):
+        # Only the first audio stream is used
+        if audio_pads or not self.audio_str:
+            return False
+
+        audio_subpipe = gst.parse_launch(self.audio_str % {"pad": audio_pads})
+        audio_subpipe.set_state(gst.STATE_PAUSED)
+        self.pipe.add(audio_subpipe)
+
+        aq = self.pipe.get_by_name("q_dec_aenc_%d" % audio_pads)
+        link = pad.link(aq.get_pad("sink"))
+        _log.debug("Result of linking %s to % s => %r" % (pad, aq, link))
+
+        self._link_renditions("q_aenc_mux", audio_pads)
+        return True
+
+    def _setup_segment_keyframes(self, encoder):
+        """
+            Ask the encoder for a keyframe at every segment boundary. The
+            boundaries are the same in every rendition, so their segments
+            line up, and the event that comes out of the encoder with the
+            keyframe tells multifilesink to start a new segment.
+        """
+        length = self.preset.ladder.segment * gst.SECOND
+        boundary = [None]
+
+        def _buffer_probe(pad, buffer):
+            if boundary[0] is None:
+                boundary[0] = self._start_ns + length
+            if buffer.timestamp != gst.CLOCK_TIME_NONE and \
+               buffer.timestamp >= boundary[0]:
+                while buffer.timestamp >= boundary[0]:
+                    boundary[0] += length
+                struct = gst.Structure("GstForceKeyUnit")
+                struct["all-headers"] = True
+                pad.send_event(gst.event_new_custom(
+                    gst.EVENT_CUSTOM_DOWNSTREAM, struct))
+            return True
+
+        encoder.get_pad("sink").add_buffer_probe(_buffer_probe)
+
+    def _cb_ladder_complete(self, transcoder):
+        """
+            Write the manifests once all segments are written.
+        """
+        directory = self.options.output_uri
+        length = self.preset.ladder.segment
+        self.segments = {}
+        for rendition, width, height in self.renditions:
+            path = os.path.join(directory, rendition.name)
+            names = sorted([name for name in os.listdir(path) \
+                            if name.startswith("segment-") and \
+                               name.endswith(".ts")])
+            parts = []
+            for index, name in enumerate(names):
+                if index < len(names) - 1:
+                    duration = length
+                else:
+                    duration = max(self.output_duration - length * index, 0.001)
+                parts.append((name, duration,
+                              os.path.getsize(os.path.join(path, name))))
+            self.segments[rendition.name] = parts
+
+        try:
+            write_hls(directory, self.renditions, self.segments)
+            write_dash(directory, self.renditions, self.segments, length,
+                       self.output_duration)
+        except IOError, e:
+            # The segments are fine, only the manifests are missing
+            _log.error(_("Unable to write manifests: %(error)s") % {
+                "error": str(e),
+            })
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+"""
+    Arista Metrics
+    ==============
+    Export the state of a transcode queue and its running jobs in the
+    Prometheus text exposition format, either as a textfile for the node
+    exporter's textfile collector or on a local HTTP port.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import BaseHTTPServer
+import gettext
+import logging
+import os
+import threading
+import time
+
+import gobject
+import gst
+
+import cache
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.metrics")
+
+# How often metrics are collected, in milliseconds
+UPDATE_INTERVAL = 5000
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class MetricsCollector(object):
+    """
+        Collect metrics about a transcode queue. The metrics are gathered in
+        the main loop every UPDATE_INTERVAL milliseconds and written to a
+        textfile and/or served over HTTP from the last snapshot, so that
+        scrapes never touch the pipelines directly.
+    """
+    def __init__(self, queue, textfile=None, port=None, address="127.0.0.1"):
+        """
+            @type queue: arista.queue.TranscodeQueue
+            @param queue: The queue to watch
+            @type textfile: str
+            @param textfile: Path of a file to write metrics to
+            @type port: int
+            @param port: Local HTTP port to serve metrics on
+            @type address: str
+            @param address: Address to bind the HTTP server to
+        """
+        self.queue = queue
+        self.textfile = textfile
+        self.started = time.time()
+        self.completed = 0
+        self.errors = 0
+        self.passes = 0
+        self.text = ""
+        self._server = None
+        self._timeout = None
+
+        queue.connect("entry-complete", self._on_complete)
+        queue.connect("entry-error", self._on_error)
+        queue.connect("entry-pass-complete", self._on_pass_complete)
+
+        if port is not None:
+            self._start_server(address, port)
+
+        self.update()
+        self._timeout = gobject.timeout_add(UPDATE_INTERVAL, self.update)
+
+    def _on_complete(self, queue, entry):
+        self.completed += 1
+        self.update()
+
+    def _on_error(self, queue, entry, errorstr):
+        self.errors += 1
+        self.update()
+
+    def _on_pass_complete(self, queue, entry):
+        self.passes += 1
+
+    def _get_job_metrics(self, entry):
+        """
+            Get (name, labels, value) tuples for a running job.
+        """
+        transcoder = getattr(entry, "transcoder", None)
+        if not transcoder or not getattr(transcoder, "pipe", None):
+            return []
+
+        labels = {
+            "input": entry.options.uri,
+            "output": entry.options.output_uri,
+        }
+        metrics = [("arista_job_pass", labels, transcoder.enc_pass + 1)]
+
+        try:
+            size = os.path.getsize(entry.options.output_uri)
+        except (OSError, TypeError):
+            size = 0
+        metrics.append(("arista_job_bytes_written", labels, size))
+
+        start_time = getattr(transcoder, "start_time", None)
+        try:
+            pos = transcoder.pipe.query_position(gst.FORMAT_TIME)[0]
+        except (gst.QueryError, AttributeError):
+            pos = None
+
+        if start_time and pos is not None:
+            elapsed = time.time() - start_time
+            encoded = max(pos - getattr(transcoder, "_start_ns", 0), 0) / \
+                      float(gst.SECOND)
+            realtime = elapsed and encoded / elapsed or 0.0
+            metrics.append(("arista_job_realtime_factor", labels, realtime))
+            metrics.append(("arista_job_encoded_seconds", labels, encoded))
+            if transcoder.output_rate:
+                metrics.append(("arista_job_fps", labels,
+                                realtime * transcoder.output_rate))
+
+        return metrics
+
+    def collect(self):
+        """
+            Get the current metrics.
+
+            @rtype: list
+            @return: (name, type, help, [(labels, value), ...]) tuples
+        """
+        entries = [self.queue[pos] for pos in range(len(self.queue))]
+        running = [entry for entry in entries \
+                   if getattr(entry, "transcoder", None) and \
+                      getattr(entry.transcoder, "pipe", None)]
+        lookups = cache.stats["hits"] + cache.stats["misses"]
+
+        metrics = [
+            ("arista_queue_depth", "gauge", "Jobs waiting or running",
+             [({}, len(self.queue))]),
+            ("arista_jobs_running", "gauge", "Jobs being transcoded",
+             [({}, len(running))]),
+            ("arista_jobs_completed_total", "counter", "Jobs completed",
+             [({}, self.completed)]),
+            ("arista_job_errors_total", "counter", "Jobs that failed",
+             [({}, self.errors)]),
+            ("arista_passes_completed_total", "counter",
+             "Encoding passes completed", [({}, self.passes)]),
+            ("arista_cache_hits_total", "counter",
+             "Discovery and analysis results read from the cache",
+             [({}, cache.stats["hits"])]),
+            ("arista_cache_misses_total", "counter",
+             "Discovery and analysis results not found in the cache",
+             [({}, cache.stats["misses"])]),
+            ("arista_cache_hit_ratio", "gauge",
+             "Fraction of cache lookups that were hits",
+             [({}, lookups and cache.stats["hits"] / float(lookups) or 0.0)]),
+            ("arista_uptime_seconds", "gauge", "Seconds since start",
+             [({}, time.time() - self.started)]),
+        ]
+
+        helps = {
+            "arista_job_pass": ("gauge", "Current encoding pass"),
+            "arista_job_bytes_written": ("gauge", "Bytes written to the output"),
+            "arista_job_realtime_factor": ("gauge",
+                "Seconds of media encoded per wall clock second"),
+            "arista_job_encoded_seconds": ("gauge", "Seconds of media encoded"),
+            "arista_job_fps": ("gauge", "Frames encoded per second"),
+        }
+        jobs = {}
+        for entry in running:
+            for name, labels, value in self._get_job_metrics(entry):
+                jobs.setdefault(name, []).append((labels, value))
+        for name in sorted(jobs):
+            metrics.append((name, helps[name][0], helps[name][1], jobs[name]))
+
+        return metrics
+
+    def render(self):
+        """
+            Render the current metrics in the Prometheus text format.
+
+            @rtype: str
+            @return: The metrics
+        """
+        lines = []
+        for name, kind, help, samples in self.collect():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                if labels:
+                    label_str = ",".join(["%s=\"%s\"" % (key, _escape(labels[key])) \
+                                          for key in sorted(labels)])
+                    lines.append("%s{%s} %s" % (name, label_str, repr(float(value))))
+                else:
+                    lines.append("%s %s" % (name, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def update(self):
+        """
+            Collect the metrics and write them out. Called periodically from
+            the main loop.
+        """
+        try:
+            self.text = self.render()
+        except Exception, e:
+            _log.warning(_("Unable to collect metrics: %(error)s") % {
+                "error": str(e),
+            })
+            return True
+
+        if self.textfile:
+            # Write to a temporary file first so readers never see a
+            # partial file
+            tmp = self.textfile + ".tmp"
+            try:
+                open(tmp, "w").write(self.text)
+                os.rename(tmp, self.textfile)
+            except (IOError, OSError), e:
+                _log.warning(_("Unable to write metrics to %(filename)s: %(error)s") % {
+                    "filename": self.textfile,
+                    "error": str(e),
+                })
+
+        return True
+
+    def _start_server(self, address, port):
+        collector = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+                data = collector.text
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                _log.debug(format % args)
+
+        self._server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        _log.debug(_("Serving metrics on %(address)s:%(port)d") % {
+            "address": address,
+            "port": port,
+        })
+
+    def stop(self):
+        """
+            Write the final metrics, stop updating them and stop the HTTP
+            server.
+        """
+        if self._timeout:
+            gobject.source_remove(self._timeout)
+            self._timeout = None
+        self.update()
+        if self._server:
+            self._server.shutdown()
+            self._server = None
@@ -250,6 +250,17 @@ class Device(object):
                     "transform": preset.vcodec.transform,
                 },
             })
+            
+            if preset.ladder:
+                data["presets"][-1]["ladder"] = {
+                    "segment": preset.ladder.segment,
+                    "settings": preset.ladder.settings,
+                    "renditions": [{
+                        "name": rendition.name,
+                        "height": rendition.height,
+                        "bitrate": rendition.bitrate,
+                    } for rendition in preset.ladder.renditions],
+                }
         
         return json.dumps(data, indent=4)
     
@@ -302,6 +313,17 @@ class Device(object):
         for preset in parsed.get("presets", []):
             acodec = preset.get("acodec", {})
             vcodec = preset.get("vcodec", {})
+            ladder = preset.get("ladder", None)
+            if ladder is not None:
+                ladder = Ladder(**{
+                    "segment": int(ladder.get("segment", 4)),
+                    "settings": ladder.get("settings", ""),
+                    "renditions": [Rendition(**{
+                        "name": rendition.get("name", ""),
+                        "height": int(rendition.get("height", 0)),
+                        "bitrate": int(rendition.get("bitrate", 0)),
+                    }) for rendition in ladder.get("renditions", [])],
+                })
             device.presets[preset.get("name", "")] = Preset(**{
                 "name": preset.get("name", ""),
                 "description": preset.get("description", device.description),
@@ -331,6 +353,7 @@ class Device(object):
                     "height": vcodec.get("height", []),
                     "transform": vcodec.get("transform", ""),
                 }),
+                "ladder": ladder,
                 "device": device,
             })
 
@@ -343,7 +366,8 @@ class Preset(object):
     """
     def __init__(self, name = "", container = "", extension = "", 
                  acodec = None, vcodec = None, device = None, icon = None,
-                 version = None, description = None, author = None):
+                 version = None, description = None, author = None,
+                 ladder = None):
         """
             @type name: str
             @param name: The name of the preset, e.g. "High Quality"
@@ -357,6 +381,8 @@ class Preset(object):
             @param vcodec: The video encoding settings
             @type device: Device
             @param device: A link back to the device this preset belongs to
+            @type ladder: Ladder
+            @param ladder: Renditions for adaptive streaming output, if any
         """
         self.name = name
         self.description = description
@@ -365,6 +391,7 @@ class Preset(object):
         self.extension = extension
         self.acodec = acodec
         self.vcodec = vcodec
+        self.ladder = ladder
         self.device = device
         self.version = version
         self.icon = icon
@@ -421,6 +448,9 @@ class Preset(object):
             "queue",
         ]
         
+        if self.ladder:
+            elements += ["mpegtsmux", "multifilesink"]
+        
         missing = []
         missingdesc = ""
         for element in elements:
@@ -499,6 +529,50 @@ class VideoCodec(Codec):
         self.height = height and height or (2, 1080)
         self.transform = transform
 
+class Rendition(object):
+    """
+        A single video quality in an adaptive streaming ladder.
+    """
+    def __init__(self, name=None, height=None, bitrate=None):
+        """
+            @type name: str
+            @param name: The name of the rendition, also used as the name of
+                         its directory, e.g. 720p
+            @type height: int
+            @param height: The output height, the width follows from the
+                           input aspect ratio
+            @type bitrate: int
+            @param bitrate: The video bitrate in kbps
+        """
+        self.name = name and name or ""
+        self.height = height and height or 0
+        self.bitrate = bitrate and bitrate or 0
+    
+    def __repr__(self):
+        return "%s %dp %dkbps" % (self.name, self.height, self.bitrate)
+
+class Ladder(object):
+    """
+        Settings for adaptive bitrate streaming output, where the input is
+        decoded once and encoded to several renditions with aligned
+        keyframes, cut into segments.
+    """
+    def __init__(self, segment=None, settings=None, renditions=None):
+        """
+            @type segment: int
+            @param segment: The segment length in seconds
+            @type settings: str
+            @param settings: Video encoder settings used for every rendition
+                             instead of the first video pass, e.g. to use a
+                             bitrate based rate control mode
+            @type renditions: list
+            @param renditions: The Rendition objects, from high to low
+                               quality
+        """
+        self.segment = segment and segment or 4
+        self.settings = settings and settings or ""
+        self.renditions = renditions and renditions or []
+
 def load(filename):
     """
         Load a filename into a new Device.
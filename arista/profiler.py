@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+"""
+    Arista Pipeline Profiler
+    ========================
+    Measure how buffers flow through the named queues of a transcode
+    pipeline, to find out which stage of a slow job is the bottleneck.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import gettext
+import logging
+import time
+
+import gobject
+import gst
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.profiler")
+
+# Queues created by Transcoder._setup_pass, followed by the stream index
+QUEUE_PREFIXES = ["q_dec_venc_", "q_venc_mux_", "q_dec_aenc_", "q_aenc_mux_"]
+
+# Stages between two queues as (name, queue before, queue after)
+STAGES = [
+    (_("video convert/scale/encode"), "q_dec_venc_", "q_venc_mux_"),
+    (_("audio convert/resample/encode"), "q_dec_aenc_", "q_aenc_mux_"),
+]
+
+# How often queue fill levels are sampled, in milliseconds
+SAMPLE_INTERVAL = 100
+
+# Average queue fill above which the stage after a queue can't keep up,
+# and below which the stage before it can't keep up
+SATURATED = 0.8
+STARVED = 0.1
+
+class QueueStats(object):
+    """
+        Buffer counts, rates and fill levels of a single queue.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        self.name = queue.get_name()
+        self.buffers_in = 0
+        self.buffers_out = 0
+        self.bytes_in = 0
+        self.first = None
+        self.last = None
+        self.fill_samples = []
+
+    @property
+    def elapsed(self):
+        """
+            @rtype: float
+            @return: Seconds between the first and last buffer
+        """
+        if self.first is None:
+            return 0.0
+        return self.last - self.first
+
+    @property
+    def rate(self):
+        """
+            @rtype: float
+            @return: Buffers per second leaving the queue
+        """
+        return self.elapsed and self.buffers_out / self.elapsed or 0.0
+
+    @property
+    def fill(self):
+        """
+            @rtype: float
+            @return: The average fill level between 0.0 and 1.0
+        """
+        if not self.fill_samples:
+            return 0.0
+        return sum(self.fill_samples) / len(self.fill_samples)
+
+    def sample(self):
+        """
+            Record how full the queue is right now, relative to whichever
+            of its limits is closest to being reached.
+        """
+        levels = []
+        for prop in ["buffers", "bytes", "time"]:
+            limit = self.queue.get_property("max-size-" + prop)
+            if limit:
+                current = self.queue.get_property("current-level-" + prop)
+                levels.append(min(current / float(limit), 1.0))
+        if levels:
+            self.fill_samples.append(max(levels))
+
+    def _sink_probe(self, pad, buffer):
+        now = time.time()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.buffers_in += 1
+        self.bytes_in += buffer.size
+        return True
+
+    def _src_probe(self, pad, buffer):
+        self.last = time.time()
+        self.buffers_out += 1
+        return True
+
+class StageStats(object):
+    """
+        Processing latency of the elements between two queues. Elements
+        like videorate, audio encoders that rechunk samples and encoders
+        that reorder frames don't put out one buffer per input buffer with
+        the same timestamp. Instead of matching buffers, the stream position
+        of every buffer entering the stage is kept in arrival order. When
+        the output reaches a position, the latency is measured from the
+        arrival of the last input buffer at or before it.
+    """
+    def __init__(self, name, before, after):
+        self.name = name
+        self.before = before
+        self.after = after
+        self.latencies = []
+        self._pending = collections.deque()
+        self._position = None
+
+    @property
+    def latency(self):
+        """
+            @rtype: float
+            @return: The average latency in seconds
+        """
+        if not self.latencies:
+            return 0.0
+        return sum(self.latencies) / len(self.latencies)
+
+    @property
+    def max_latency(self):
+        """
+            @rtype: float
+            @return: The highest latency in seconds
+        """
+        return self.latencies and max(self.latencies) or 0.0
+
+    def _enter_probe(self, pad, buffer):
+        if buffer.timestamp != gst.CLOCK_TIME_NONE:
+            self._pending.append((buffer.timestamp, time.time()))
+        return True
+
+    def _leave_probe(self, pad, buffer):
+        # Reordered frames can come out behind the position already reached
+        if buffer.timestamp == gst.CLOCK_TIME_NONE or \
+           (self._position is not None and buffer.timestamp <= self._position):
+            return True
+        self._position = buffer.timestamp
+        
+        start = None
+        while self._pending and self._pending[0][0] <= self._position:
+            start = self._pending.popleft()[1]
+        if start is not None:
+            self.latencies.append(time.time() - start)
+        return True
+
+class PipelineProfiler(object):
+    """
+        Attach pad probes to the named queues of a pipeline and sample
+        their fill levels while it runs. Create it once the pipeline is
+        fully linked, call start() when it starts playing and stop() when
+        it is done, then get the results with report() or summary().
+    """
+    def __init__(self, pipe):
+        """
+            @type pipe: gst.Pipeline
+            @param pipe: The transcode pipeline
+        """
+        self.pipe = pipe
+        self.queues = {}
+        self.stages = []
+        self.started = None
+        self.stopped = None
+        self._timeout = None
+
+        for element in pipe.recurse():
+            name = element.get_name()
+            for prefix in QUEUE_PREFIXES:
+                if name.startswith(prefix):
+                    stats = QueueStats(element)
+                    element.get_pad("sink").add_buffer_probe(stats._sink_probe)
+                    element.get_pad("src").add_buffer_probe(stats._src_probe)
+                    self.queues[name] = stats
+
+        for name, before, after in STAGES:
+            for queue in sorted(self.queues):
+                if not queue.startswith(before):
+                    continue
+                index = queue[len(before):]
+                if before + index not in self.queues or \
+                   after + index not in self.queues:
+                    continue
+                stage = StageStats("%s %s" % (name, index), before + index,
+                                   after + index)
+                self.queues[before + index].queue.get_pad("src").add_buffer_probe(stage._enter_probe)
+                self.queues[after + index].queue.get_pad("sink").add_buffer_probe(stage._leave_probe)
+                self.stages.append(stage)
+
+    def start(self):
+        """
+            Start sampling queue fill levels.
+        """
+        self.started = time.time()
+        self._timeout = gobject.timeout_add(SAMPLE_INTERVAL, self._sample)
+
+    def stop(self):
+        """
+            Stop sampling queue fill levels.
+        """
+        self.stopped = time.time()
+        if self._timeout:
+            gobject.source_remove(self._timeout)
+            self._timeout = None
+
+    def _sample(self):
+        for stats in self.queues.values():
+            stats.sample()
+        return True
+
+    def report(self):
+        """
+            Get the results.
+
+            @rtype: dict
+            @return: Per queue and per stage results that can be serialized
+                     as JSON
+        """
+        report = {
+            "elapsed": (self.stopped or time.time()) - (self.started or time.time()),
+            "queues": {},
+            "stages": {},
+            "bottlenecks": self.get_bottlenecks(),
+        }
+
+        for name, stats in self.queues.items():
+            report["queues"][name] = {
+                "buffers_in": stats.buffers_in,
+                "buffers_out": stats.buffers_out,
+                "bytes_in": stats.bytes_in,
+                "rate": stats.rate,
+                "fill": stats.fill,
+            }
+
+        for stage in self.stages:
+            report["stages"][stage.name] = {
+                "latency": stage.latency,
+                "max_latency": stage.max_latency,
+                "samples": len(stage.latencies),
+            }
+
+        return report
+
+    def get_bottlenecks(self):
+        """
+            Find stages that were starved or saturated. A queue that is
+            mostly full means the stage reading from it couldn't keep up,
+            one that is mostly empty means the stage feeding it couldn't.
+
+            @rtype: list
+            @return: (queue name, "saturated" or "starved") tuples
+        """
+        found = []
+        for name in sorted(self.queues):
+            stats = self.queues[name]
+            if not stats.fill_samples:
+                continue
+            if stats.fill >= SATURATED:
+                found.append((name, "saturated"))
+            elif stats.fill <= STARVED:
+                found.append((name, "starved"))
+        return found
+
+    def summary(self):
+        """
+            Get a human readable summary of the results.
+
+            @rtype: str
+            @return: One line per queue and stage
+        """
+        lines = []
+        for name in sorted(self.queues):
+            stats = self.queues[name]
+            lines.append(_("%(name)s: %(rate).1f buffers/sec, %(fill)d%% full") % {
+                "name": name,
+                "rate": stats.rate,
+                "fill": stats.fill * 100,
+            })
+
+        for stage in self.stages:
+            lines.append(_("%(name)s: %(latency).1f ms average, %(max).1f ms max latency") % {
+                "name": stage.name,
+                "latency": stage.latency * 1000,
+                "max": stage.max_latency * 1000,
+            })
+
+        for name, state in self.get_bottlenecks():
+            if state == "saturated":
+                lines.append(_("%(name)s is saturated: the stage after it is a bottleneck") % {
+                    "name": name,
+                })
+            else:
+                lines.append(_("%(name)s is starved: the stage before it is a bottleneck") % {
+                    "name": name,
+                })
+
+        return "\n".join(lines)
@@ -35,24 +35,44 @@ import time
 import gobject
 import gst
 
+from . import accounting
+from . import history
+from .ladder import LadderTranscoder, get_unsupported
+from . import tracing
 from .transcoder import Transcoder
 
 _ = gettext.gettext
 _log = logging.getLogger("arista.queue")
 
+# Ways to pick the next entry: first in first out, shortest estimated job
+# first, or earliest deadline first
+SCHEDULERS = ["fifo", "sjf", "deadline"]
+
 class QueueEntry(object):
     """
         An entry in the queue.
     """
-    def __init__(self, options):
+    def __init__(self, options, deadline = None):
         """
             @type options: arista.transcoder.TranscoderOptions
             @param options: The input options (uri, subs) to process
+            @type deadline: float
+            @param deadline: When the entry should be finished, in seconds
+                             since the epoch, used by deadline scheduling
         """
         self.options = options
+        self.queued = tracing.now()
+        self.deadline = deadline
+        
+        # Expected wall time from past jobs or None if unknown
+        self.estimate = history.estimate_options(options)
         
         # Set when QueueEntry.stop() was called so you can react accordingly
         self.force_stopped = False
+        
+        # Set once entry-start was emitted, restarted passes don't start
+        # the entry again
+        self.started = False
     
     def __repr__(self):
         return _("Queue entry %(infile)s -> %(preset)s -> %(outfile)s" % {
@@ -99,16 +119,28 @@ class TranscodeQueue(gobject.GObject):
                           (gobject.TYPE_PYOBJECT,)),   # QueueEntry
     }
     
-    def __init__(self, check_interval = 500):
+    def __init__(self, check_interval = 500, report_dir = None,
+                 policy = "fifo"):
         """
             Create a new queue, setup locks, and register a callback.
             
             @type check_interval: int
             @param check_interval: The interval in milliseconds between
                                    checking for new queue items
+            @type report_dir: str
+            @param report_dir: A directory to write a JSON resource report
+                               to for every finished entry
+            @type policy: str
+            @param policy: How to pick the next entry, one of SCHEDULERS
         """
+        if policy not in SCHEDULERS:
+            raise ValueError("Unknown scheduling policy %s" % policy)
+        
         self.__gobject_init__()
         self._queue = []
+        self.report_dir = report_dir
+        self.policy = policy
+        self.summary = accounting.AccountSummary()
         self.running = True
         self.pipe_running = False
         self.enc_pass = 0
@@ -154,15 +186,24 @@ class TranscodeQueue(gobject.GObject):
         """
         self._queue.insert(pos, entry)
     
-    def append(self, options):
+    def append(self, options, deadline = None):
         """
             Append a QueueEntry to the queue.
+            
+            @type deadline: float
+            @param deadline: When the entry should be finished, in seconds
+                             since the epoch
         """
         # Sanity check of input options
         if not options.uri or not options.preset or not options.output_uri:
             raise ValueError("Invalid input options %s" % str(options))
+        if options.ladder and not options.preset.ladder:
+            raise ValueError("Preset %s has no ladder" % options.preset.name)
+        if options.ladder and get_unsupported(options):
+            raise ValueError("Options %s can't be used with a ladder" % \
+                             ", ".join(get_unsupported(options)))
         
-        self._queue.append(QueueEntry(options))
+        self._queue.append(QueueEntry(options, deadline))
         self.emit("entry-added", self._queue[-1])
     
     def remove(self, entry):
@@ -171,6 +212,33 @@ class TranscodeQueue(gobject.GObject):
         """
         self._queue.remove(entry)
     
+    def _schedule(self):
+        """
+            Move the entry that should run next to the front of the queue,
+            according to the scheduling policy. Entries without an estimate
+            are treated as the longest and entries without a deadline as
+            the least urgent, so they keep their order at the end.
+        """
+        if self.policy == "fifo" or len(self._queue) < 2:
+            return
+        
+        def estimate(entry):
+            if entry.estimate is None:
+                return float("inf")
+            return entry.estimate
+        
+        if self.policy == "sjf":
+            key = lambda entry: estimate(entry)
+        else:
+            key = lambda entry: (entry.deadline is None and float("inf") or \
+                                 entry.deadline, estimate(entry))
+        
+        # min() returns the first of equal entries, keeping FIFO order
+        entry = min(self._queue, key=key)
+        if entry is not self._queue[0]:
+            self._queue.remove(entry)
+            self._queue.insert(0, entry)
+    
     def _check_queue(self):
         """
             This method is invoked periodically by the gobject mainloop.
@@ -181,30 +249,46 @@ class TranscodeQueue(gobject.GObject):
         """
         item = None
         if len(self._queue) and not self.pipe_running:
+            self._schedule()
             item = self._queue[0]
         if item:
             _log.debug(_("Found item in queue! Queue is %(queue)s" % {
                 "queue": str(self)
             }))
-            item.transcoder =  Transcoder(item.options)
+            item.account = accounting.JobAccount()
+            item.account.start()
+            if item.options.ladder:
+                item.transcoder = LadderTranscoder(item.options)
+            else:
+                item.transcoder =  Transcoder(item.options)
+            tracing.complete("queue wait", item.transcoder.trace_track,
+                             item.queued, category="queue")
             item.transcoder.connect("complete", self._on_complete)
             
             def discovered(transcoder, info, is_media):
                 self.emit("entry-discovered", item, info, is_media)
                 if not is_media:
+                    self._account(item, False)
                     self.emit("entry-error", item, _("Not a recognized media file!"))
                     self._queue.pop(0)
                     self.pipe_running = False
            
             def pass_complete(transcoder):
+                item.account.pass_completed()
                 self.emit("entry-pass-complete", item)
  
             def pass_setup(transcoder):
+                item.account.pass_started()
                 self.emit("entry-pass-setup", item)
-                if transcoder.enc_pass == 0:
+                if not item.started:
+                    item.started = True
                     self.emit("entry-start", item)
             
+            def pass_abandoned(transcoder, reason):
+                item.account.pass_abandoned(transcoder.enc_pass, reason)
+            
             def error(transcoder, errorstr, errnum=0):
+                self._account(item, False)
                 self.emit("entry-error", item, errorstr)
                 self._queue.pop(0)
                 self.pipe_running = False
@@ -212,14 +296,33 @@ class TranscodeQueue(gobject.GObject):
             item.transcoder.connect("discovered", discovered)
             item.transcoder.connect("pass-setup", pass_setup)
             item.transcoder.connect("pass-complete", pass_complete)
+            item.transcoder.connect("pass-abandoned", pass_abandoned)
             item.transcoder.connect("error", error)
             self.pipe_running = True
         return True
     
+    def _account(self, entry, success):
+        """
+            Record the resources a finished entry used, add them to the
+            queue summary and write the entry's report.
+        """
+        entry.report = entry.account.finish(entry, success)
+        self.summary.add(entry.report)
+        if success:
+            history.record(entry.report["preset"],
+                           entry.report.get("input_width", 0),
+                           entry.report.get("input_height", 0),
+                           entry.report.get("duration", 0),
+                           entry.transcoder.options.pass_count,
+                           entry.report["wall_time"])
+        if self.report_dir:
+            accounting.write_record(self.report_dir, entry.report)
+    
     def _on_complete(self, transcoder):
         """
             An entry is complete!
         """
+        self._account(self._queue[0], True)
         self.emit("entry-complete", self._queue[0])
         self._queue.pop(0)
         self.pipe_running = False
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+    Arista Encoder Speed
+    ====================
+    Per encoder ladders of speed settings, from fastest to slowest, and
+    choosing the slowest (best quality) setting that still finishes a job
+    before its deadline given the speed measured so far.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import gettext
+import logging
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.speed")
+
+# Encoder settings from fastest to slowest as (relative cost, properties).
+# The properties are added after the preset's own pass settings so they
+# override them. Costs are rough encoding times relative to the fastest
+# setting.
+LADDERS = {
+    "x264enc": [
+        (1.0, "speed-preset=ultrafast subme=1 me=dia"),
+        (1.8, "speed-preset=veryfast subme=2 me=hex"),
+        (3.0, "speed-preset=faster subme=4 me=hex"),
+        (4.5, "speed-preset=fast subme=6 me=hex"),
+        (6.0, "speed-preset=medium subme=7 me=hex"),
+        (10.0, "speed-preset=slower subme=9 me=umh"),
+    ],
+    "vp8enc": [
+        (1.0, "speed=2"),
+        (2.0, "speed=1"),
+        (4.0, "speed=0"),
+    ],
+    "theoraenc": [
+        (1.0, "speed-level=2"),
+        (1.5, "speed-level=1"),
+        (2.5, "speed-level=0"),
+    ],
+}
+
+# Only plan to use this much of the time left, to allow for the audio,
+# muxing and measurement errors
+MARGIN = 0.85
+
+def get_ladder(encoder):
+    """
+        Get the speed ladder of an encoder.
+
+        @type encoder: str
+        @param encoder: The encoder element name, e.g. x264enc
+        @rtype: list
+        @return: (relative cost, properties) tuples or None if the encoder
+                 has no ladder
+    """
+    return LADDERS.get(encoder)
+
+def get_start(ladder):
+    """
+        Get the setting to start measuring with.
+
+        @type ladder: list
+        @param ladder: A ladder from get_ladder
+        @rtype: int
+        @return: The index of a setting in the middle of the ladder
+    """
+    return len(ladder) // 2
+
+def choose(ladder, current, realtime, remaining, restart, budget):
+    """
+        Choose the slowest setting that finishes in time. Keeping the
+        current setting only needs the media that is left, changing it
+        means starting the current pass over.
+
+        @type ladder: list
+        @param ladder: A ladder from get_ladder
+        @type current: int
+        @param current: The index of the setting that was measured
+        @type realtime: float
+        @param realtime: Seconds of media encoded per second with the
+                         current setting
+        @type remaining: float
+        @param remaining: Seconds of media left to encode with the current
+                          setting, over all passes
+        @type restart: float
+        @param restart: Seconds of media to encode over all passes when
+                        the current pass starts over
+        @type budget: float
+        @param budget: Seconds until the deadline
+        @rtype: int
+        @return: The index of the chosen setting
+    """
+    budget *= MARGIN
+    cost = ladder[current][0]
+    for index in range(len(ladder) - 1, -1, -1):
+        speed = realtime * cost / ladder[index][0]
+        if index == current:
+            needed = remaining / realtime
+        else:
+            needed = restart / speed
+        if needed <= budget:
+            return index
+
+    _log.warning(_("Can't finish before the deadline even with the " \
+                   "fastest encoder settings"))
+    return 0
@@ -1,18 +1,77 @@
 
+import cPickle
 import os
+import select
+import subprocess
 import sys
+import time
 import gst
 import thread
 import gtk
 import gtk.gdk
 from discoverer import Discoverer
+import analysis
+import cache
+import utils
 import logging
 _log = logging.getLogger("arista.transcoder")
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Rough cost of one accurate seek, in seconds of decoded video. An accurate
+# seek redecodes from the previous keyframe, so once thumbnails are closer
+# together than this a single forward pass through the file is cheaper.
+_SEEK_COST = 10
+
+# Elements used to encode each thumbnail format inside the pipeline
+_ENCODERS = {
+    "jpeg": "jpegenc",
+    "jpg": "jpegenc",
+    "png": "pngenc",
+}
+
+def get_encoder(format):
+    """
+        Get the element that encodes thumbnails in a format, jpegenc for
+        unknown formats.
+    """
+    if format not in _ENCODERS:
+        _log.debug("Unknown thumbnail format %s, using jpeg" % format)
+        format = "jpeg"
+    return _ENCODERS[format]
+
+class _FrameEncoder(object):
+    # Encodes raw frames that were pulled from an appsink one at a time,
+    # for frames that can only be picked after they have been looked at.
+    # Buffers are pushed as they are so nothing is copied in Python.
+    def __init__(self, encoder):
+        self.pipeline = gst.parse_launch("appsrc name=src ! ffmpegcolorspace ! %s ! "
+                                         "appsink name=sink sync=false" % encoder)
+        self.src = self.pipeline.get_by_name("src")
+        self.sink = self.pipeline.get_by_name("sink")
+        self.started = False
+
+    def encode(self, buffer):
+        if not self.started:
+            self.src.set_property("caps", buffer.get_caps())
+            self.pipeline.set_state(gst.STATE_PLAYING)
+            self.started = True
+        self.src.emit("push-buffer", buffer)
+        return self.sink.emit("pull-buffer")
+
+    def close(self):
+        self.pipeline.set_state(gst.STATE_NULL)
+
 class Thumbnailer(object):
+    # Subclasses that need the decoded frames themselves set this
+    raw_frames = False
     
     def __init__(self, filepath, output_dir, fileinfo=None, interval=None, number=5,\
-                 width=120, height=90, preserve_aspect_ratio=True, prefix="thumbnail", format='jpeg'):
+                 width=120, height=90, preserve_aspect_ratio=True, prefix="thumbnail", format='jpeg',
+                 strategy="auto", best_frame=False, candidates=8, window=2):
         self.filepath = filepath
         self.output_dir = output_dir
         self.width = width
@@ -23,8 +82,22 @@ class Thumbnailer(object):
         #TODO: Need to use proper pixel-aspect-ratio
         self.par = preserve_aspect_ratio
         self.prefix = prefix
+        if format not in _ENCODERS:
+            _log.debug("Unknown thumbnail format %s, using jpeg" % format)
+            format = "jpeg"
         self.format = format
         self.fileinfo = fileinfo
+        # Number of thumbnails, bytes written and seconds taken by the
+        # last call to create_thumbnails
+        self.stats = {"thumbnails": 0, "bytes": 0, "elapsed": 0.0}
+        self._encoder = None
+        # One of "seek", "linear" or "auto"
+        self.strategy = strategy
+        # Pick the best of several candidate frames spread over window
+        # seconds after each offset instead of the first frame
+        self.best_frame = best_frame
+        self.candidates = candidates
+        self.window = window
 
     def on_new_preroll_cb(self, appsink):
         buffer = appsink.emit('pull-preroll')
@@ -46,39 +119,489 @@ class Thumbnailer(object):
             _log.debug("Skipping thumbnail creation. No video stream found for file: %s." % self.filepath)
             return False
  
-        offset = counter = 0 
+        if self.interval is None:
+            self.interval = ((self.fileinfo.videolength/gst.SECOND) / self.count) or 1
+
+        offsets = []
+        offset = 0
+        while ((offset < self.fileinfo.videolength/gst.SECOND) and (len(offsets) < self.count)):
+            offsets.append(offset)
+            offset += self.interval
+
+        strategy = self._get_strategy(len(offsets))
+        _log.debug("Creating %d thumbnails using %s strategy" % (len(offsets), strategy))
+        self.stats = {"thumbnails": 0, "bytes": 0, "elapsed": 0.0}
+        start = time.time()
+        try:
+            if strategy == "linear":
+                self._create_linear(offsets)
+            else:
+                self._create_seeking(offsets)
+        finally:
+            if self._encoder:
+                self._encoder.close()
+                self._encoder = None
+        self.stats["elapsed"] = time.time() - start
+        return True
+
+    def _get_sink_str(self):
         caps = "video/x-raw-rgb,format=RGB,width=%s,height=%s,pixel-aspect-ratio=1/1" % (self.width, self.height)
+        if self.raw_frames or self.best_frame:
+            return "appsink name=sink caps=%s sync=false" % caps
+        # Frames are encoded before they reach Python
+        return "%s ! %s ! appsink name=sink sync=false" % (caps, _ENCODERS[self.format])
+
+    def _get_strategy(self, count):
+        if self.best_frame:
+            if analysis.available():
+                # Candidates are only cheap to collect in a forward pass
+                return "linear"
+            _log.warning("Best frame selection needs numpy, using the first "
+                         "frame at each offset for %s" % self.filepath)
+            self.best_frame = False
+
+        if self.strategy != "auto":
+            return self.strategy
+
+        if count * _SEEK_COST >= self.fileinfo.videolength / gst.SECOND:
+            return "linear"
+        return "seek"
+
+    def _create_seeking(self, offsets):
         cmd = "uridecodebin uri=file://%s  ! ffmpegcolorspace ! videorate ! videoscale ! " \
-                "ffmpegcolorspace ! appsink name=sink caps=%s" % \
-                (os.path.abspath(self.filepath), caps)
+                "ffmpegcolorspace ! %s" % \
+                (os.path.abspath(self.filepath), self._get_sink_str())
 
         pipeline = gst.parse_launch(cmd)
         appsink = pipeline.get_by_name("sink")
         appsink.set_property('emit-signals', True)
-        #Set sync off, make decoding faster
-        appsink.set_property('sync', False)
         appsink.connect('new-preroll', self.on_new_preroll_cb)
         pipeline.set_state(gst.STATE_PAUSED)
         pipeline.get_state()
     
-        if self.interval is None:
-            self.interval = ((self.fileinfo.videolength/gst.SECOND) / self.count) or 1
-    
-        while ((offset < self.fileinfo.videolength/gst.SECOND) and (counter < self.count)):
+        for offset in offsets:
             ret = pipeline.seek_simple( 
                 gst.FORMAT_TIME, gst.SEEK_FLAG_ACCURATE | gst.SEEK_FLAG_FLUSH, offset * gst.SECOND)
             pipeline.get_state()
-            offset += self.interval
-            counter += 1
-        return True
 
-    # Load pixbuf and save file to disk
+        pipeline.set_state(gst.STATE_NULL)
+
+    def _create_linear(self, offsets):
+        # Decode the file once from start to end. Frames are dropped right
+        # after the decoder unless they are the first frame at or after one
+        # of the target times, so only the kept frames get converted and
+        # scaled. Each target time is labelled with the offset it is for.
+        if self.best_frame:
+            window = min(self.window, self.interval) * gst.SECOND
+            step = window / max(self.candidates, 1)
+            targets = [(offset, offset * gst.SECOND + x * step) \
+                       for offset in offsets for x in range(max(self.candidates, 1))]
+        else:
+            targets = [(offset, offset * gst.SECOND) for offset in offsets]
+
+        cmd = "uridecodebin uri=file://%s ! ffmpegcolorspace name=csp ! videoscale ! " \
+                "ffmpegcolorspace ! %s" % \
+                (os.path.abspath(self.filepath), self._get_sink_str())
+
+        pipeline = gst.parse_launch(cmd)
+        pending = list(targets)
+        kept = []
+        self._best = None
+
+        def _buffer_probe(pad, buffer):
+            if not pending:
+                return False
+
+            end = buffer.timestamp
+            if buffer.duration != gst.CLOCK_TIME_NONE:
+                end += buffer.duration
+
+            if end <= pending[0][1]:
+                return False
+
+            # Several targets can fall within a single long frame
+            kept.append(pending.pop(0)[0])
+            while pending and end > pending[0][1]:
+                pending.pop(0)
+            return True
+
+        def _new_buffer(appsink):
+            buffer = appsink.emit('pull-buffer')
+            if buffer and kept:
+                if self.best_frame:
+                    self._add_candidate(buffer, kept.pop(0))
+                else:
+                    self._load_and_save_file(buffer, kept.pop(0))
+            if not pending and not kept:
+                # No need to decode the rest of the file
+                pipeline.post_message(gst.message_new_application(pipeline,
+                    gst.Structure("thumbnails-done")))
+
+        pipeline.get_by_name("csp").get_pad("sink").add_buffer_probe(_buffer_probe)
+        appsink = pipeline.get_by_name("sink")
+        appsink.set_property('emit-signals', True)
+        appsink.connect('new-buffer', _new_buffer)
+        pipeline.set_state(gst.STATE_PLAYING)
+
+        bus = pipeline.get_bus()
+        msg = bus.timed_pop_filtered(gst.CLOCK_TIME_NONE,
+            gst.MESSAGE_EOS | gst.MESSAGE_ERROR | gst.MESSAGE_APPLICATION)
+        if msg.type == gst.MESSAGE_ERROR:
+            _log.debug("Error creating thumbnails for %s: %s" % (self.filepath, msg.parse_error()[0]))
+
+        pipeline.set_state(gst.STATE_NULL)
+        self._save_best()
+
+    def _add_candidate(self, buffer, offset):
+        # Only the best scoring frame of each offset is kept and saved
+        if self._best and self._best[0] != offset:
+            self._save_best()
+
+        score = analysis.frame_quality(
+            analysis.rgb_to_luma(buffer, self.width, self.height))
+        if not self._best or score > self._best[1]:
+            self._best = (offset, score, buffer)
+
+    def _save_best(self):
+        if self._best:
+            offset, score, buffer = self._best
+            _log.debug("Best frame for %s scored %.2f" % (offset, score))
+            self._load_and_save_file(buffer, offset)
+            self._best = None
+
+    # Save an encoded frame to disk, raw frames are encoded first
     def _load_and_save_file(self, buffer, offset):
         file_name = "%s/%s_%s.%s" %  (self.output_dir, self.prefix, offset, self.format)
         try:
-            pix_buf = gtk.gdk.pixbuf_new_from_data(buffer.data, \
-                        gtk.gdk.COLORSPACE_RGB, False, 8, self.width, self.height, self.width * 3)
-            pix_buf.save(file_name, 'jpeg')
+            if buffer.get_caps()[0].get_name().startswith("video/"):
+                if not self._encoder:
+                    self._encoder = _FrameEncoder(_ENCODERS[self.format])
+                buffer = self._encoder.encode(buffer)
+            self.stats["bytes"] += utils.write_buffer(file_name, buffer)
+            self.stats["thumbnails"] += 1
         except Exception as e:
             _log.debug("Error saving %s to disk: %s " % (file_name, e))
 
+
+# Default seconds between sprite sheet tiles
+_SPRITE_INTERVAL = 10
+
+def _format_vtt_time(timestamp):
+    # WebVTT times have millisecond precision
+    ms = timestamp // gst.MSECOND
+    return "%02d:%02d:%02d.%03d" % (ms // 3600000, ms // 60000 % 60,
+                                    ms // 1000 % 60, ms % 1000)
+
+class SpriteSheetThumbnailer(Thumbnailer):
+    """
+        Pack thumbnails into a few sprite sheets for seek previews, plus a
+        WebVTT file that maps each time range to a tile. Frames are copied
+        into the current sheet, a numpy array, straight from the pulled
+        buffers and only the finished sheets are encoded and written.
+    """
+    raw_frames = True
+
+    def __init__(self, filepath, output_dir, columns=10, rows=10, **kwargs):
+        # Seek previews need a tile every few seconds over the whole file
+        # rather than a handful of thumbnails
+        if kwargs.get("interval") is None:
+            kwargs["interval"] = _SPRITE_INTERVAL
+        kwargs.setdefault("number", sys.maxint)
+        Thumbnailer.__init__(self, filepath, output_dir, **kwargs)
+        self.columns = columns
+        self.rows = rows
+        self.sheets = []
+        self.tiles = []
+        self._sheet = None
+        self._caps = None
+        self._sheet_encoder = None
+
+    def create_thumbnails(self):
+        if not analysis.available():
+            _log.warning("Sprite sheets need numpy, skipping %s" % self.filepath)
+            return False
+
+        self.sheets = []
+        self.tiles = []
+        self._sheet = None
+        try:
+            if not Thumbnailer.create_thumbnails(self):
+                return False
+            self._save_sheet()
+        finally:
+            if self._sheet_encoder:
+                self._sheet_encoder.close()
+                self._sheet_encoder = None
+        self._save_index()
+        return True
+
+    def _load_and_save_file(self, buffer, offset):
+        # Tiles are timed by their frame, not the offset they were taken for
+        timestamp = buffer.timestamp
+        if timestamp == gst.CLOCK_TIME_NONE:
+            timestamp = offset * gst.SECOND
+
+        # The seek strategy can deliver the same preroll frame twice
+        if self.tiles and timestamp <= self.tiles[-1][0]:
+            return
+
+        per_sheet = self.columns * self.rows
+        index = len(self.tiles) % per_sheet
+        if index == 0:
+            self._save_sheet()
+            stride = (self.width * self.columns * 3 + 3) & ~3
+            self._sheet = numpy.zeros((self.height * self.rows, stride),
+                                      numpy.uint8)
+            self._caps = buffer.get_caps()
+
+        x = (index % self.columns) * self.width
+        y = (index // self.columns) * self.height
+        try:
+            frame = analysis.rgb_frame(buffer, self.width, self.height)
+            self._sheet[y:y + self.height, x * 3:(x + self.width) * 3] = \
+                frame.reshape(self.height, self.width * 3)
+        except Exception as e:
+            _log.debug("Error adding frame at %s to sprite sheet: %s " % (offset, e))
+            return
+
+        self.tiles.append((timestamp, len(self.sheets), x, y))
+
+    def _save_sheet(self):
+        if self._sheet is None:
+            return
+
+        file_name = "%s_sprite_%d.%s" % (self.prefix, len(self.sheets), self.format)
+        caps = gst.Caps(self._caps.to_string())
+        caps[0]["width"] = self.width * self.columns
+        caps[0]["height"] = self.height * self.rows
+        buffer = gst.Buffer(self._sheet.tostring())
+        buffer.set_caps(caps)
+        try:
+            if not self._sheet_encoder:
+                self._sheet_encoder = _FrameEncoder(get_encoder(self.format))
+            self.stats["bytes"] += utils.write_buffer(
+                os.path.join(self.output_dir, file_name),
+                self._sheet_encoder.encode(buffer))
+            self.stats["thumbnails"] += 1
+        except Exception as e:
+            _log.debug("Error saving %s to disk: %s " % (file_name, e))
+        self.sheets.append(file_name)
+        self._sheet = None
+
+    def _save_index(self):
+        file_name = os.path.join(self.output_dir, "%s.vtt" % self.prefix)
+        lines = ["WEBVTT", ""]
+        for pos, (timestamp, sheet, x, y) in enumerate(self.tiles):
+            if pos + 1 < len(self.tiles):
+                end = self.tiles[pos + 1][0]
+            else:
+                end = max(self.fileinfo.videolength, timestamp + gst.SECOND)
+            lines.append("%s --> %s" % (_format_vtt_time(timestamp), _format_vtt_time(end)))
+            lines.append("%s#xywh=%d,%d,%d,%d" % (self.sheets[sheet], x, y, self.width, self.height))
+            lines.append("")
+        try:
+            open(file_name, "w").write("\n".join(lines))
+        except IOError as e:
+            _log.debug("Error saving %s to disk: %s " % (file_name, e))
+
+# Files with these extensions are picked up when scanning directories
+_MEDIA_EXTENSIONS = [".avi", ".flv", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4",
+                     ".mpeg", ".mpg", ".mts", ".ogm", ".ogv", ".ts", ".vob",
+                     ".webm", ".wmv"]
+
+# Written into each output directory once its thumbnails are complete
+_STAMP = ".thumbnails-done"
+
+def find_media(paths):
+    """
+        Get the media files in a list of files and directories. Directories
+        are searched recursively for files with known video extensions,
+        files are always included.
+    """
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in _MEDIA_EXTENSIONS:
+                    found.append(os.path.join(root, name))
+    return found
+
+def _get_output_dir(filepath, output_dir):
+    # Keep thumbnails of files with the same name apart
+    name = os.path.splitext(os.path.abspath(filepath))[0].lstrip(os.sep)
+    return os.path.join(output_dir, name)
+
+def _is_up_to_date(filepath, output_dir):
+    stamp = os.path.join(output_dir, _STAMP)
+    try:
+        return os.path.getmtime(stamp) >= os.path.getmtime(filepath)
+    except OSError:
+        return False
+
+# Worker processes are replaced after this many files, so that leaks in
+# decoders can't build up over a large library
+_MAX_TASKS_PER_WORKER = 100
+
+def _thumbnail_job(job):
+    # Returns the file and one of "done", "skipped" or "failed"
+    filepath, output_dir, sprites, kwargs = job
+    try:
+        fileinfo = cache.get_discovery(filepath)
+        if fileinfo is None:
+            fileinfo = Discoverer(filepath)
+            fileinfo.do_discovery()
+            cache.store_discovery(filepath, fileinfo)
+
+        # Audio files in a library are normal, not a failure
+        if not fileinfo.is_video:
+            _log.debug("Skipping %s without a video stream" % filepath)
+            return filepath, "skipped"
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        if sprites:
+            thumbnailer = SpriteSheetThumbnailer(filepath, output_dir,
+                                                 fileinfo=fileinfo, **kwargs)
+        else:
+            thumbnailer = Thumbnailer(filepath, output_dir, fileinfo=fileinfo, **kwargs)
+        if not thumbnailer.create_thumbnails():
+            return filepath, "failed"
+
+        open(os.path.join(output_dir, _STAMP), "w").close()
+        return filepath, "done"
+    except Exception as e:
+        _log.debug("Error creating thumbnails for %s: %s" % (filepath, e))
+        return filepath, "failed"
+
+def _worker_main():
+    """
+        Run thumbnail jobs in a worker process. Jobs are read from stdin
+        and results written to stdout as pickles until stdin is closed.
+    """
+    import gobject
+    gobject.threads_init()
+
+    while True:
+        try:
+            job = cPickle.load(sys.stdin)
+        except EOFError:
+            break
+        cPickle.dump(_thumbnail_job(job), sys.stdout, cPickle.HIGHEST_PROTOCOL)
+        sys.stdout.flush()
+
+class _Worker(object):
+    # A worker is a new interpreter rather than a fork of this process, so
+    # it doesn't inherit the GLib and GStreamer state set up here
+    def __init__(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [root] + [path for path in [env.get("PYTHONPATH")] if path])
+        self.process = subprocess.Popen([sys.executable, "-c",
+                "from arista.thumbnailer import _worker_main; _worker_main()"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.tasks = 0
+        self.job = None
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def send(self, job):
+        self.job = job
+        self.tasks += 1
+        cPickle.dump(job, self.process.stdin, cPickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+
+    def receive(self):
+        job, self.job = self.job, None
+        try:
+            return cPickle.load(self.process.stdout)
+        except EOFError:
+            # The worker crashed, e.g. in a decoder
+            _log.debug("Thumbnail worker died while processing %s" % job[0])
+            self.close()
+            return job[0], "failed"
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+def create_library_thumbnails(paths, output_dir, workers=None, force=False, callback=None,
+                              sprites=False, **kwargs):
+    """
+        Create thumbnails for every media file in a list of files and
+        directories, using a pool of worker processes. Each file gets its
+        own directory below output_dir that mirrors its path. Files whose
+        thumbnails are newer than the file itself are skipped unless force
+        is set, as are files without a video stream.
+
+        With sprites set each file gets sprite sheets and a WebVTT index
+        from SpriteSheetThumbnailer instead of single thumbnails. Extra
+        keyword arguments, such as format, strategy and best_frame, are
+        passed on to the thumbnailer. The callback, if given, is called as
+        callback(filepath, success) when each file is done.
+
+        Returns a dict with the number of files "done", "skipped" and
+        "failed", the "elapsed" time in seconds and the throughput in
+        "files_per_second".
+    """
+    import multiprocessing
+
+    stats = {
+        "done": 0,
+        "skipped": 0,
+        "failed": 0,
+    }
+
+    jobs = []
+    for filepath in find_media(paths):
+        job_dir = _get_output_dir(filepath, output_dir)
+        if not force and _is_up_to_date(filepath, job_dir):
+            stats["skipped"] += 1
+            continue
+        jobs.append((filepath, job_dir, sprites, kwargs))
+
+    start = time.time()
+    pool = []
+    try:
+        for x in range(min(workers or multiprocessing.cpu_count(), len(jobs))):
+            worker = _Worker()
+            worker.send(jobs.pop(0))
+            pool.append(worker)
+
+        while pool:
+            for worker in select.select(pool, [], [])[0]:
+                filepath, result = worker.receive()
+                stats[result] += 1
+                if callback:
+                    callback(filepath, result != "failed")
+
+                if worker.tasks >= _MAX_TASKS_PER_WORKER or \
+                   worker.process.poll() is not None or not jobs:
+                    worker.close()
+                    pool.remove(worker)
+                    if jobs:
+                        worker = _Worker()
+                        pool.append(worker)
+                if jobs and worker in pool:
+                    worker.send(jobs.pop(0))
+    finally:
+        for worker in pool:
+            worker.kill()
+
+    stats["elapsed"] = time.time() - start
+    stats["files_per_second"] = stats["elapsed"] and \
+                                (stats["done"] + stats["failed"]) / stats["elapsed"] or 0.0
+    return stats
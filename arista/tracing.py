@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+    Arista Tracing
+    ==============
+    Record the phases of each transcode job, such as discovery, prerolling,
+    seeking and encoding passes, as Chrome trace events. The resulting JSON
+    file can be loaded into chrome://tracing or any other viewer that reads
+    the trace event format, with one row per job.
+
+    Tracing is off unless enable() is called, in which case events are kept
+    in memory until save() writes them out.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import gettext
+import logging
+import os
+import threading
+import time
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.tracing")
+
+_path = None
+_events = []
+_tracks = [0]
+_lock = threading.Lock()
+
+def enable(path):
+    """
+        Start recording trace events.
+
+        @type path: str
+        @param path: Where save() writes the trace
+    """
+    global _path
+    _path = path
+
+def enabled():
+    """
+        @rtype: bool
+        @return: Whether trace events are being recorded
+    """
+    return _path is not None
+
+def now():
+    """
+        Get the current time in the units trace events use.
+
+        @rtype: int
+        @return: Microseconds since the epoch
+    """
+    return int(time.time() * 1000000)
+
+def _add(event):
+    event["pid"] = os.getpid()
+    _lock.acquire()
+    try:
+        _events.append(event)
+    finally:
+        _lock.release()
+
+def new_track(name):
+    """
+        Get a new track (a row in the timeline) for a job.
+
+        @type name: str
+        @param name: The label shown for the track
+        @rtype: int
+        @return: The track id to pass to complete() and instant()
+    """
+    _lock.acquire()
+    try:
+        _tracks[0] += 1
+        track = _tracks[0]
+    finally:
+        _lock.release()
+
+    if enabled():
+        _add({
+            "name": "thread_name",
+            "ph": "M",
+            "tid": track,
+            "args": {"name": name},
+        })
+    return track
+
+def complete(name, track, start, category="job", **args):
+    """
+        Record a phase that started at start and ends now.
+
+        @type name: str
+        @param name: The name of the phase
+        @type track: int
+        @param track: The track from new_track()
+        @type start: int
+        @param start: The start time from now()
+        @type category: str
+        @param category: The event category
+    """
+    if not enabled():
+        return
+
+    _add({
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": start,
+        "dur": now() - start,
+        "tid": track,
+        "args": args,
+    })
+
+def instant(name, track, category="job", **args):
+    """
+        Record a single point in time, such as EOS.
+
+        @type name: str
+        @param name: The name of the event
+        @type track: int
+        @param track: The track from new_track()
+        @type category: str
+        @param category: The event category
+    """
+    if not enabled():
+        return
+
+    _add({
+        "name": name,
+        "cat": category,
+        "ph": "i",
+        "s": "t",
+        "ts": now(),
+        "tid": track,
+        "args": args,
+    })
+
+def save():
+    """
+        Write all recorded events to the trace file.
+    """
+    if not enabled():
+        return
+
+    _lock.acquire()
+    try:
+        data = json.dumps({
+            "traceEvents": _events,
+            "displayTimeUnit": "ms",
+        })
+    finally:
+        _lock.release()
+
+    try:
+        open(_path, "w").write(data)
+    except IOError, e:
+        _log.warning(_("Unable to write trace to %(filename)s: %(error)s") % {
+            "filename": _path,
+            "error": str(e),
+        })
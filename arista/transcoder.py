@@ -50,7 +50,18 @@ import gst
 import gtk
 import gtk.gdk
 
+import analysis
+import cache
+import complexity
+import concat
 import discoverer
+import history
+import profiler
+import speed
+import thumbnailer
+import tracing
+import utils
+import watchdog
 
 from threading import Thread
 _ = gettext.gettext
@@ -62,6 +73,36 @@ _log = logging.getLogger("arista.transcoder")
 
 _NO_APPLICATION_MSG_TIMEOUT = 20000
 
+# How many times a job that stalled is restarted before it fails
+_MAX_STALL_RESTARTS = 2
+
+# With a deadline, the encoder speed is measured for this many seconds or
+# this fraction of the output, whichever comes first
+_SPEED_SAMPLE_TIME = 20
+_SPEED_SAMPLE_FRACTION = 0.1
+
+# Reduced resolution decoding is only used when the decoded frames are still
+# at least this many times the output size, so videoscale always scales down
+_LOWRES_MARGIN = 1.2
+
+# Skipping B-frames is only used when at most one in this many input frames
+# ends up in the output
+_SKIP_FRAME_RATIO = 3
+
+# Containers and encoders that cope with variable framerate input
+_VFR_CONTAINERS = ["matroskamux", "webmmux", "mp4mux", "qtmux", "ffmux_mp4",
+                   "flvmux"]
+_VFR_ENCODERS = ["x264enc", "vp8enc", "ffenc_mpeg4", "ffenc_flv"]
+
+# Telecine detection looks at this many runs of consecutive frames, spread
+# over the input
+_TELECINE_RUNS = 6
+_TELECINE_RUN_LENGTH = 20
+
+# Interlace detection looks at this many shorter runs
+_INTERLACE_RUNS = 8
+_INTERLACE_RUN_LENGTH = 6
+
 class TranscoderException(Exception):
     """
         A generic transcoder exception to be thrown when something goes wrong.
@@ -97,10 +138,17 @@ class TranscoderOptions(object):
                  audio = None, start_time = 0, stop_time = -1, nb_threads = 0,
                  height = None, width = None, framerate = None,
                  video_bitrate = None, absolute = False, max_duration = None,
-                 thumbnail_offset = 0, encoder_passes=1, **kw):
+                 thumbnail_offset = 0, encoder_passes=1, video_streams = None,
+                 audio_streams = None, decode_hints = False, vfr = False,
+                 ivtc = False, auto_crop = False, crop_samples = 10,
+                 crop_threshold = 24, scene_keyframes = False, profile = False,
+                 stall_timeout = 60, stall_action = "warn", deadline = None,
+                 probe_bitrate = False, ladder = False,
+                 thumbnail_format = "jpeg", **kw):
         """
-            @type uri: str
-            @param uri: The URI to the input file, device, or stream
+            @type uri: str or list
+            @param uri: The URI to the input file, device, or stream. A list
+                        of URIs is decoded back to back into one output.
             @type preset: Preset
             @param preset: The preset to convert to
             @type output_uri: str
@@ -112,8 +160,10 @@ class TranscoderOptions(object):
                                     'utf-8' or 'latin-1'
             @type font: str
             @param font: Pango font description
-            @type deinterlace: bool
-            @param deinterlace: Force deinterlacing of the input data
+            @type deinterlace: bool or str
+            @param deinterlace: Force deinterlacing of the input data, or
+                                "auto" to deinterlace only if sampled frames
+                                show interlacing
             @type crop: int tuple
             @param crop: How much should be cropped on each side
                                     (top, right, bottom, left)
@@ -131,12 +181,72 @@ class TranscoderOptions(object):
 
             @type nb_threads: int
             @param nb_threads: Number of threads to use
+            @type thumbnail_offset: int
+            @param thumbnail_offset: Write a thumbnail next to the output
+                                     every this many seconds (0 to disable)
+            @type thumbnail_format: str
+            @param thumbnail_format: The image format of thumbnails, jpeg or
+                                     png
+
+            @type video_streams: list
+            @param video_streams: Video streams to encode, as stream indexes
+                                  or language codes (default: all)
+            @type audio_streams: list
+            @param audio_streams: Audio streams to encode, as stream indexes
+                                  or language codes (default: all)
+            @type decode_hints: bool
+            @param decode_hints: Ask video decoders to decode at a reduced
+                                 resolution or to skip frames when the output
+                                 is much smaller or slower than the input
+            @type vfr: bool
+            @param vfr: Keep variable framerate input variable when the
+                        container and encoder support it, only dropping
+                        frames above the maximum output framerate
+            @type ivtc: bool
+            @param ivtc: Detect 3:2 pulldown in NTSC sources and inverse
+                         telecine them to 23.976 fps
+            @type auto_crop: bool
+            @param auto_crop: Detect black borders and crop them if crop
+                              isn't set
+            @type crop_samples: int
+            @param crop_samples: Number of frames to sample for auto_crop
+            @type crop_threshold: int
+            @param crop_threshold: Highest mean luma (0 - 255) of a row or
+                                   column that auto_crop counts as black
+            @type scene_keyframes: bool
+            @param scene_keyframes: Force a keyframe at every scene change,
+                                    using the input's scene index
+            @type profile: bool
+            @param profile: Measure buffer rates, latencies and queue fill
+                            levels of each pass
+            @type stall_timeout: int
+            @param stall_timeout: Seconds without any progress after which
+                                  a pass is stalled (0 to never check)
+            @type stall_action: str
+            @param stall_action: What to do with a stalled pass, one of
+                                 arista.watchdog.ACTIONS
+            @type deadline: float
+            @param deadline: When the job should be finished, in seconds
+                             since the epoch. The video encoder speed
+                             settings are then chosen to meet it.
+            @type probe_bitrate: bool
+            @param probe_bitrate: Base the video bitrate on a fixed quality
+                                  encode of a few short windows instead of
+                                  the input file size
+            @type ladder: bool
+            @param ladder: Write the renditions of the preset's ladder as
+                           segments and streaming manifests to the
+                           output_uri directory
         """
         _log.debug("unhandled options : %s" % kw)
         self.reset(uri, preset, output_uri, ssa,subfile, subfile_charset, font, deinterlace,
                    crop, title, chapter, audio, start_time, stop_time, nb_threads,
                    height, width, framerate, video_bitrate, absolute, max_duration, 
-                   thumbnail_offset, encoder_passes)
+                   thumbnail_offset, encoder_passes, video_streams, audio_streams,
+                   decode_hints, vfr, ivtc, auto_crop, crop_samples,
+                   crop_threshold, scene_keyframes, profile, stall_timeout,
+                   stall_action, deadline, probe_bitrate, ladder,
+                   thumbnail_format)
     
     def reset(self, uri = None, preset = None, output_uri = None, ssa = False,
               subfile = None, subfile_charset = None, font = "Sans Bold 16",
@@ -144,11 +254,23 @@ class TranscoderOptions(object):
               audio = None, start_time = 0, stop_time = -1, nb_threads = 0,
               height = None, width = None, framerate = None,
               video_bitrate = None, absolute = False, max_duration = None,
-              thumbnail_offset = 0, encoder_passes=1):
+              thumbnail_offset = 0, encoder_passes=1, video_streams = None,
+              audio_streams = None, decode_hints = False, vfr = False,
+              ivtc = False, auto_crop = False, crop_samples = 10,
+              crop_threshold = 24, scene_keyframes = False, profile = False,
+              stall_timeout = 60, stall_action = "warn", deadline = None,
+              probe_bitrate = False, ladder = False,
+              thumbnail_format = "jpeg"):
         """
             Reset the input options to nothing.
         """
-        self.uri = uri
+        if isinstance(uri, (list, tuple)):
+            self.uris = list(uri)
+        elif uri:
+            self.uris = [uri]
+        else:
+            self.uris = []
+        self.uri = self.uris and self.uris[0] or None
         self.preset = preset
         self.output_uri = output_uri
         self.ssa = ssa
@@ -178,6 +300,25 @@ class TranscoderOptions(object):
         self.absolute = absolute
         self.max_duration = max_duration
         self.thumbnail_offset = thumbnail_offset
+        self.video_streams = video_streams
+        self.audio_streams = audio_streams
+        self.decode_hints = decode_hints
+        self.vfr = vfr
+        self.ivtc = ivtc
+        self.auto_crop = auto_crop
+        self.crop_samples = crop_samples
+        self.crop_threshold = crop_threshold
+        self.scene_keyframes = scene_keyframes
+        self.profile = profile
+        self.stall_timeout = stall_timeout
+        if stall_action not in watchdog.ACTIONS:
+            _log.debug("invalid stall_action sent %s" % stall_action)
+            stall_action = "warn"
+        self.stall_action = stall_action
+        self.deadline = deadline
+        self.probe_bitrate = probe_bitrate
+        self.ladder = ladder
+        self.thumbnail_format = thumbnail_format
         if encoder_passes not in [1, 2]: encoder_passes = 1
         self.passes = self.preset.vcodec.passes[encoder_passes]
         self.pass_count = max(len(self.passes), len(preset.acodec.passes))
@@ -196,6 +337,8 @@ class Transcoder(gobject.GObject):
                        gobject.TYPE_PYOBJECT)),    # is_media
         "pass-setup": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, tuple()),
         "pass-complete": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, tuple()),
+        "pass-abandoned": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                          (gobject.TYPE_PYOBJECT,)),   # reason
         "message": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
                    (gobject.TYPE_PYOBJECT,         # bus
                     gobject.TYPE_PYOBJECT)),       # message
@@ -215,6 +358,7 @@ class Transcoder(gobject.GObject):
         self.options = options
         
         self.pipe = None
+        self._bus_watch = None
         
         self.enc_pass = 0
         self.random_num = str(time.time()) + "-" +  str(random.randint(1,100000))
@@ -224,28 +368,249 @@ class Transcoder(gobject.GObject):
         else:
             self.cpu_count = self.options.nb_threads
 
-        self._percent_cached = 0
-        self._percent_cached_time = 0
+        self.watchdog = None
+        self.stall_restarts = 0
+        
+        # Index into the encoder's speed ladder when there is a deadline
+        self.speed_rung = None
+        self._speed_measured = False
+        
+        # Result of the complexity probe, measured before the first pass
+        self.probe = None
+        self.connect("error", self._cb_error)
+        
+        # Expected wall time of the whole job from past jobs, if known
+        self.job_start = time.time()
+        self.estimate = None
         
-        self.do_discovery(options.uri, self._got_info)
+        # Start of the current phase for the trace timeline
+        self.trace_track = tracing.new_track(os.path.basename(options.uri or ""))
+        self._trace_start = tracing.now()
+        self._trace_pass = self._trace_start
+        
+        self.infos = []
+        self.input_durations = []
+        self.duration = 0
+        if len(options.uris) > 1:
+            self._discover_inputs(options.uris, [], self._got_info)
+        else:
+            self.do_discovery(options.uri, self._got_info)
   
         self.output_duration = 0.0
+        self.output_rate = 0.0
+        self.vfr = False
+        self.vfr_duplicates_avoided = 0
+        self.telecined = False
+        self.deinterlace = bool(options.deinterlace) and \
+                           options.deinterlace != "auto"
+        self.crop = options.crop
+        self.scene_index = None
+        self.thumbnails = []
+        self.profiler = None
+        self.profiles = []
+        self.metadata = {}
         self._lock = threading.Lock()
 
     def _got_info(self, info, is_media):
         self.info = info
         self.emit("discovered", info, is_media)
         info.set_state(gst.STATE_NULL)
+        if len(self.options.uris) == 1:
+            cache.store_discovery(self.infile, info)
+        tracing.complete("discovery", self.trace_track, self._trace_start)
         if info.is_video or info.is_audio:
             try:
-                self._setup_pass()
+                self._setup_duration()
+                length = self.duration / float(gst.SECOND)
+                self.estimate = history.estimate(self.options.preset.name,
+                                    info.videowidth or 0,
+                                    info.videoheight or 0,
+                                    history.get_output_duration(self.options,
+                                                                length),
+                                    self.options.pass_count)
             except PipelineException, e:
                 self.emit("error", str(e), 0)
                 info = None
                 return
-            self.pause()
+            
+            # Analysis waits on decoded frames, so it runs outside the main
+            # loop and setup continues there once it is done
+            thread = threading.Thread(target=self._analyze_source_thread)
+            thread.daemon = True
+            thread.start()
         info = None
 
+    def _analyze_source_thread(self):
+        """
+            Analyze the input from a worker thread, then continue setting
+            up the first pass in the main loop.
+        """
+        start = tracing.now()
+        try:
+            self._analyze_source()
+        finally:
+            tracing.complete("analysis", self.trace_track, start)
+            gobject.idle_add(self._cb_source_analyzed)
+
+    def _cb_source_analyzed(self):
+        try:
+            self._setup_pass_traced()
+        except PipelineException, e:
+            self.emit("error", str(e), 0)
+            return False
+        self.pause()
+        return False
+
+    def _setup_pass_traced(self):
+        """
+            Set up the next pass and record it on the trace timeline. The
+            time until the pipeline has prerolled is traced from here.
+        """
+        start = tracing.now()
+        self._setup_pass()
+        tracing.complete("pass %d setup" % (self.enc_pass + 1),
+                         self.trace_track, start)
+        self._trace_start = tracing.now()
+
+    def _setup_duration(self):
+        """
+            Set the total input duration. Concatenated inputs each need a
+            known duration, as the timestamps of every input are offset by
+            the durations of the ones before it.
+        """
+        if len(self.infos) < 2:
+            self.duration = max(self.info.videolength, self.info.audiolength)
+            return
+        
+        for uri, info in zip(self.options.uris, self.infos):
+            if info.length <= 0:
+                raise PipelineException(_("Unable to get the duration of " \
+                                          "%(filename)s!") % {
+                    "filename": uri,
+                })
+        
+        self.input_durations = [info.length for info in self.infos]
+        self.duration = sum(self.input_durations)
+
+    def _analyze_source(self):
+        """
+            Sample decoded frames to choose settings that depend on the
+            content of the input rather than its caps. The results are
+            stored in self.metadata.
+            
+            This blocks until the frames are decoded and must not be called
+            from the main loop.
+        """
+        auto_deinterlace = self.options.deinterlace == "auto"
+        auto_crop = self.options.auto_crop and not self.options.crop
+        if not self.info.is_video:
+            return
+        
+        if len(self.options.uris) > 1:
+            if self.options.scene_keyframes or self.options.ivtc or \
+               auto_deinterlace or auto_crop:
+                _log.warning(_("Source analysis is not supported for " \
+                               "concatenated inputs, skipping it"))
+            return
+        
+        if self.options.scene_keyframes:
+            try:
+                self.scene_index = analysis.get_scene_index(self.infile)
+            except analysis.AnalysisException, e:
+                _log.warning(_("Unable to index scenes: %(error)s") % {
+                    "error": str(e),
+                })
+        
+        if not (self.options.ivtc or auto_deinterlace or auto_crop):
+            return
+        
+        if not analysis.available():
+            _log.warning(_("Source analysis needs numpy, skipping it"))
+            return
+        
+        sampler = analysis.FrameSampler(self._get_uri(self.infile))
+        try:
+            sampler.open()
+            if self.options.ivtc:
+                self._detect_telecine(sampler)
+            if auto_deinterlace and not self.telecined:
+                self._detect_interlacing(sampler)
+            if auto_crop:
+                self._detect_crop(sampler)
+        except analysis.AnalysisException, e:
+            _log.warning(_("Unable to analyze source: %(error)s") % {
+                "error": str(e),
+            })
+        finally:
+            sampler.close()
+
+    def _detect_telecine(self, sampler):
+        """
+            Look for the 3:2 pulldown pattern in an NTSC rate source.
+        """
+        rate = self.info.videorate.num / float(self.info.videorate.denom or 1)
+        if abs(rate - 29.97) > 0.05:
+            self.metadata["telecine"] = False
+            return
+        
+        duration = self.info.videolength
+        runs = []
+        for x in range(_TELECINE_RUNS):
+            position = duration * (x + 1) / (_TELECINE_RUNS + 1)
+            frames = sampler.sample(position, _TELECINE_RUN_LENGTH)
+            runs.append([analysis.is_combed(frame) for (ts, frame) in frames])
+        
+        self.telecined = analysis.detect_telecine(runs)
+        self.metadata["telecine"] = self.telecined
+        _log.info(_("Source telecined: %(telecined)s") % {
+            "telecined": self.telecined,
+        })
+
+    def _detect_interlacing(self, sampler):
+        """
+            Classify the source as progressive, interlaced or mixed and only
+            deinterlace when it isn't progressive.
+        """
+        duration = self.info.videolength
+        runs = []
+        for x in range(_INTERLACE_RUNS):
+            position = duration * (x + 1) / (_INTERLACE_RUNS + 1)
+            frames = sampler.sample(position, _INTERLACE_RUN_LENGTH)
+            runs.append([frame for (ts, frame) in frames])
+        
+        interlacing = analysis.classify_interlacing(runs)
+        self.deinterlace = interlacing != analysis.PROGRESSIVE
+        self.metadata["interlacing"] = interlacing
+        self.metadata["deinterlace"] = self.deinterlace
+        _log.info(_("Source is %(interlacing)s, deinterlace: %(deint)s") % {
+            "interlacing": interlacing,
+            "deint": self.deinterlace,
+        })
+
+    def _detect_crop(self, sampler):
+        """
+            Find stable black borders in frames sampled across the input and
+            crop them.
+        """
+        duration = self.info.videolength
+        count = max(1, self.options.crop_samples)
+        frames = []
+        for x in range(count):
+            position = duration * (x + 1) / (count + 1)
+            frames += [frame for (ts, frame) in sampler.sample(position)]
+        
+        crop = analysis.detect_crop(frames, self.options.crop_threshold)
+        if any(crop):
+            self.crop = crop
+        self.metadata["crop"] = crop
+        _log.info(_("Detected crop: top %(top)d, right %(right)d, bottom " \
+                    "%(bottom)d, left %(left)d") % {
+            "top": crop[0],
+            "right": crop[1],
+            "bottom": crop[2],
+            "left": crop[3],
+        })
+
     def do_discovery(self, filename, callback):
         """ Does discovery of the filename and connects the discovered signal to callback"""
         if not filename:
@@ -259,6 +624,33 @@ class Transcoder(gobject.GObject):
         d.connect("discovered", callback)
         d.discover()
 
+    def _discover_inputs(self, uris, infos, callback):
+        """
+            Discover several inputs one after another. Once all of them are
+            known their infos are stored in self.infos and the info of the
+            first input is passed on to callback.
+        """
+        def _discovered(info, is_media):
+            info.set_state(gst.STATE_NULL)
+            infos.append(info)
+            if not is_media:
+                callback(info, is_media)
+            elif len(infos) < len(uris):
+                self.do_discovery(uris[len(infos)], _discovered)
+            else:
+                first = infos[0]
+                for other in infos[1:]:
+                    if other.is_video != first.is_video or \
+                       other.is_audio != first.is_audio:
+                        self.emit("error", _("All concatenated inputs must " \
+                                             "contain the same streams!"), 0)
+                        return
+                
+                self.infos = infos
+                callback(first, is_media)
+        
+        self.do_discovery(uris[0], _discovered)
+
     @property
     def infile(self):
         """
@@ -290,13 +682,43 @@ class Transcoder(gobject.GObject):
             @rtype: string
             @return: Source to prepend to gst-launch style strings.
         """
+        return "uridecodebin uri=\"%s\" name=uridecode" % \
+               self._get_uri(self.infile)
+    
+    def _get_uri(self, filename):
+        """
+            Return a URI usable with uridecodebin for a filename or URI.
+        """
         # FIXME : Not dealing with http source in transcoder yet
-        if self.infile.startswith("file://"):
-            filename = self.infile
+        if filename.startswith("file://"):
+            return filename
         else:
-            filename = "file://" + os.path.abspath(self.infile)
+            return "file://" + os.path.abspath(filename)
+    
+    def _build_concat_source(self):
+        """
+            Return a pipeline that decodes all inputs back to back through a
+            ConcatSource named uridecode, linked to a fakesink like the
+            pipeline built from _get_source.
             
-        return "uridecodebin uri=\"%s\" name=uridecode" % filename
+            @rtype: gst.Pipeline
+            @return: A new pipeline
+        """
+        pipe = gst.Pipeline()
+        source = concat.ConcatSource(
+            [self._get_uri(uri) for uri in self.options.uris],
+            self.input_durations, video=self.info.is_video,
+            audio=self.info.is_audio, name="uridecode")
+        fake = gst.element_factory_make("fakesink", "fake")
+        pipe.add(source, fake)
+        
+        def _link_fake(elem, pad):
+            sinkpad = fake.get_pad("sink")
+            if not sinkpad.is_linked():
+                pad.link(sinkpad)
+        
+        source.connect("pad-added", _link_fake)
+        return pipe
     
     def _get_container(self):
         container = None
@@ -398,8 +820,8 @@ class Transcoder(gobject.GObject):
 
         vcrop = ""
         crop = [0, 0, 0, 0]
-        if self.options.crop:
-            crop = self.options.crop
+        if self.crop:
+            crop = self.crop
             vcrop = "videocrop top=%i right=%i bottom=%i left=%i ! "  % \
                      (crop[0], crop[1], crop[2], crop[3])
 
@@ -483,6 +905,8 @@ class Transcoder(gobject.GObject):
         for vcap in self.vcaps:
             vcap["width"] = width
             vcap["height"] = height
+        self.metadata["width"] = width
+        self.metadata["height"] = height
 
         return vcrop, vbox
          
@@ -492,8 +916,12 @@ class Transcoder(gobject.GObject):
         # =================================================================
 
         # FIXME : Not working for webm yet
-        num = self.info.videorate.num
-        denom = self.info.videorate.denom
+        if self.telecined:
+            # Inverse telecine recovers the original film frames
+            num, denom = 24000, 1001
+        else:
+            num = self.info.videorate.num
+            denom = self.info.videorate.denom
 
         input_num = num
         input_denom = denom
@@ -524,6 +952,122 @@ class Transcoder(gobject.GObject):
         _log.debug("Final Determined Framerate : %d/%d" % (num, denom))
         return num, denom    
 
+    def _supports_vfr(self, container):
+        """
+            Check whether variable framerate output is possible with the
+            given container, the preset's video encoder and the installed
+            videorate element.
+            
+            @type container: str
+            @param container: The muxer element name
+            @rtype: bool
+            @return: True if the framerate can be left variable
+        """
+        if container not in _VFR_CONTAINERS or \
+           self.preset.vcodec.name not in _VFR_ENCODERS:
+            _log.debug("%s / %s can't do variable framerate" % \
+                       (container, self.preset.vcodec.name))
+            return False
+        
+        element = gst.element_factory_make("videorate")
+        names = [prop.name for prop in gobject.list_properties(element)]
+        if "drop-only" not in names or "max-rate" not in names:
+            _log.debug("videorate is too old for variable framerate output")
+            return False
+        
+        return True
+
+    def _update_vfr_stats(self):
+        """
+            Work out how many duplicate frames a constant framerate encode of
+            this pass would have needed but variable framerate output
+            avoided, summed over every video stream.
+        """
+        if not self.vfr or not self.pipe:
+            return
+        
+        vrates = []
+        while self.pipe.get_by_name("vrate_%d" % len(vrates)):
+            vrates.append(self.pipe.get_by_name("vrate_%d" % len(vrates)))
+        if not vrates:
+            return
+        
+        expected = int(round(self.output_duration * self.output_rate))
+        self.vfr_duplicates_avoided = sum([max(0, expected - \
+            vrate.get_property("out")) for vrate in vrates])
+        _log.info(_("Variable framerate avoided %(count)d duplicate frames") % {
+            "count": self.vfr_duplicates_avoided,
+        })
+
+    def _get_decode_hints(self, width, height, num, denom):
+        """
+            Work out which decoder properties can be used to avoid decoding
+            data that videoscale and videorate would throw away anyway. The
+            properties are the ones supported by the ffmpeg decoders.
+            
+            @type width: int
+            @param width: The output video width
+            @type height: int
+            @param height: The output video height
+            @type num: int
+            @param num: The output framerate numerator
+            @type denom: int
+            @param denom: The output framerate denominator
+            @rtype: dict
+            @return: A dictionary of decoder property names and values
+        """
+        hints = {}
+        
+        # Cropping is done in input pixels and deinterlacing needs both
+        # fields at full resolution, so only decode at full size then
+        if not self.crop and not self.deinterlace and \
+           not self.telecined:
+            lowres = 0
+            for level in [1, 2]:
+                if self.info.videowidth >> level >= width * _LOWRES_MARGIN and \
+                   self.info.videoheight >> level >= height * _LOWRES_MARGIN:
+                    lowres = level
+            if lowres:
+                hints["lowres"] = lowres
+        
+        rate = self.info.videorate.num / float(self.info.videorate.denom or 1)
+        orate = num / float(denom)
+        if orate and rate / orate >= _SKIP_FRAME_RATIO:
+            # Skip B-frames
+            hints["skip-frame"] = 1
+        
+        _log.debug("Decode hints: %s" % hints)
+        return hints
+
+    def _cb_element_added(self, bin, element):
+        """
+            Apply decode hints to video decoders as uridecodebin plugs them.
+            Nested bins are watched as well, since the decoders live inside
+            decodebin2.
+        """
+        if isinstance(element, gst.Bin):
+            self._watch_decoders(element)
+        
+        factory = element.get_factory()
+        if not factory or "Decoder/Video" not in factory.get_klass():
+            return
+        
+        names = [prop.name for prop in gobject.list_properties(element)]
+        for name, value in self.decode_hints.items():
+            if name in names:
+                _log.debug("Setting %s=%s on %s" % (name, value,
+                                                    element.get_name()))
+                element.set_property(name, value)
+
+    def _watch_decoders(self, bin):
+        """
+            Watch a bin and any bins it already contains for new decoders.
+        """
+        bin.connect("element-added", self._cb_element_added)
+        for element in bin.elements():
+            if isinstance(element, gst.Bin):
+                self._watch_decoders(element)
+
     def _update_preset_to_aencoder_limits(self):
         # =================================================================
         # Update limits based on what the encoder really supports
@@ -563,7 +1107,10 @@ class Transcoder(gobject.GObject):
         filesize = 0
         oabitrate = 0
         try:
-            filesize = os.path.getsize( os.path.abspath(self.infile) )
+            for uri in self.options.uris:
+                if uri.startswith("file://"):
+                    uri = uri[7:]
+                filesize += os.path.getsize(os.path.abspath(uri))
         except:
             _log.debug(_("Error reading FILESIZE for %(filename)s") % { "filename": self.options.uri})
             return 0
@@ -578,17 +1125,100 @@ class Transcoder(gobject.GObject):
         
         # calculating in kbps for H.264. Note vp8enc requires it in bits per second 
         fsize_bits = filesize * 8 
-        fsize_bps = fsize_bits/(self.info.videolength/gst.SECOND) 
+        fsize_bps = fsize_bits/(self.duration/gst.SECOND) 
         fsize_kbps = fsize_bps/1000
         return fsize_kbps
 
 
+    def _get_probed_video_bitrate(self):
+        """
+            Measure the bitrate the input needs at the output size with the
+            complexity probe. The probe runs once per job and its cost is
+            logged and stored in self.metadata.
+        """
+        if self.probe is None:
+            if len(self.options.uris) > 1:
+                return 0
+            
+            length = self.duration / float(gst.SECOND)
+            start = self.options.start_time
+            if not self.options.absolute:
+                start = length * start / 100.0
+            stop = start + history.get_output_duration(self.options, length)
+            
+            trace_start = tracing.now()
+            try:
+                self.probe = complexity.get_bitrate(self.infile,
+                                    self._get_uri(self.infile),
+                                    self.preset.vcodec.name,
+                                    self.vcaps.to_string(),
+                                    int(start * gst.SECOND),
+                                    int(stop * gst.SECOND))
+            except complexity.ComplexityException, e:
+                _log.warning(_("Unable to probe complexity: %(error)s") % {
+                    "error": str(e),
+                })
+                self.probe = False
+                return 0
+            tracing.complete("complexity probe", self.trace_track,
+                             trace_start, windows=self.probe.windows,
+                             cached=self.probe.cached)
+            
+            _log.info(_("Complexity probe: %(bitrate)d kbps from %(windows)d " \
+                        "windows (%(seconds).1f seconds of media) in " \
+                        "%(elapsed).1f seconds") % {
+                "bitrate": self.probe.bitrate,
+                "windows": self.probe.windows,
+                "seconds": self.probe.seconds,
+                "elapsed": self.probe.elapsed,
+            })
+            self.metadata["probe_bitrate"] = self.probe.bitrate
+            self.metadata["probe_time"] = self.probe.elapsed
+        
+        return self.probe and self.probe.bitrate or 0
+
+    def _get_video_bitrate_limit(self):
+        """
+            Get the highest video bitrate allowed by the preset, which is a
+            bitrate given in the encoder settings of the current pass, and
+            by the range of the encoder's bitrate property.
+            
+            @rtype: int
+            @return: The limit or None if there is none
+        """
+        limits = []
+        for setting in self.options.passes[self.enc_pass].split():
+            if setting.startswith("bitrate="):
+                try:
+                    limits.append(int(setting[8:]))
+                except ValueError:
+                    pass
+        
+        try:
+            element = gst.element_factory_make(self.preset.vcodec.name)
+        except gst.ElementNotFoundError:
+            element = None
+        if element:
+            for prop in gobject.list_properties(element):
+                if prop.name == "bitrate":
+                    limits.append(prop.maximum)
+        
+        return limits and min(limits) or None
+
     def _set_video_bitrate(self):
 
         if self.options.video_bitrate and self.options.absolute:
             return self.options.video_bitrate
 
-        target_bitrate = self._get_input_video_bitrate()
+        target_bitrate = 0
+        if self.options.probe_bitrate:
+            target_bitrate = self._get_probed_video_bitrate()
+            limit = self._get_video_bitrate_limit()
+            if target_bitrate and limit:
+                target_bitrate = min(target_bitrate, limit)
+        if not target_bitrate:
+            # Not probed or probing failed, estimate from the file size
+            target_bitrate = self._get_input_video_bitrate()
         if self.options.absolute:
             return int(target_bitrate)
 
@@ -648,6 +1278,7 @@ class Transcoder(gobject.GObject):
         # Get limits and setup caps
 
         _log.debug("inside setup pass start:%d stop:%d" % (self.options.start_time, self.options.stop_time))
+        self.decode_hints = {}
         self.vcaps = gst.Caps()
         self.vcaps.append_structure(gst.Structure("video/x-raw-yuv"))
         self.vcaps.append_structure(gst.Structure("video/x-raw-rgb"))
@@ -691,14 +1322,32 @@ class Transcoder(gobject.GObject):
             # Setup video framerate and add to caps
             # =================================================================
             num, denom = self._setup_video_framerate() 
-            for vcap in self.vcaps:
-                vcap["framerate"] = gst.Fraction(num, denom)
+            self.vfr = self.options.vfr and self._supports_vfr(container)
+            if self.vfr:
+                # Leave the framerate open so that frames keep their own
+                # timestamps, videorate only caps the maximum rate
+                videorate = "videorate name=vrate_%%(pad)d drop-only=true " \
+                            "max-rate=%d" % -(-num // denom)
+            else:
+                videorate = "videorate name=vrate_%(pad)d"
+                for vcap in self.vcaps:
+                    vcap["framerate"] = gst.Fraction(num, denom)
+            self.output_rate = num / float(denom)
+            self.metadata["framerate"] = self.output_rate
 
             # =================================================================
             # Properly handle and pass through pixel aspect ratio information
             # =================================================================
             self._setup_pixel_aspect_ratio() 
 
+            # =================================================================
+            # Let decoders do less work if the output allows it
+            # =================================================================
+            if self.options.decode_hints:
+                self.decode_hints = self._get_decode_hints(
+                    self.vcaps[0]["width"], self.vcaps[0]["height"],
+                    num, denom)
+
             # =================================================================
             # Setup the video encoder and options
             # =================================================================
@@ -710,11 +1359,29 @@ class Transcoder(gobject.GObject):
             # FIXME : vp8enc requires the parameter as 'target-bitrate' and 
             # requires it in bps, while x264 requires it in kbps. In general 
             # this handling should be much better than what it is
+            ladder = self.options.deadline and \
+                     speed.get_ladder(self.preset.vcodec.name)
+            if ladder:
+                if self.speed_rung is None:
+                    self.speed_rung = speed.get_start(ladder)
+                vencoder += " " + ladder[self.speed_rung][1]
+                self.metadata["speed"] = ladder[self.speed_rung][1]
+            
             target_bitrate = self._set_video_bitrate()
             vencoder += " bitrate={0}".format(target_bitrate)
+            self.metadata["video_bitrate"] = target_bitrate
 
             deint = ""
-            if self.options.deinterlace:
+            ivtc = ""
+            if self.telecined:
+                # Match fields back into film frames before videorate drops
+                # the repeated ones. The deinterlace fallback must output a
+                # frame per input frame, all fields would double the rate.
+                if gst.element_factory_find("ivtc"):
+                    ivtc = "ivtc ! "
+                else:
+                    ivtc = "deinterlace locking=active fields=top ! "
+            elif self.deinterlace:
                 deint = " ffdeinterlace ! "
             
             transform = ""
@@ -725,12 +1392,30 @@ class Transcoder(gobject.GObject):
             cmd, sub = self._setup_subtitles_from_file()
             video_str += cmd
 
-            video_str += " queue name=q_dec_venc_%d " + " ! ffmpegcolorspace ! videorate !" \
-                   "%s %s %s %s videoscale ! %s ! %s%s ! tee " \
+            vencoder += " name=vencoder_%(pad)d"
+
+            # Scaled frames are split off before the encoder for thumbnails,
+            # on the last pass only
+            thumbtee = ""
+            if self.options.thumbnail_offset and \
+               self.enc_pass == len(self.options.passes) - 1:
+                thumbtee = "tee name=rawtee_%(pad)d ! "
+
+            video_str += " queue name=q_dec_venc_%%(pad)d ! ffmpegcolorspace ! " \
+                   "%s%s ! %s %s %s %s videoscale ! %s ! %s%s%s ! tee " \
                    "name=videotee" % \
-                   (deint, vcrop, transform, sub, self.vcaps.to_string(), vbox,
-                    vencoder)
-            video_str += " ! queue name=q_venc_mux_%d "
+                   (ivtc, videorate, deint, vcrop, transform, sub,
+                    self.vcaps.to_string(), vbox, thumbtee, vencoder)
+            video_str += " ! queue name=q_venc_mux_%(pad)d "
+
+            if thumbtee:
+                video_str += " rawtee_%%(pad)d. ! queue name=q_thumb_%%(pad)d " \
+                             "leaky=downstream max-size-buffers=2 ! " \
+                             "ffmpegcolorspace ! %s ! " \
+                             "appsink name=thumbsink_%%(pad)d sync=false " \
+                             "emit-signals=true" % \
+                             thumbnailer.get_encoder(
+                                 self.options.thumbnail_format)
 
             _log.debug(video_str)
 
@@ -767,11 +1452,11 @@ class Transcoder(gobject.GObject):
                             "threads": self.cpu_count,
                        }
             
-            audio_str += " queue name=q_dec_aenc_%d" + " ! audioconvert ! " \
+            audio_str += " queue name=q_dec_aenc_%%(pad)d ! audioconvert ! " \
                          "audiorate tolerance=100000000 ! " \
                          "audioresample ! %s ! %s " % \
                          (self.acaps.to_string(), aencoder)
-            audio_str += " ! queue name=q_aenc_mux_%d"
+            audio_str += " ! queue name=q_aenc_mux_%(pad)d"
 
             _log.debug(audio_str) 
 
@@ -807,19 +1492,135 @@ class Transcoder(gobject.GObject):
             @param audio_str: A gst-launch string to construct a audio sub-pipeline from.
         """
         try:
-            self.pipe = gst.parse_launch(uridecode_str + " ! fakesink name = fake") # We need a fakesink or uridecodebin won't seek
+            if len(self.options.uris) > 1:
+                self.pipe = self._build_concat_source()
+            else:
+                self.pipe = gst.parse_launch(uridecode_str + " ! fakesink name = fake") # We need a fakesink or uridecodebin won't seek
         except gobject.GError, e:
             raise PipelineException(_("Unable to construct pipeline! ") + \
                                     str(e))
+        except gst.ElementNotFoundError, e:
+            raise PipelineException(_("Unable to construct pipeline! ") + \
+                                    str(e))
 
         bus = self.pipe.get_bus()
         bus.add_signal_watch()
-        bus.connect("message", self._on_message)
+        self._bus_watch = bus.connect("message", self._on_message)
 
         uridecode_elem = self.pipe.get_by_name("uridecode")
         uridecode_elem.connect("pad-added", self._cb_uridecode_pad_added)
         uridecode_elem.connect("no-more-pads", self._cb_uridecode_no_more_pads)
 
+        self._selected_streams = {
+            "video": self._get_selected_streams("video"),
+            "audio": self._get_selected_streams("audio"),
+        }
+        self._stream_counts = {"video": 0, "audio": 0}
+        if self.decode_hints:
+            self._watch_decoders(uridecode_elem)
+        if len(self.options.uris) == 1:
+            uridecode_elem.connect("autoplug-continue",
+                                   self._cb_autoplug_continue)
+
+    def _get_selected_streams(self, kind):
+        """
+            Get the audio or video streams that will be encoded during this
+            pass. Streams selected by language are identified by the name
+            of the demuxer pad they come from, see
+            arista.discoverer.get_stream_id.
+            
+            @type kind: str
+            @param kind: Either "audio" or "video"
+            @rtype: list
+            @return: A list of stream indexes and demuxer pad names, or None
+                     to encode all streams
+            @raise PipelineException: A language was requested that none of
+                                      the streams has
+        """
+        if not getattr(self, kind + "_str"):
+            return []
+        
+        selectors = getattr(self.options, kind + "_streams")
+        if selectors is None:
+            return None
+        
+        languages = getattr(self.info, kind + "languages", {})
+        selected = []
+        for selector in selectors:
+            if isinstance(selector, int):
+                selected.append(selector)
+                continue
+            
+            streams = [stream for (stream, lang) in languages.items() \
+                       if lang == selector]
+            if not streams:
+                raise PipelineException(_("No %(kind)s stream in " \
+                    "%(language)s found! Available languages: " \
+                    "%(available)s") % {
+                    "kind": kind,
+                    "language": selector,
+                    "available": ", ".join(sorted([lang for lang in \
+                        languages.values() if lang])) or _("none"),
+                })
+            selected += streams
+        return selected
+
+    def _want_stream(self, kind, index):
+        """
+            Check whether a decoded stream should be encoded. Streams coming
+            out of a demuxer have already been filtered before decoding in
+            _cb_autoplug_continue, so index is only used when no demuxer was
+            involved.
+        """
+        selected = self._selected_streams[kind]
+        if selected is None:
+            return True
+        elif self._stream_counts[kind]:
+            return bool(getattr(self, kind + "_str"))
+        return index in selected
+
+    def _cb_autoplug_continue(self, elem, pad, caps):
+        """
+            Stop uridecodebin from plugging decoders for demuxed streams that
+            will not be encoded. Returning False exposes the stream as-is,
+            and it is then sent to a fakesink without ever being decoded.
+        """
+        caps_str = caps.to_string()
+        if caps_str.startswith("video/"):
+            kind = "video"
+        elif caps_str.startswith("audio/"):
+            kind = "audio"
+        else:
+            return True
+        
+        parent = pad.get_parent_element()
+        if parent is None or not parent.get_factory() or \
+           "Demux" not in parent.get_factory().get_klass():
+            return True
+        
+        index = self._stream_counts[kind]
+        self._stream_counts[kind] += 1
+        
+        selected = self._selected_streams[kind]
+        if selected is None or index in selected or \
+           pad.get_name() in selected:
+            return True
+        
+        _log.debug("Not decoding %s stream %d (%s)" % (kind, index, caps_str))
+        return False
+
+    def _link_unused_pad(self, pad):
+        """
+            Send a stream that will not be encoded to a fakesink so that it
+            doesn't stall the demuxer.
+        """
+        sink = gst.element_factory_make("fakesink")
+        sink.set_property("sync", False)
+        sink.set_property("async", False)
+        self.pipe.add(sink)
+        sink.set_state(gst.STATE_PAUSED)
+        pad.link(sink.get_pad("sink"))
+
     def _dec_counter(self):
         self._lock.acquire()
         self.counter -= 1
@@ -850,7 +1651,7 @@ class Transcoder(gobject.GObject):
         if not self.video_str:
             return False
 
-        video_str = self.video_str % (video_pads, video_pads)
+        video_str = self.video_str % {"pad": video_pads}
         video_subpipe = gst.parse_launch(video_str)
 
         if video_subpipe:
@@ -858,9 +1659,16 @@ class Transcoder(gobject.GObject):
             self.pipe.add(video_subpipe)
             _log.debug("Adding %s to pipeline " % video_subpipe)
 
+            if self.scene_index:
+                encoder = self.pipe.get_by_name("vencoder_%d" % video_pads)
+                self._setup_scene_keyframes(encoder)
+
+            if self.pipe.get_by_name("thumbsink_%d" % video_pads):
+                self._setup_thumbnails(video_pads)
+
             vq = self.pipe.get_by_name("q_dec_venc_%d" % video_pads)
-            link = elem.link(vq)
-            _log.debug("Result of linking %s to % s => %r" % (elem, vq, link))
+            link = pad.link(vq.get_pad("sink"))
+            _log.debug("Result of linking %s to % s => %r" % (pad, vq, link))
 
             muxer = self.pipe.get_by_name("mux")
             q = self.pipe.get_by_name("q_venc_mux_%d" % video_pads)
@@ -871,11 +1679,91 @@ class Transcoder(gobject.GObject):
         else:
             return False
 
+    def _setup_scene_keyframes(self, encoder):
+        """
+            Ask the encoder for a keyframe at the first frame of every scene
+            in the scene index.
+        """
+        timestamps = self.scene_index.timestamps
+        sinkpad = encoder.get_pad("sink")
+        
+        def _buffer_probe(pad, buffer):
+            # Skip scene changes before the seek start position
+            while timestamps and timestamps[0] < self._start_ns:
+                timestamps.pop(0)
+            
+            forced = False
+            while timestamps and buffer.timestamp >= timestamps[0]:
+                timestamps.pop(0)
+                forced = True
+            if forced:
+                struct = gst.Structure("GstForceKeyUnit")
+                pad.send_event(gst.event_new_custom(
+                    gst.EVENT_CUSTOM_DOWNSTREAM, struct))
+            return True
+        
+        sinkpad.add_buffer_probe(_buffer_probe)
+
+    def _setup_thumbnails(self, video_pads):
+        """
+            Write a thumbnail in thumbnail_format next to the output file
+            every thumbnail_offset seconds. Frames come from the scaled video
+            branch of the transcode, so nothing is decoded twice. Only the
+            frames that are needed enter the thumbnail queue, and it drops
+            frames rather than hold up the encoder. Encoded thumbnails are
+            named after their own timestamp, so a dropped frame only means
+            a missing thumbnail. The interval grid and the names start at
+            the trimmed start of the output, not at the start of the input.
+        """
+        interval = self.options.thumbnail_offset * gst.SECOND
+        base = os.path.splitext(self.options.output_uri)[0]
+        if video_pads:
+            base += "_%d" % video_pads
+        extension = self.options.thumbnail_format
+        if extension == "jpeg":
+            extension = "jpg"
+        # The start is only known once the pipeline has been seeked, which
+        # happens after the pads are set up
+        state = {"next": None}
+        
+        def _buffer_probe(pad, buffer):
+            if state["next"] is None:
+                state["next"] = int(self._start_ns)
+            if buffer.timestamp == gst.CLOCK_TIME_NONE or \
+               buffer.timestamp < state["next"]:
+                return False
+            offset = buffer.timestamp - int(self._start_ns)
+            state["next"] = int(self._start_ns) + \
+                            (offset // interval + 1) * interval
+            return True
+        
+        def _new_buffer(appsink):
+            buffer = appsink.emit("pull-buffer")
+            if not buffer or buffer.timestamp == gst.CLOCK_TIME_NONE:
+                return
+            offset = max(buffer.timestamp - int(self._start_ns), 0)
+            offset = offset // interval * interval
+            filename = "%s_%d.%s" % (base, offset // gst.SECOND, extension)
+            try:
+                utils.write_buffer(filename, buffer)
+                self.thumbnails.append(filename)
+            except IOError, e:
+                _log.warning(_("Unable to write thumbnail %(filename)s: " \
+                               "%(error)s") % {
+                    "filename": filename,
+                    "error": str(e),
+                })
+        
+        queue = self.pipe.get_by_name("q_thumb_%d" % video_pads)
+        queue.get_pad("sink").add_buffer_probe(_buffer_probe)
+        appsink = self.pipe.get_by_name("thumbsink_%d" % video_pads)
+        appsink.connect("new-buffer", _new_buffer)
+
     def _handle_audio_pad_added(self, elem, pad, audio_pads):
         if not self.audio_str:
             return False
 
-        audio_str = self.audio_str % (audio_pads, audio_pads)
+        audio_str = self.audio_str % {"pad": audio_pads}
         audio_subpipe = gst.parse_launch(audio_str)
 
         if audio_subpipe:
@@ -884,8 +1772,8 @@ class Transcoder(gobject.GObject):
             _log.debug("Adding %s to pipeline " % audio_subpipe)
 
             aq = self.pipe.get_by_name("q_dec_aenc_%d" % audio_pads)
-            link = elem.link(aq)
-            _log.debug("Result of linking %s to % s => %r" % (elem, aq, link))
+            link = pad.link(aq.get_pad("sink"))
+            _log.debug("Result of linking %s to % s => %r" % (pad, aq, link))
             
             muxer = self.pipe.get_by_name("mux")
             q = self.pipe.get_by_name("q_aenc_mux_%d" % audio_pads)
@@ -897,8 +1785,7 @@ class Transcoder(gobject.GObject):
 
     def _do_seek(self, elem):
         start, stop = self.options.start_time, self.options.stop_time
-        duration = max(self.info.videolength, self.info.audiolength)
-        duration = duration / gst.SECOND
+        duration = self.duration / gst.SECOND
 
         if start < 0 or stop < -1:
             _log.debug("Start(%d) or Stop(%d) time is invalid" % \
@@ -959,11 +1846,20 @@ class Transcoder(gobject.GObject):
         """
         t = message.type
         if t == gst.MESSAGE_EOS:
+            self._update_vfr_stats()
+            if self.profiler:
+                self.profiler.stop()
+                self.profiles.append(self.profiler)
+                self.profiler = None
+            self._stop_watchdog()
             self.state = gst.STATE_NULL
+            tracing.instant("EOS", self.trace_track)
+            tracing.complete("pass %d" % (self.enc_pass + 1), self.trace_track,
+                             self._trace_pass)
             self.emit("pass-complete")
             if self.enc_pass < self.options.pass_count - 1:
                 self.enc_pass += 1
-                self._setup_pass()
+                self._setup_pass_traced()
                 self.pause()
             else:
                 self.emit("complete")
@@ -971,12 +1867,17 @@ class Transcoder(gobject.GObject):
             msg_name = message.structure.get_name()
             if msg_name == "Prerolled":
                 _log.debug("Prerolled application msg received!")
+                tracing.complete("preroll", self.trace_track, self._trace_start)
 
                 # Do a seek 
                 try:
                     uridecode_elem = self.pipe.get_by_name("uridecode")
                     fake = self.pipe.get_by_name("fake")
-                    if self._do_seek(self.pipe) != True:
+                    start = tracing.now()
+                    seeked = self._do_seek(self.pipe)
+                    tracing.complete("seek", self.trace_track, start)
+                    start = tracing.now()
+                    if seeked != True:
                         _log.debug("Seek failed!")
                         # it's better to unblock pads here and emit an error
                         for pad in uridecode_elem.pads():
@@ -999,15 +1900,33 @@ class Transcoder(gobject.GObject):
                     # adding and connecting the audio and video sub-pipes
                     video_pads = 0
                     audio_pads = 0
+                    raw_index = {"video": 0, "audio": 0}
                     for pad in uridecode_elem.pads():
-                        if "video" in pad.get_caps().to_string():
-                            vpad_added = self._handle_video_pad_added(uridecode_elem, pad, video_pads)
-                            if vpad_added:
-                                video_pads += 1
-                        elif "audio" in pad.get_caps().to_string():
-                            apad_added = self._handle_audio_pad_added(uridecode_elem, pad, audio_pads)
-                            if apad_added:
-                                audio_pads += 1
+                        caps = pad.get_caps().to_string()
+                        if "video" in caps:
+                            kind = "video"
+                        elif "audio" in caps:
+                            kind = "audio"
+                        else:
+                            continue
+                        
+                        # Streams skipped in _cb_autoplug_continue come out
+                        # still encoded
+                        added = False
+                        if "x-raw" in caps and \
+                           self._want_stream(kind, raw_index[kind]):
+                            if kind == "video":
+                                added = self._handle_video_pad_added(uridecode_elem, pad, video_pads)
+                                if added:
+                                    video_pads += 1
+                            else:
+                                added = self._handle_audio_pad_added(uridecode_elem, pad, audio_pads)
+                                if added:
+                                    audio_pads += 1
+                        if "x-raw" in caps:
+                            raw_index[kind] += 1
+                        if not added:
+                            self._link_unused_pad(pad)
 
                     # remove timeout id - error after this is error in start
                     if self._timeoutid:
@@ -1018,8 +1937,26 @@ class Transcoder(gobject.GObject):
                     for pad in uridecode_elem.pads():
                         pad.set_blocked_async(False, self._cb_unblocked)
 
+                    tracing.complete("link", self.trace_track, start,
+                                     video_pads=video_pads,
+                                     audio_pads=audio_pads)
+                    self._trace_pass = tracing.now()
+
                     if (audio_pads + video_pads) > 0:
+                        if self.options.profile:
+                            self.profiler = profiler.PipelineProfiler(self.pipe)
+                            self.profiler.start()
+                        if self.options.stall_timeout:
+                            self.watchdog = watchdog.Watchdog(self.pipe,
+                                                self.options.output_uri,
+                                                self.options.stall_timeout,
+                                                self._cb_stalled,
+                                                self._cb_slow)
+                            self.watchdog.start()
                         self.start()
+                        if self.speed_rung is not None and \
+                           not self._speed_measured:
+                            gobject.timeout_add(1000, self._cb_check_speed)
                         self.emit("pass-setup")
                     else:
                         # Send eos - that completes pass and then next pass can be started
@@ -1042,6 +1979,161 @@ class Transcoder(gobject.GObject):
     def _cb_no_app_message_timeout(self):
         self.emit("error", "Pipeline Hanged. No application Message Received", 0)
 
+    def _cb_error(self, transcoder, errorstr, errnum):
+        self._stop_watchdog()
+
+    def _stop_watchdog(self):
+        if self.watchdog:
+            self.watchdog.stop()
+            self.watchdog = None
+
+    def _cb_stalled(self):
+        """
+            Handle a pass that made no progress for stall_timeout seconds.
+            A stalled pass is never ended with an EOS, which would leave a
+            truncated output that looks complete. Instead it is restarted,
+            either on its own or together with all previous passes, and the
+            output is rewritten from the start.
+        """
+        action = self.options.stall_action
+        tracing.instant("stalled", self.trace_track, action=action)
+        if action == "warn":
+            return True
+
+        self.watchdog = None
+        if self.stall_restarts >= _MAX_STALL_RESTARTS:
+            self.stop()
+            self.emit("error", _("Pipeline stalled %(count)d times, giving " \
+                                 "up") % {
+                "count": self.stall_restarts + 1,
+            }, 0)
+            return False
+
+        self.stall_restarts += 1
+        enc_pass = action == "retry" and 0 or self.enc_pass
+        _log.warning(_("Pipeline stalled, restarting pass %(pass)d") % {
+            "pass": enc_pass + 1,
+        })
+        self._restart_pass("stalled", enc_pass)
+        return False
+
+    def _cb_slow(self, slow):
+        """
+            Report a pass that still makes progress, but far slower than
+            realtime, and when it has sped up again.
+        """
+        tracing.instant(slow and "slow" or "running", self.trace_track)
+        if slow:
+            _log.warning(_("Pass %(pass)d is running at less than " \
+                           "%(factor).1fx realtime") % {
+                "pass": self.enc_pass + 1,
+                "factor": watchdog.SLOW_FACTOR,
+            })
+        else:
+            _log.info(_("Pass %(pass)d is no longer slow") % {
+                "pass": self.enc_pass + 1,
+            })
+
+    def _restart_pass(self, reason, enc_pass=None):
+        """
+            Throw away the running pass and set up a pass again. The output
+            is rewritten from the start. The abandoned attempt is recorded
+            on the trace timeline and reported with the pass-abandoned
+            signal, so the time spent on it isn't lost.
+            
+            @type reason: str
+            @param reason: Why the pass is thrown away
+            @type enc_pass: int
+            @param enc_pass: The pass to run next (default: the same one)
+        """
+        self._stop_watchdog()
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler = None
+        tracing.complete("pass %d (abandoned)" % (self.enc_pass + 1),
+                         self.trace_track, self._trace_pass, reason=reason)
+        self.emit("pass-abandoned", reason)
+        self._teardown_pipeline()
+        if enc_pass is not None:
+            self.enc_pass = enc_pass
+        try:
+            self._setup_pass_traced()
+        except PipelineException, e:
+            self.emit("error", str(e), 0)
+            return
+        self.pause()
+
+    def _teardown_pipeline(self):
+        """
+            Stop listening to the current pipeline and shut it down before
+            a new one replaces it.
+        """
+        if self._timeoutid:
+            gobject.source_remove(self._timeoutid)
+            self._timeoutid = None
+        if not self.pipe:
+            return
+        bus = self.pipe.get_bus()
+        if self._bus_watch is not None:
+            bus.disconnect(self._bus_watch)
+            self._bus_watch = None
+        bus.remove_signal_watch()
+        self.pipe.set_state(gst.STATE_NULL)
+        self.pipe = None
+
+    def _cb_check_speed(self):
+        """
+            Measure the realtime factor of the first part of the encode and
+            pick the encoder speed setting that meets the deadline. If it
+            differs from the measured one, the current pass starts over with
+            it. Completed passes are kept. The time spent on the discarded
+            part is reported with pass-abandoned, and as it has already
+            passed it is no longer in the budget until the deadline.
+        """
+        if not self.pipe or self._speed_measured:
+            return False
+        if self.state != gst.STATE_PLAYING:
+            return True
+        
+        try:
+            pos = self.pipe.query_position(gst.FORMAT_TIME)[0]
+        except gst.QueryError:
+            return True
+        
+        elapsed = time.time() - self.start_time
+        done = max(pos - self._start_ns, 0) / float(gst.SECOND)
+        if elapsed < _SPEED_SAMPLE_TIME and \
+           done < self.output_duration * _SPEED_SAMPLE_FRACTION:
+            return True
+        
+        self._speed_measured = True
+        if not done or not elapsed:
+            return False
+        
+        ladder = speed.get_ladder(self.preset.vcodec.name)
+        restart = self.output_duration * \
+                  (self.options.pass_count - self.enc_pass)
+        remaining = restart - done
+        measured = self.speed_rung
+        self.speed_rung = speed.choose(ladder, measured, done / elapsed,
+                                       remaining, restart,
+                                       self.options.deadline - time.time())
+        tracing.instant("speed", self.trace_track,
+                        realtime=done / elapsed,
+                        settings=ladder[self.speed_rung][1])
+        if self.speed_rung != measured:
+            _log.info(_("Encoding at %(realtime).2fx realtime, restarting " \
+                        "pass %(pass)d with %(settings)s to meet the " \
+                        "deadline, discarding %(elapsed).1f seconds of " \
+                        "encoding") % {
+                "realtime": done / elapsed,
+                "pass": self.enc_pass + 1,
+                "settings": ladder[self.speed_rung][1],
+                "elapsed": elapsed,
+            })
+            self._restart_pass("speed")
+        return False
+
     def start(self, reset_timer=True):
         """
             Start the pipeline!
@@ -1060,6 +2152,7 @@ class Transcoder(gobject.GObject):
         """
             Stop the pipeline!
         """
+        self._stop_watchdog()
         self.state = gst.STATE_NULL
 
     def get_state(self):
@@ -1102,7 +2195,6 @@ class Transcoder(gobject.GObject):
             @return: A tuple of percent, time_rem
         """
         start, stop = self.options.start_time, self.options.stop_time
-        duration = max(self.info.videolength, self.info.audiolength)
         
         duration = self.output_duration * gst.SECOND
         if not duration or duration < 0:
@@ -1120,15 +2212,19 @@ class Transcoder(gobject.GObject):
         if percent <= 0.0:
             return 0.0, _("Unknown")
         
-        if self._percent_cached == percent and time.time() - self._percent_cached_time > 5:
-            self.pipe.post_message(gst.message_new_eos(self.pipe))
+        # Extrapolate the current pass to all remaining passes
+        now = time.time()
+        pass_total = 1.0 / percent * (now - self.start_time)
+        remaining = self.options.pass_count - self.enc_pass - percent
+        rem = pass_total * remaining
         
-        if self._percent_cached != percent:
-            self._percent_cached = percent
-            self._percent_cached_time = time.time()
+        if self.estimate:
+            # Trust past jobs at the start and the measured speed as the
+            # job gets closer to completion
+            progress = (self.enc_pass + percent) / self.options.pass_count
+            estimated = max(self.estimate - (now - self.job_start), 0)
+            rem = (1.0 - progress) * estimated + progress * rem
         
-        total = 1.0 / percent * (time.time() - self.start_time)
-        rem = total - (time.time() - self.start_time)
         min = rem / 60
         sec = rem % 60
         
@@ -145,6 +145,30 @@ def get_friendly_time(seconds):
       "seconds": seconds,
    }
 
+def write_buffer(filename, buffer):
+    """
+        Write the contents of a GStreamer buffer to a file. The buffer is
+        passed to the file through the buffer interface, so its data isn't
+        copied into a Python string first. Builds of pygst whose buffers
+        don't provide the interface aren't supported.
+        
+        @type filename: str
+        @param filename: The path of the file to write
+        @type buffer: gst.Buffer
+        @param buffer: The buffer to write
+        @rtype: int
+        @return: The number of bytes written
+        @raise IOError: The file cannot be written
+        @raise TypeError: The buffer doesn't provide the buffer interface
+    """
+    out = open(filename, "wb")
+    try:
+        out.write(buffer)
+    finally:
+        out.close()
+    
+    return buffer.size
+
 def generate_output_path(filename, preset, to_be_created=[],
                          device_name=""):
     """
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+    Arista Watchdog
+    ===============
+    Watch a running transcode pass for signs of life: the pipeline
+    position, the size of the output file and buffers reaching the muxer.
+    A pass where any of these keeps moving is only slow, one where none of
+    them has moved for a while is stalled and gets handled by the
+    transcoder according to its stall action.
+
+    License
+    -------
+    Copyright 2011 Daniel G. Taylor <dan@programmer-art.org>
+
+    This file is part of Arista.
+
+    Arista is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as
+    published by the Free Software Foundation, either version 2.1 of
+    the License, or (at your option) any later version.
+
+    Arista is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with Arista.  If not, see
+    <http://www.gnu.org/licenses/>.
+"""
+
+import gettext
+import logging
+import os
+import time
+
+import gobject
+import gst
+
+_ = gettext.gettext
+_log = logging.getLogger("arista.watchdog")
+
+# What to do with a stalled pass: log a warning and keep waiting, restart
+# the pass, or stop the job and run it again from the first pass
+ACTIONS = ["warn", "restart", "retry"]
+
+# How often the pass is checked, in milliseconds
+CHECK_INTERVAL = 1000
+
+# Realtime factor below which a pass that is still moving counts as slow
+SLOW_FACTOR = 0.1
+
+# States of a watched pass
+RUNNING = "running"
+SLOW = "slow"
+STALLED = "stalled"
+
+class Watchdog(object):
+    """
+        Check a pass every CHECK_INTERVAL milliseconds from the main loop
+        and call a function once it has stalled, and optionally another
+        one when it becomes slow or speeds up again. Time spent while the
+        pipeline isn't playing, e.g. when paused by the user, never counts
+        towards a stall.
+    """
+    def __init__(self, pipe, output, timeout, callback, slow_callback=None):
+        """
+            @type pipe: gst.Pipeline
+            @param pipe: The linked transcode pipeline
+            @type output: str
+            @param output: The output filename
+            @type timeout: int
+            @param timeout: Seconds without any progress before the pass
+                            is stalled
+            @type callback: callable
+            @param callback: Called without arguments when the pass stalls,
+                             returns whether to keep watching it
+            @type slow_callback: callable
+            @param slow_callback: Called with True when the pass runs slower
+                                  than SLOW_FACTOR times realtime and with
+                                  False when it is faster again
+        """
+        self.pipe = pipe
+        self.output = output
+        self.timeout = timeout
+        self.callback = callback
+        self.slow_callback = slow_callback
+        self.state = RUNNING
+        self.slow = False
+        self.buffers = 0
+        self._position = None
+        self._size = None
+        self._buffers = 0
+        self._progress = None
+        self._rate_start = None
+        self._timeout_id = None
+
+        mux = pipe.get_by_name("mux")
+        if mux:
+            mux.get_pad("src").add_buffer_probe(self._buffer_probe)
+
+    def _buffer_probe(self, pad, buffer):
+        self.buffers += 1
+        return True
+
+    def start(self):
+        """
+            Start watching the pass.
+        """
+        self._progress = time.time()
+        self._timeout_id = gobject.timeout_add(CHECK_INTERVAL, self._check)
+
+    def stop(self):
+        """
+            Stop watching the pass.
+        """
+        if self._timeout_id:
+            gobject.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def _get_position(self):
+        try:
+            return self.pipe.query_position(gst.FORMAT_TIME)[0]
+        except gst.QueryError:
+            return None
+
+    def _get_size(self):
+        try:
+            return os.path.getsize(self.output)
+        except (OSError, TypeError):
+            return None
+
+    def _check(self):
+        now = time.time()
+        if self.pipe.get_state(0)[1] != gst.STATE_PLAYING:
+            self._progress = now
+            self._rate_start = None
+            return True
+
+        position = self._get_position()
+        size = self._get_size()
+        moved = position != self._position or size != self._size or \
+                self.buffers != self._buffers
+
+        if self._rate_start is None and position is not None:
+            self._rate_start = (now, position)
+
+        if moved:
+            self._progress = now
+            self._position = position
+            self._size = size
+            self._buffers = self.buffers
+            slow = self._is_slow(now, position)
+            if slow != self.slow and self.slow_callback:
+                self.slow_callback(slow)
+            self.slow = slow
+            self.state = slow and SLOW or RUNNING
+            return True
+
+        if now - self._progress < self.timeout:
+            return True
+
+        _log.warning(_("No progress for %(seconds)d seconds at %(position)s") % {
+            "seconds": now - self._progress,
+            "position": position is not None and \
+                        "%.1fs" % (position / float(gst.SECOND)) or _("unknown"),
+        })
+        self.state = STALLED
+        if self.callback():
+            # Keep watching and warn again after another timeout
+            self._progress = now
+            return True
+        self._timeout_id = None
+        return False
+
+    def _is_slow(self, now, position):
+        if self._rate_start is None or position is None:
+            return False
+        start, start_position = self._rate_start
+        if now - start < self.timeout:
+            return False
+        encoded = (position - start_position) / float(gst.SECOND)
+        return encoded / (now - start) < SLOW_FACTOR
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+
+"""
+	Arista Benchmark
+	================
+	Generate deterministic test media with videotestsrc and audiotestsrc at
+	several resolutions and durations, transcode it with every preset and
+	record how fast each one runs as JSON. Everything runs locally, no
+	network access or GPU is needed.
+
+	Each transcode runs in its own process so that its peak memory use can be
+	measured. For every run the results contain:
+
+		- realtime_factor: seconds of media encoded per wall clock second
+		- time_to_first_frame: seconds from start until the first buffer
+		  reaches the output file
+		- peak_rss: peak resident memory of the process in kilobytes
+		- output_bytes: size of the output file
+
+	Usage:
+
+		./utils/benchmark.py -o benchmark.json
+		./utils/benchmark.py -s 640x360 -l 10 -d android -d web
+		./utils/benchmark.py --thumbnails
+
+	Baselines:
+
+		./utils/benchmark.py -n 5 --save-baseline baseline.json
+		./utils/benchmark.py -n 5 --compare baseline.json
+
+	With --compare a table of changes per job and metric is printed, and the
+	exit status is 1 if any job got significantly slower. A change counts as
+	significant when it is larger than both --threshold and three times the
+	noise measured over the repeated trials (-n) of both runs.
+"""
+
+import os
+import platform
+import subprocess
+import sys
+import time
+
+try:
+	import json
+except ImportError:
+	import simplejson as json
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FRAMERATE = 25
+AUDIO_RATE = 44100
+# Audio buffers per second of generated media
+AUDIO_BUFFERS = 100
+
+# Metrics as (name, higher is better, whether getting worse is a failure)
+METRICS = [
+	("realtime_factor", True, True),
+	("time_to_first_frame", False, True),
+	("seconds_per_thumbnail", False, True),
+	("peak_rss", False, False),
+	("output_bytes", False, False),
+]
+
+# How many times the measured noise a change must exceed to count
+NOISE_SIGMAS = 3.0
+
+def generate_input(directory, width, height, duration):
+	"""
+		Generate a Theora/Vorbis test file unless it already exists. The
+		test sources are deterministic, so the same file is generated every
+		time.
+	"""
+	path = os.path.join(directory, "test-%dx%d-%ds.ogg" % (width, height, duration))
+	if os.path.exists(path):
+		return path
+
+	cmd = "gst-launch-0.10 -q videotestsrc pattern=smpte num-buffers=%(frames)d ! " \
+		"video/x-raw-yuv,width=%(width)d,height=%(height)d,framerate=%(rate)d/1 ! " \
+		"theoraenc ! queue ! oggmux name=mux ! filesink location=%(tmp)s " \
+		"audiotestsrc wave=sine num-buffers=%(buffers)d samplesperbuffer=%(samples)d ! " \
+		"audio/x-raw-int,rate=%(arate)d,channels=2 ! audioconvert ! vorbisenc ! " \
+		"queue ! mux." % {
+			"frames": duration * FRAMERATE,
+			"width": width,
+			"height": height,
+			"rate": FRAMERATE,
+			"tmp": path + ".tmp",
+			"buffers": duration * AUDIO_BUFFERS,
+			"samples": AUDIO_RATE / AUDIO_BUFFERS,
+			"arate": AUDIO_RATE,
+		}
+
+	if subprocess.call(cmd, shell=True):
+		raise SystemExit("Unable to generate %s" % path)
+
+	os.rename(path + ".tmp", path)
+	return path
+
+def get_presets(devices=None):
+	"""
+		Get (device id, preset name) tuples for every installed preset,
+		optionally limited to some devices.
+	"""
+	import arista
+	arista.init()
+
+	found = []
+	for id, device in sorted(arista.presets.get().items()):
+		if devices and id not in devices:
+			continue
+		for name in sorted(device.presets.keys()):
+			found.append((id, name))
+	return found
+
+def run_child(args, timeout):
+	"""
+		Run this script in a child process and return its result and peak
+		memory use in kilobytes.
+	"""
+	resultfile = os.path.join(os.path.dirname(args[-1]) or ".", ".benchmark-%d.json" % os.getpid())
+	cmd = [sys.executable, os.path.abspath(__file__)] + args + [resultfile]
+
+	devnull = open(os.devnull, "w")
+	proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+	start = time.time()
+	while True:
+		pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+		if pid:
+			break
+		if time.time() - start > timeout:
+			os.kill(proc.pid, 9)
+			pid, status, usage = os.wait4(proc.pid, 0)
+			break
+		time.sleep(0.05)
+	devnull.close()
+
+	result = {"success": False}
+	if os.path.exists(resultfile):
+		result = json.loads(open(resultfile).read())
+		os.remove(resultfile)
+
+	# ru_maxrss is in kilobytes on Linux
+	result["peak_rss"] = usage.ru_maxrss
+	result["exit_status"] = status
+	return result
+
+def run_transcode(device, preset, infile, duration, outfile, timeout):
+	"""
+		Transcode one file in a child process and collect its results.
+	"""
+	if os.path.exists(outfile):
+		os.remove(outfile)
+
+	result = run_child(["--run-one", device, preset, infile, outfile], timeout)
+
+	result["output_bytes"] = 0
+	result["realtime_factor"] = None
+	if result["success"] and os.path.exists(outfile):
+		result["output_bytes"] = os.path.getsize(outfile)
+		result["realtime_factor"] = duration / result["wall_time"]
+	return result
+
+def run_thumbnails(infile, output_dir, timeout):
+	"""
+		Create thumbnails of one file in a child process and collect its
+		results.
+	"""
+	if not os.path.exists(output_dir):
+		os.makedirs(output_dir)
+
+	result = run_child(["--run-thumbnails", infile, output_dir], timeout)
+	if result.get("thumbnails"):
+		result["seconds_per_thumbnail"] = result["elapsed"] / result["thumbnails"]
+	return result
+
+def _run_one(device, preset_name, infile, outfile, resultfile):
+	"""
+		Child process: transcode a file and write the timing results.
+	"""
+	import gobject
+	gobject.threads_init()
+
+	import arista
+	arista.init()
+
+	from arista.transcoder import Transcoder, TranscoderOptions
+
+	preset = arista.presets.get()[device].presets[preset_name]
+	result = {
+		"success": False,
+		"time_to_first_frame": None,
+	}
+	start = time.time()
+
+	def _first_buffer(pad, buffer):
+		if result["time_to_first_frame"] is None:
+			result["time_to_first_frame"] = time.time() - start
+		return True
+
+	def _pass_setup(transcoder):
+		sink = transcoder.pipe.get_by_name("sink")
+		if sink and transcoder.enc_pass == transcoder.options.pass_count - 1:
+			sink.get_pad("sink").add_buffer_probe(_first_buffer)
+
+	def _complete(transcoder):
+		result["success"] = True
+		loop.quit()
+
+	def _error(transcoder, errorstr, errnum=0):
+		result["error"] = str(errorstr)
+		loop.quit()
+
+	def _discovered(transcoder, info, is_media):
+		if not is_media:
+			_error(transcoder, "Not a recognized media file!")
+
+	transcoder = Transcoder(TranscoderOptions(infile, preset, outfile))
+	transcoder.connect("discovered", _discovered)
+	transcoder.connect("pass-setup", _pass_setup)
+	transcoder.connect("complete", _complete)
+	transcoder.connect("error", _error)
+
+	loop = gobject.MainLoop()
+	loop.run()
+	transcoder.stop()
+
+	result["wall_time"] = time.time() - start
+	open(resultfile, "w").write(json.dumps(result))
+
+def _run_thumbnails(infile, output_dir, resultfile):
+	"""
+		Child process: create thumbnails of a file and write the results.
+	"""
+	import gobject
+	gobject.threads_init()
+
+	import arista
+	arista.init()
+
+	from arista.thumbnailer import Thumbnailer
+
+	thumbnailer = Thumbnailer(infile, output_dir, number=20)
+	result = {
+		"success": thumbnailer.create_thumbnails(),
+	}
+	result.update(thumbnailer.stats)
+	open(resultfile, "w").write(json.dumps(result))
+
+def _median(values):
+	values = sorted(values)
+	middle = len(values) // 2
+	if len(values) % 2:
+		return values[middle]
+	return (values[middle - 1] + values[middle]) / 2.0
+
+def aggregate(trials):
+	"""
+		Combine repeated trials of a job into one result. Each metric is the
+		median of the trials, and metric_noise is a robust estimate of its
+		standard deviation (scaled median absolute deviation).
+	"""
+	result = dict(trials[-1])
+	result["trials"] = trials
+	result["success"] = bool([t for t in trials if t.get("success")])
+
+	for name, higher, fails in METRICS:
+		values = [t[name] for t in trials if t.get("success") and t.get(name) is not None]
+		if not values:
+			continue
+		median = _median(values)
+		result[name] = median
+		result[name + "_noise"] = 1.4826 * _median([abs(v - median) for v in values])
+	return result
+
+def get_key(result):
+	"""
+		Get a name that identifies the same job across runs.
+	"""
+	size = "%(width)dx%(height)d-%(duration)ds" % result["input"]
+	if result.get("device"):
+		return "%s/%s %s" % (result["device"], result["preset"], size)
+	return "thumbnails %s" % size
+
+def compare(baseline, current, threshold):
+	"""
+		Print a table comparing two reports and return the number of
+		significant regressions in metrics that fail the run.
+	"""
+	old = dict([(get_key(r), r) for r in baseline["results"]])
+	rows = []
+	regressions = 0
+
+	for result in current["results"]:
+		key = get_key(result)
+		if key not in old:
+			rows.append((key, "-", "-", "-", "-", "new"))
+			continue
+		before = old[key]
+
+		if before.get("success") and not result.get("success"):
+			rows.append((key, "success", "yes", "no", "-", "FAILED"))
+			regressions += 1
+			continue
+
+		for name, higher, fails in METRICS:
+			b, c = before.get(name), result.get(name)
+			if b is None or c is None:
+				continue
+
+			noise = (before.get(name + "_noise", 0) ** 2 + \
+					 result.get(name + "_noise", 0) ** 2) ** 0.5
+			change = b and (c - b) / float(b) or 0.0
+			significant = abs(c - b) > max(threshold * abs(b), NOISE_SIGMAS * noise)
+
+			flag = ""
+			if significant:
+				worse = higher and c < b or not higher and c > b
+				if worse and fails:
+					flag = "SLOWER"
+					regressions += 1
+				elif worse:
+					flag = "worse"
+				else:
+					flag = "better"
+
+			rows.append((key, name, "%.3f" % b, "%.3f" % c, "%+.1f%%" % (change * 100), flag))
+
+	widths = [max([len(row[x]) for row in rows] + [8]) for x in range(6)]
+	header = ("Job", "Metric", "Baseline", "Current", "Change", "")
+	for row in [header] + rows:
+		print "  ".join([row[x].ljust(widths[x]) for x in range(6)]).rstrip()
+
+	missing = [key for key in old if key not in [get_key(r) for r in current["results"]]]
+	for key in sorted(missing):
+		print "%s: not in this run" % key
+
+	return regressions
+
+def parse_sizes(value):
+	return [tuple([int(x) for x in size.split("x")]) for size in value.split(",")]
+
+if __name__ == "__main__":
+	# GStreamer parses sys.argv when it is imported, so child arguments are
+	# taken off first
+	if len(sys.argv) > 1 and sys.argv[1] == "--run-one":
+		args, sys.argv = sys.argv[2:], sys.argv[:1]
+		_run_one(*args)
+		raise SystemExit()
+	elif len(sys.argv) > 1 and sys.argv[1] == "--run-thumbnails":
+		args, sys.argv = sys.argv[2:], sys.argv[:1]
+		_run_thumbnails(*args)
+		raise SystemExit()
+
+	parser = OptionParser(usage = "%prog [options]")
+	parser.add_option("-s", "--sizes", dest = "sizes",
+					  default = "320x240,640x360,1280x720",
+					  help = "Input resolutions [320x240,640x360,1280x720]")
+	parser.add_option("-l", "--lengths", dest = "lengths", default = "10,30",
+					  help = "Input durations in seconds [10,30]")
+	parser.add_option("-d", "--device", dest = "devices", default = [],
+					  action = "append",
+					  help = "Only benchmark this device, can be repeated [all]")
+	parser.add_option("-i", "--input-dir", dest = "input_dir",
+					  default = "benchmark_input",
+					  help = "Directory for generated inputs [benchmark_input]")
+	parser.add_option("-w", "--work-dir", dest = "work_dir",
+					  default = "benchmark_output",
+					  help = "Directory to write outputs to [benchmark_output]")
+	parser.add_option("-o", "--output", dest = "output", default = None,
+					  help = "Write JSON results to this file [stdout]")
+	parser.add_option("-t", "--timeout", dest = "timeout", default = 600,
+					  type = int,
+					  help = "Seconds before a run is killed [600]")
+	parser.add_option("--thumbnails", dest = "thumbnails", default = False,
+					  action = "store_true",
+					  help = "Benchmark thumbnail creation instead of presets")
+	parser.add_option("-n", "--trials", dest = "trials", default = 1,
+					  type = int,
+					  help = "Number of times to run each job [1]")
+	parser.add_option("--save-baseline", dest = "save_baseline",
+					  default = None, metavar = "FILE",
+					  help = "Save this run as a baseline to compare against")
+	parser.add_option("--compare", dest = "compare", default = None,
+					  metavar = "FILE",
+					  help = "Compare this run against a saved baseline")
+	parser.add_option("--threshold", dest = "threshold", default = 5.0,
+					  type = float,
+					  help = "Smallest change in percent that counts as a " \
+							 "regression [5]")
+
+	options, args = parser.parse_args()
+
+	for directory in [options.input_dir, options.work_dir]:
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	inputs = []
+	for width, height in parse_sizes(options.sizes):
+		for duration in [int(x) for x in options.lengths.split(",")]:
+			path = generate_input(options.input_dir, width, height, duration)
+			inputs.append((path, width, height, duration))
+
+	results = []
+	for path, width, height, duration in inputs:
+		name = os.path.splitext(os.path.basename(path))[0]
+		if options.thumbnails:
+			jobs = [(None, None)]
+		else:
+			jobs = get_presets(options.devices)
+
+		for device, preset in jobs:
+			trials = []
+			for trial in range(max(options.trials, 1)):
+				if device:
+					sys.stderr.write("%s: %s (%s)\n" % (name, device, preset))
+					outfile = os.path.join(options.work_dir, "%s-%s-%s.out" % (name, device, preset.replace(" ", "_").replace("/", "_")))
+					trials.append(run_transcode(device, preset, path, duration, outfile, options.timeout))
+				else:
+					sys.stderr.write("%s: thumbnails\n" % name)
+					trials.append(run_thumbnails(path, os.path.join(options.work_dir, name), options.timeout))
+
+			result = aggregate(trials)
+			if device:
+				result["device"] = device
+				result["preset"] = preset
+
+			result["input"] = {
+				"width": width,
+				"height": height,
+				"duration": duration,
+			}
+			results.append(result)
+
+	report = {
+		"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"host": {
+			"platform": platform.platform(),
+			"processor": platform.processor(),
+			"python": platform.python_version(),
+		},
+		"results": results,
+	}
+
+	data = json.dumps(report, indent = 4, sort_keys = True)
+	if options.save_baseline:
+		open(options.save_baseline, "w").write(data)
+	if options.output:
+		open(options.output, "w").write(data)
+	elif not options.save_baseline and not options.compare:
+		print data
+
+	if options.compare:
+		baseline = json.loads(open(options.compare).read())
+		regressions = compare(baseline, report, options.threshold / 100.0)
+		if regressions:
+			print
+			print "%d significant regressions" % regressions
+			raise SystemExit(1)
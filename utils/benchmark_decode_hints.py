@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""
+	Benchmark Arista Decode Hints
+	=============================
+	Transcode the same files with and without --decode-hints and report the
+	wall clock time and output size of both, so the speedup can be weighed
+	against any quality loss.
+
+	Quality is measured by decoding both outputs at the same positions and
+	comparing the luma of the hinted output against the output made with a
+	full decode, as PSNR in dB and mean SSIM. Identical frames give an
+	infinite PSNR and an SSIM of 1. This needs numpy, use --no-quality to
+	skip it.
+
+	Usage:
+
+		./utils/benchmark_decode_hints.py -d android -p "Nexus One / Desire" \
+			tests/test.mp4
+"""
+
+import math
+import os
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Stabilising constants from the SSIM paper for 8-bit samples
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+# SSIM is computed over non-overlapping windows of this size
+_SSIM_WINDOW = 8
+
+def run(infile, outfile, options, hints):
+	cmd = ["./arista-transcode", "-q", "-d", options.device, "-o", outfile]
+	if options.preset:
+		cmd += ["-p", options.preset]
+	if hints:
+		cmd.append("--decode-hints")
+	cmd.append(infile)
+
+	if os.path.exists(outfile):
+		os.remove(outfile)
+
+	start = time.time()
+	ret = subprocess.call(cmd)
+	elapsed = time.time() - start
+
+	if ret or not os.path.exists(outfile):
+		return None, 0
+
+	return elapsed, os.path.getsize(outfile)
+
+def psnr(reference, frame):
+	"""
+		Get the peak signal to noise ratio of a luma frame in dB.
+	"""
+	error = ((reference.astype(float) - frame) ** 2).mean()
+	if not error:
+		return float("inf")
+	return 10 * math.log10(255.0 ** 2 / error)
+
+def ssim(reference, frame):
+	"""
+		Get the mean structural similarity of a luma frame, averaged over
+		square windows.
+	"""
+	size = _SSIM_WINDOW
+	height = reference.shape[0] - reference.shape[0] % size
+	width = reference.shape[1] - reference.shape[1] % size
+
+	def windows(data):
+		data = data[:height, :width].astype(float)
+		data = data.reshape(height / size, size, width / size, size)
+		return data.swapaxes(1, 2).reshape(height / size, width / size,
+										   size * size)
+
+	x, y = windows(reference), windows(frame)
+	mean_x, mean_y = x.mean(axis = 2), y.mean(axis = 2)
+	var_x, var_y = x.var(axis = 2), y.var(axis = 2)
+	covar = (x * y).mean(axis = 2) - mean_x * mean_y
+
+	scores = ((2 * mean_x * mean_y + _SSIM_C1) * (2 * covar + _SSIM_C2)) / \
+			 ((mean_x ** 2 + mean_y ** 2 + _SSIM_C1) * (var_x + var_y + _SSIM_C2))
+	return scores.mean()
+
+def compare(reference, outfile, samples, width, height):
+	"""
+		Decode two files at the same evenly spaced positions and compare
+		their luma. Returns the mean PSNR and SSIM of the second file
+		against the first, or (None, None) if they can't be decoded.
+	"""
+	from arista import analysis
+	from arista.discoverer import Discoverer
+
+	info = Discoverer(reference)
+	info.do_discovery()
+	if not info.is_video or info.videolength <= 0:
+		return None, None
+
+	samplers = []
+	try:
+		for filename in [reference, outfile]:
+			sampler = analysis.FrameSampler("file://" + os.path.abspath(filename), width, height)
+			sampler.open()
+			samplers.append(sampler)
+
+		psnrs, ssims = [], []
+		for x in range(samples):
+			position = info.videolength * (2 * x + 1) / (2 * samples)
+			frames = [sampler.sample(position, accurate = True) for sampler in samplers]
+			if not frames[0] or not frames[1]:
+				continue
+			psnrs.append(psnr(frames[0][0][1], frames[1][0][1]))
+			ssims.append(ssim(frames[0][0][1], frames[1][0][1]))
+	except analysis.AnalysisException:
+		return None, None
+	finally:
+		for sampler in samplers:
+			sampler.close()
+
+	if not psnrs:
+		return None, None
+
+	return sum(psnrs) / len(psnrs), sum(ssims) / len(ssims)
+
+if __name__ == "__main__":
+	parser = OptionParser(usage = "%prog [options] infile [infile ...]")
+	parser.add_option("-d", "--device", dest = "device", default = "android",
+					  help = "Device to encode to [android]")
+	parser.add_option("-p", "--preset", dest = "preset", default = None,
+					  help = "Preset to encode to [default]")
+	parser.add_option("-r", "--runs", dest = "runs", default = 3, type = int,
+					  help = "Number of runs per file and mode [3]")
+	parser.add_option("-o", "--output-dir", dest = "output_dir",
+					  default = "test_output",
+					  help = "Directory to write outputs to [test_output]")
+	parser.add_option("-s", "--samples", dest = "samples", default = 10,
+					  type = int,
+					  help = "Number of frames to compare per file [10]")
+	parser.add_option("--quality-size", dest = "quality_size",
+					  default = "320x240",
+					  help = "Size frames are scaled to for the quality " \
+							 "comparison [320x240]")
+	parser.add_option("--no-quality", dest = "quality", default = True,
+					  action = "store_false",
+					  help = "Only compare speed, not quality")
+
+	options, args = parser.parse_args()
+
+	if not args:
+		parser.print_help()
+		raise SystemExit(1)
+
+	# GStreamer parses sys.argv when it is imported
+	sys.argv = sys.argv[:1]
+	if options.quality:
+		import gobject
+		gobject.threads_init()
+
+		from arista import analysis
+		if not analysis.available():
+			print "numpy is not installed, not comparing quality"
+			options.quality = False
+
+	width, height = [int(x) for x in options.quality_size.split("x")]
+
+	if not os.path.exists(options.output_dir):
+		os.makedirs(options.output_dir)
+
+	print "%-30s %12s %12s %12s %12s %8s %10s %6s" % ("File", "Normal (s)",
+		"Hints (s)", "Normal (B)", "Hints (B)", "Speedup", "PSNR (dB)",
+		"SSIM")
+
+	for infile in args:
+		name = os.path.splitext(os.path.basename(infile))[0]
+		results = {}
+		outfiles = {}
+		for hints in [False, True]:
+			outfile = os.path.join(options.output_dir, "%s-%s.out" % (name,
+				hints and "hints" or "normal"))
+			outfiles[hints] = outfile
+			times = []
+			size = 0
+			for x in range(options.runs):
+				elapsed, size = run(infile, outfile, options, hints)
+				if elapsed is None:
+					break
+				times.append(elapsed)
+
+			# Use the fastest run to reduce noise from other processes
+			results[hints] = (times and min(times) or None, size)
+
+		normal, hinted = results[False], results[True]
+		if normal[0] is None or hinted[0] is None:
+			print "%-30s failed" % os.path.basename(infile)
+			continue
+
+		quality = "%10s %6s" % ("-", "-")
+		if options.quality:
+			mean_psnr, mean_ssim = compare(outfiles[False], outfiles[True],
+										   options.samples, width, height)
+			if mean_psnr is not None:
+				quality = "%10.2f %6.4f" % (mean_psnr, mean_ssim)
+
+		print "%-30s %12.2f %12.2f %12d %12d %7.2fx %s" % (
+			os.path.basename(infile), normal[0], hinted[0], normal[1],
+			hinted[1], normal[0] / hinted[0], quality)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+"""
+	Arista Unit Tests
+	=================
+	Small deterministic tests of the parts of Arista that don't need any
+	media files: source analysis on synthetic frames, encoder speed choice,
+	time estimates, the metadata cache, preset ladders, streaming playlists
+	and benchmark comparisons. Analysis tests are skipped without numpy.
+
+	Usage:
+
+		./utils/unit_tests.py
+		./utils/unit_tests.py -v SpeedTest
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+from StringIO import StringIO
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# GStreamer parses sys.argv when it is imported
+args, sys.argv = sys.argv[1:], sys.argv[:1]
+
+import gst
+
+import arista; arista.init()
+from arista import analysis, cache, history, ladder, presets, speed
+
+import benchmark
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+def gradient(height, width, offset=0):
+	"""
+		A progressive frame that gets brighter from left to right.
+	"""
+	row = numpy.linspace(0, 150, width).astype(numpy.uint8)
+	return numpy.tile(row, (height, 1)) + offset
+
+def interlaced(height, width, offset=0):
+	"""
+		A frame whose odd lines come from a much brighter field.
+	"""
+	frame = numpy.zeros((height, width), numpy.uint8) + 50 + offset
+	frame[1::2] += 100
+	return frame
+
+@unittest.skipUnless(analysis.available(), "numpy is not installed")
+class AnalysisTest(unittest.TestCase):
+	def test_comb_scores(self):
+		scores = analysis.comb_scores([gradient(32, 32), interlaced(32, 32)])
+		self.assertEqual(scores[0], 0.0)
+		self.assertEqual(scores[1], 1.0)
+		self.assertFalse(analysis.is_combed(gradient(32, 32)))
+		self.assertTrue(analysis.is_combed(interlaced(32, 32)))
+
+	def test_telecine(self):
+		pulldown = [True, True, False, False, False] * 4
+		self.assertTrue(analysis.detect_telecine([pulldown]))
+		self.assertTrue(analysis.detect_telecine([pulldown[2:] + pulldown[:2]]))
+		self.assertFalse(analysis.detect_telecine([[True] * 20]))
+		self.assertFalse(analysis.detect_telecine([[False] * 20]))
+
+	def test_classify_interlacing(self):
+		progressive = [gradient(32, 32, x * 10) for x in range(5)]
+		combed = [interlaced(32, 32, x * 10) for x in range(5)]
+		static = [interlaced(32, 32)] * 5
+		self.assertEqual(analysis.classify_interlacing([progressive]),
+						 analysis.PROGRESSIVE)
+		self.assertEqual(analysis.classify_interlacing([combed]),
+						 analysis.INTERLACED)
+		self.assertEqual(analysis.classify_interlacing([static]),
+						 analysis.PROGRESSIVE)
+
+	def test_detect_crop(self):
+		frame = numpy.zeros((80, 100), numpy.uint8)
+		frame[10:70, 6:94] = 128
+		self.assertEqual(analysis.detect_crop([frame, frame.copy()]),
+						 (10, 6, 10, 6))
+
+		# Black frames, like fades, don't say anything about borders
+		black = numpy.zeros((80, 100), numpy.uint8)
+		self.assertEqual(analysis.detect_crop([black]), (0, 0, 0, 0))
+
+	def test_scene_changes(self):
+		frames = [(x * gst.SECOND, numpy.zeros((36, 64), numpy.uint8) + \
+				   (x < 5 and 20 or 220)) for x in range(10)]
+		self.assertEqual(analysis.scene_changes(frames),
+						 [(5 * gst.SECOND, 1.0)])
+
+		# Changes closer together than min_interval are one scene change
+		frames = [(x * gst.SECOND / 4, numpy.zeros((36, 64), numpy.uint8) + \
+				   (x % 2 and 220 or 20)) for x in range(4)]
+		self.assertEqual(analysis.scene_changes(frames),
+						 [(gst.SECOND / 4, 1.0)])
+
+class SpeedTest(unittest.TestCase):
+	ladder = [(1.0, "fast"), (2.0, "medium"), (4.0, "slow")]
+
+	def test_slower_when_there_is_time(self):
+		self.assertEqual(speed.choose(self.ladder, 1, 2.0, 100, 100, 1000), 2)
+
+	def test_keep_current(self):
+		self.assertEqual(speed.choose(self.ladder, 1, 2.0, 100, 100, 60), 1)
+
+	def test_restart_cost(self):
+		# Switching to the fastest setting is quick, but starting the pass
+		# over takes longer than finishing it with the current one
+		self.assertEqual(speed.choose(self.ladder, 1, 2.0, 10, 100, 10), 1)
+
+	def test_impossible_deadline(self):
+		self.assertEqual(speed.choose(self.ladder, 1, 2.0, 100, 100, 1), 0)
+
+class HistoryTest(unittest.TestCase):
+	def setUp(self):
+		self.connection = history._connection
+		history._connection = sqlite3.connect(":memory:")
+		history._connection.execute(history._SCHEMA)
+
+	def tearDown(self):
+		history._connection.close()
+		history._connection = self.connection
+
+	def test_estimate(self):
+		self.assertEqual(history.estimate("test", 1000, 1000, 5, 2), None)
+
+		# Seconds per pass per megapixel second of 1, 2 and 3
+		for wall_time in [20, 10, 30]:
+			history.record("test", 1000, 1000, 10, 1, wall_time)
+
+		self.assertEqual(history.estimate("test", 1000, 1000, 5, 2), 20.0)
+		self.assertEqual(history.estimate("test", 500, 500, 5, 1), 2.5)
+		self.assertEqual(history.estimate("other", 1000, 1000, 5, 2), None)
+
+class CacheTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.get_cache_path = cache._get_cache_path
+		cache._get_cache_path = lambda filename: os.path.join(self.dir,
+			os.path.basename(filename) + ".json")
+		self.filename = os.path.join(self.dir, "input.ogg")
+		open(self.filename, "w").write("data")
+
+	def tearDown(self):
+		cache._get_cache_path = self.get_cache_path
+		shutil.rmtree(self.dir)
+
+	def test_store(self):
+		cache.store(self.filename, "scenes", [1, 2])
+		self.assertEqual(cache.get(self.filename, "scenes"), [1, 2])
+		self.assertEqual(cache.get("file://" + self.filename, "scenes"), [1, 2])
+		self.assertEqual(cache.get(self.filename, "discovery"), None)
+
+	def test_size_changed(self):
+		cache.store(self.filename, "scenes", [1, 2])
+		open(self.filename, "a").write("more")
+		self.assertEqual(cache.get(self.filename, "scenes"), None)
+
+	def test_mtime_changed(self):
+		cache.store(self.filename, "scenes", [1, 2])
+		mtime = os.stat(self.filename).st_mtime
+		os.utime(self.filename, (mtime + 10, mtime + 10))
+		self.assertEqual(cache.get(self.filename, "scenes"), None)
+
+	def test_missing_file(self):
+		cache.store("/does/not/exist.ogg", "scenes", [1, 2])
+		self.assertEqual(cache.get("/does/not/exist.ogg", "scenes"), None)
+
+DEVICE = """{
+	"make": "Test",
+	"model": "Device",
+	"default": "Streaming",
+	"presets": [{
+		"name": "Streaming",
+		"container": "mpegtsmux",
+		"extension": "ts",
+		"acodec": {
+			"name": "faac",
+			"container": "audio/mpeg",
+			"rate": [8000, 48000],
+			"passes": [""],
+			"width": [8, 24],
+			"depth": [8, 24],
+			"channels": [1, 2]
+		},
+		"vcodec": {
+			"name": "x264enc",
+			"container": "video/x-h264",
+			"rate": ["1", "30000/1001"],
+			"passes": [""],
+			"width": [2, 1920],
+			"height": [2, 1080]
+		},
+		"ladder": {
+			"segment": 6,
+			"settings": "pass=cbr",
+			"renditions": [
+				{"name": "720p", "height": 720, "bitrate": 2500},
+				{"name": "360p", "height": 360, "bitrate": 800}
+			]
+		}
+	}]
+}"""
+
+class PresetsTest(unittest.TestCase):
+	def check_ladder(self, device):
+		streaming = device.presets["Streaming"].ladder
+		self.assertEqual(streaming.segment, 6)
+		self.assertEqual(streaming.settings, "pass=cbr")
+		self.assertEqual([(r.name, r.height, r.bitrate) for r in streaming.renditions],
+						 [("720p", 720, 2500), ("360p", 360, 800)])
+
+	def test_ladder_round_trip(self):
+		device = presets.Device.from_json(DEVICE)
+		self.check_ladder(device)
+		self.check_ladder(presets.Device.from_json(device.json))
+
+	def test_ladder_defaults(self):
+		device = presets.Device.from_json(DEVICE.replace('"segment": 6,', ""))
+		self.assertEqual(device.presets["Streaming"].ladder.segment, 4)
+
+class LadderTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.renditions = [
+			(presets.Rendition("720p", 720, 2500), 1280, 720),
+			(presets.Rendition("360p", 360, 800), 640, 360),
+		]
+		self.segments = {
+			"720p": [("segment-00000.ts", 4.0, 1000000),
+					 ("segment-00001.ts", 2.0, 250000)],
+			"360p": [],
+		}
+		for rendition, width, height in self.renditions:
+			os.mkdir(os.path.join(self.dir, rendition.name))
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def read(self, *parts):
+		return open(os.path.join(self.dir, *parts)).read().splitlines()
+
+	def test_get_renditions(self):
+		streaming = presets.Ladder(renditions=[r for (r, w, h) in self.renditions])
+		self.assertEqual([(r.name, w, h) for (r, w, h) in \
+						  ladder.get_renditions(streaming, 640, 480)],
+						 [("360p", 480, 360)])
+
+	def test_write_hls(self):
+		ladder.write_hls(self.dir, self.renditions, self.segments)
+
+		# Renditions without segments are left out of the master playlist
+		self.assertEqual(self.read(ladder.MASTER_PLAYLIST), [
+			"#EXTM3U",
+			"#EXT-X-VERSION:3",
+			"#EXT-X-STREAM-INF:BANDWIDTH=2000000,AVERAGE-BANDWIDTH=1666666," \
+			"RESOLUTION=1280x720",
+			"720p/index.m3u8",
+		])
+		self.assertEqual(self.read("720p", ladder.MEDIA_PLAYLIST), [
+			"#EXTM3U",
+			"#EXT-X-VERSION:3",
+			"#EXT-X-TARGETDURATION:4",
+			"#EXT-X-MEDIA-SEQUENCE:0",
+			"#EXT-X-PLAYLIST-TYPE:VOD",
+			"#EXTINF:4.000,",
+			"segment-00000.ts",
+			"#EXTINF:2.000,",
+			"segment-00001.ts",
+			"#EXT-X-ENDLIST",
+		])
+
+	def test_write_dash(self):
+		ladder.write_dash(self.dir, self.renditions, self.segments, 4, 6.0)
+
+		mpd = minidom.parse(os.path.join(self.dir, ladder.DASH_MANIFEST))
+		root = mpd.documentElement
+		self.assertEqual(root.getAttribute("mediaPresentationDuration"), "PT6.000S")
+		self.assertEqual(root.getAttribute("minBufferTime"), "PT4S")
+
+		representations = mpd.getElementsByTagName("Representation")
+		self.assertEqual(len(representations), 1)
+		self.assertEqual([representations[0].getAttribute(name) for name in \
+						  ["id", "bandwidth", "width", "height"]],
+						 ["720p", "2000000", "1280", "720"])
+
+		template = mpd.getElementsByTagName("SegmentTemplate")[0]
+		self.assertEqual(template.getAttribute("duration"), "4")
+		self.assertEqual(template.getAttribute("media"),
+						 "720p/segment-$Number%05d$.ts")
+
+def report(**metrics):
+	result = {
+		"device": "test",
+		"preset": "Default",
+		"input": {"width": 320, "height": 240, "duration": 10},
+		"success": True,
+		"realtime_factor": 10.0,
+		"realtime_factor_noise": 0.1,
+		"time_to_first_frame": 0.5,
+		"peak_rss": 50000,
+	}
+	result.update(metrics)
+	return {"results": [result]}
+
+class BenchmarkCompareTest(unittest.TestCase):
+	def compare(self, baseline, current, threshold=0.05):
+		stdout, sys.stdout = sys.stdout, StringIO()
+		try:
+			return benchmark.compare(baseline, current, threshold)
+		finally:
+			sys.stdout = stdout
+
+	def test_unchanged(self):
+		self.assertEqual(self.compare(report(), report()), 0)
+
+	def test_slower(self):
+		self.assertEqual(self.compare(report(), report(realtime_factor=5.0)), 1)
+		self.assertEqual(self.compare(report(), report(time_to_first_frame=1.0)), 1)
+
+	def test_within_noise(self):
+		# A 10% change is above the threshold but within three times the
+		# noise of the two runs
+		self.assertEqual(self.compare(report(realtime_factor_noise=0.5),
+									  report(realtime_factor=9.0,
+											 realtime_factor_noise=0.5)), 0)
+
+	def test_informational_metrics(self):
+		self.assertEqual(self.compare(report(), report(peak_rss=100000)), 0)
+
+	def test_failed(self):
+		self.assertEqual(self.compare(report(), report(success=False)), 1)
+
+	def test_new_job(self):
+		current = report()
+		current["results"][0]["device"] = "other"
+		self.assertEqual(self.compare(report(), current), 0)
+
+if __name__ == "__main__":
+	unittest.main(argv = sys.argv + args)